@@ -0,0 +1,196 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+a local stand in for the web, for benchmarking fetching code.
+
+the response to a request is controlled by its query string:
+
+  delay       - seconds to wait before responding
+  status      - the response status, default 200
+  size        - the number of bytes in the body, default 1024
+  feed        - if 1, the body is an rss feed of roughly size bytes
+  chunks      - send the body in this many pieces...
+  chunk_delay - ...waiting this many seconds between them
+
+eg http://127.0.0.1:<port>/any/path?delay=0.1&size=20000&feed=1
+
+use as a script to run a server in the foreground:
+
+  python benchserver.py [port]
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cgi import parse_qs
+import random
+import threading
+import time
+from urllib import urlencode
+from urlparse import urlparse
+
+FEED_HEAD = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>bench</title><link>http://example.com/</link>
+<description>benchmark feed</description>
+"""
+FEED_ITEM = """<item><title>item %(n)d</title><link>http://example.com/%(n)d</link>
+<guid>http://example.com/%(n)d</guid><description>%(text)s</description></item>
+"""
+FEED_TAIL = "</channel></rss>\n"
+
+def make_feed(size):
+    parts = [FEED_HEAD]
+    total = len(FEED_HEAD) + len(FEED_TAIL)
+    n = 0
+    text = 'lorem ipsum dolor sit amet ' * 8
+    while total < size:
+        item = FEED_ITEM % {'n': n, 'text': text}
+        parts.append(item)
+        total += len(item)
+        n += 1
+    parts.append(FEED_TAIL)
+    return ''.join(parts)
+
+_bodies = {}
+def body_of(size, feed):
+    key = (size, feed)
+    try:
+        return _bodies[key]
+    except KeyError:
+        if feed:
+            body = make_feed(size)
+        else:
+            body = 'x' * size
+        _bodies[key] = body
+        return body
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        def param(name, default, convert):
+            if name in params:
+                return convert(params[name][0])
+            return default
+
+        delay = param('delay', 0.0, float)
+        status = param('status', 200, int)
+        size = param('size', 1024, int)
+        feed = param('feed', 0, int)
+        chunks = max(1, param('chunks', 1, int))
+        chunk_delay = param('chunk_delay', 0.0, float)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        body = body_of(size, feed)
+        self.send_response(status)
+        if feed:
+            self.send_header('Content-Type', 'application/rss+xml')
+        else:
+            self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        step = len(body) / chunks + 1
+        try:
+            for i in range(0, len(body), step):
+                if i > 0 and chunk_delay > 0:
+                    time.sleep(chunk_delay)
+                self.wfile.write(body[i:i+step])
+        except IOError:
+            # the client gave up on us
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), BenchHandler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, path='/', **params):
+        url = 'http://127.0.0.1:%d%s' % (self.port, path)
+        if params:
+            url += '?' + urlencode(sorted(params.items()))
+        return url
+
+    def start(self):
+        """
+        serves requests on a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def distribution(spec, rnd=random):
+    """
+    parses a latency distribution spec into a zero argument function
+    that samples it (in seconds):
+
+      fixed:S          always S
+      uniform:A:B      uniformly between A and B
+      exp:MEAN         exponentially distributed with mean MEAN
+      lognormal:MU:SIG lognormal, ie exp(normal(MU, SIG))
+      pareto:SCALE:A   pareto with shape A scaled by SCALE, long tailed
+    """
+    parts = spec.split(':')
+    kind = parts[0]
+    args = [float(x) for x in parts[1:]]
+    if kind == 'fixed':
+        return lambda: args[0]
+    if kind == 'uniform':
+        return lambda: rnd.uniform(args[0], args[1])
+    if kind == 'exp':
+        return lambda: rnd.expovariate(1.0 / args[0])
+    if kind == 'lognormal':
+        return lambda: rnd.lognormvariate(args[0], args[1])
+    if kind == 'pareto':
+        return lambda: args[0] * rnd.paretovariate(args[1])
+    raise ValueError('unknown distribution %r' % spec)
+
+
+if __name__ == '__main__':
+    import sys
+    port = 8000
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    server = BenchServer(port)
+    print 'serving on %s' % server.url()
+    server.serve_forever()
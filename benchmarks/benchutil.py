@@ -0,0 +1,111 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+helpers shared by the benchmark scripts in this directory.
+
+every benchmark prints (or writes with --output) a single json 
+document so that runs can be saved and compared.
+"""
+
+from optparse import OptionParser
+import platform
+import resource
+import sys
+import time
+
+import simplejson
+
+
+def make_parser(usage):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='write json results to this file instead of stdout')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                      help='number of times to repeat each measurement, the best is kept')
+    return parser
+
+def peak_rss_kb():
+    """
+    peak resident set size of this process so far, in kilobytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss
+
+def rss_kb():
+    """
+    current resident set size of this process in kilobytes, or None
+    where /proc is not available
+    """
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * resource.getpagesize() // 1024
+
+def percentiles(values, fractions=(0.5, 0.9, 0.99)):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for p in fractions:
+        if values:
+            summary['p%g' % (p * 100)] = values[min(len(values) - 1, int(p * len(values)))]
+        else:
+            summary['p%g' % (p * 100)] = None
+    if values:
+        summary['max'] = values[-1]
+    return summary
+
+def best_of(repeat, fn, *args, **kw):
+    """
+    runs fn repeat times, returns the (elapsed, result) of the fastest run
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        rc = fn(*args, **kw)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, rc)
+    return best
+
+def emit(name, params, results, output=None):
+    doc = {
+        'benchmark': name,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+    text = simplejson.dumps(doc, indent=2, sort_keys=True)
+    if output is None:
+        print text
+    else:
+        f = open(output, 'w')
+        try:
+            f.write(text)
+            f.write('\n')
+        finally:
+            f.close()
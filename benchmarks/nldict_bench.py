@@ -0,0 +1,165 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+times nldict under mixes of inserts, deletes and updates (overwriting
+an existing key), as for a per user window of the newest items, and
+loading a window from --ops stored items with one update against
+setting them one at a time, and rendering pages of 20 from a full
+window with a new item every --render-every pages, using the sorted
+view against sorting the items for each page.
+
+  python benchmarks/nldict_bench.py --ops 100000 --maxlen 500 \
+      --mixes insert,delete,update,mixed,load,render
+"""
+
+from operator import itemgetter
+import random
+
+from benchutil import make_parser, emit, best_of
+from melk.util.nldict import nldict
+
+# fractions of (insert, delete, update)
+MIXES = {
+    'insert': (1.0, 0.0, 0.0),
+    'delete': (0.5, 0.5, 0.0),
+    'update': (0.0, 0.0, 1.0),
+    'mixed': (0.6, 0.2, 0.2),
+}
+
+def make_ops(mix, nops, maxlen, seed=0):
+    """
+    returns a list of ('set', key, value) and ('del', key, None).
+    Deletes and updates are of one of the last maxlen keys inserted,
+    which are mostly still in the window.
+    """
+    rand = random.Random(seed)
+    inserts, deletes, updates = MIXES[mix]
+    ops = []
+    next_key = 0
+    for i in xrange(nops):
+        r = rand.random()
+        if r < inserts or next_key < maxlen:
+            ops.append(('set', next_key, rand.random()))
+            next_key += 1
+        else:
+            key = rand.randrange(next_key - maxlen, next_key)
+            if r < inserts + deletes:
+                ops.append(('del', key, None))
+            else:
+                ops.append(('set', key, rand.random()))
+    return ops
+
+def run(ops, maxlen):
+    d = nldict(maxlen, None)
+    for op, key, value in ops:
+        if op == 'set':
+            d[key] = value
+        elif key in d:
+            del d[key]
+    return d
+
+def load_items(pairs, maxlen):
+    d = nldict(maxlen, None)
+    for key, value in pairs:
+        d[key] = value
+    return d
+
+def load_bulk(pairs, maxlen):
+    return nldict(maxlen, None, pairs)
+
+PAGE_SIZE = 20
+
+def render_ops(nops, maxlen, every, seed=0):
+    """
+    returns a list of ('set', key, value) and ('page', offset, None)
+    """
+    rand = random.Random(seed)
+    ops = []
+    for i in xrange(nops):
+        if i % every == 0:
+            ops.append(('set', maxlen + i, rand.random()))
+        else:
+            ops.append(('page', rand.randrange(0, maxlen, PAGE_SIZE), None))
+    return ops
+
+def _filled(maxlen):
+    rand = random.Random(1)
+    return nldict(maxlen, None, ((i, rand.random()) for i in xrange(maxlen)))
+
+def render_view(ops, maxlen):
+    d = _filled(maxlen)
+    for op, key, value in ops:
+        if op == 'set':
+            d[key] = value
+        else:
+            d.slice(key, PAGE_SIZE)
+    return d
+
+def render_sorted(ops, maxlen):
+    d = _filled(maxlen)
+    for op, key, value in ops:
+        if op == 'set':
+            d[key] = value
+        else:
+            sorted(d.items(), key=itemgetter(1), reverse=True)[key:key + PAGE_SIZE]
+    return d
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_option('--ops', type='int', default=100000)
+    parser.add_option('--maxlen', type='int', default=500)
+    parser.add_option('--mixes', default='insert,delete,update,mixed,load,render')
+    parser.add_option('--render-every', type='int', default=10)
+    options, args = parser.parse_args()
+
+    runs = []
+    for mix in options.mixes.split(','):
+        if mix == 'load':
+            rand = random.Random(0)
+            pairs = [(i, rand.random()) for i in xrange(options.ops)]
+            runs.append(('load_items', load_items, pairs))
+            runs.append(('load_bulk', load_bulk, pairs))
+        elif mix == 'render':
+            # sorting per page is slow, so fewer of them
+            ops = render_ops(options.ops // 10, options.maxlen,
+                             options.render_every)
+            runs.append(('render_sorted', render_sorted, ops))
+            runs.append(('render_view', render_view, ops))
+        else:
+            runs.append((mix, run, make_ops(mix, options.ops, options.maxlen)))
+
+    results = []
+    for mix, func, ops in runs:
+        elapsed, d = best_of(options.repeat, func, ops, options.maxlen)
+        results.append({
+            'mix': mix,
+            'elapsed': elapsed,
+            'ops_per_second': len(ops) / elapsed,
+            'len': len(d),
+            # entries kept to track the window, ideally len
+            'heap_size': len(d._heap),
+        })
+
+    params = dict(vars(options))
+    params.pop('output')
+    emit('nldict', params, results, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+drives melk.util.spider.Spider against a local BenchServer and
+reports throughput, latency percentiles and memory use as json.
+memory is the growth in resident size over each run, with the
+process's peak so far alongside.
+
+  python benchmarks/spider_bench.py --poolsizes 4,16,64 --jobs 1000 \\
+      --mix fast:80,slow:5,error:10,large:5 --latency exp:0.02
+
+job kinds available to --mix:
+
+  fast    - a small feed after a --latency sampled delay
+  slow    - a 64k feed trickled out in 16 chunks
+  error   - a 500 after a --latency sampled delay
+  large   - a --large-size feed
+  timeout - a response slower than --timeout, ie a dead host
+"""
+
+import random
+import time
+
+from benchutil import make_parser, emit, peak_rss_kb, rss_kb, percentiles
+from benchserver import BenchServer, distribution
+from melk.util.spider import Spider, SpiderJob, DefaultHttp
+from melk.util.taskqueue import TaskQueue
+
+
+class BenchSpider(Spider):
+    def __init__(self, timeout, **kw):
+        Spider.__init__(self, **kw)
+        self._timeout = timeout
+
+    def _make_http_client(self):
+        return DefaultHttp(cache=self._cache, timeout=self._timeout)
+
+
+def parse_mix(spec):
+    mix = []
+    for part in spec.split(','):
+        kind, weight = part.split(':')
+        mix.append((kind, float(weight)))
+    return mix
+
+def make_urls(server, options, rnd):
+    latency = distribution(options.latency, rnd)
+    kinds = parse_mix(options.mix)
+    total = sum(w for k, w in kinds)
+
+    def pick():
+        x = rnd.uniform(0, total)
+        for kind, weight in kinds:
+            x -= weight
+            if x <= 0:
+                return kind
+        return kinds[-1][0]
+
+    urls = []
+    for i in range(options.jobs):
+        kind = pick()
+        path = '/%s/%d' % (kind, i)
+        if kind == 'fast':
+            url = server.url(path, delay='%0.4f' % latency(), size=4096, feed=1)
+        elif kind == 'slow':
+            url = server.url(path, size=65536, feed=1, chunks=16, chunk_delay=0.01)
+        elif kind == 'error':
+            url = server.url(path, delay='%0.4f' % latency(), status=500, size=64)
+        elif kind == 'large':
+            url = server.url(path, size=options.large_size, feed=1)
+        elif kind == 'timeout':
+            url = server.url(path, delay=options.timeout * 2)
+        else:
+            raise ValueError('unknown job kind %r' % kind)
+        urls.append(url)
+    return urls
+
+def run(urls, poolsize, timeout):
+    rss_before = rss_kb()
+    spider = BenchSpider(timeout, poolsize=poolsize, output_queue=TaskQueue())
+    try:
+        for url in urls:
+            spider.input_queue.put(SpiderJob(url))
+
+        start = time.time()
+        spider.start()
+        spider.join()
+        elapsed = time.time() - start
+        rss_after = rss_kb()
+    finally:
+        # don't leave workers behind to skew the next run
+        spider.shutdown(wait=True, drain=False)
+
+    stats = spider.metrics.snapshot()
+    return {
+        'poolsize': poolsize,
+        'jobs': len(urls),
+        'elapsed': elapsed,
+        'fetches_per_second': stats['fetches'] / elapsed,
+        'bytes_per_second': stats['bytes'] / elapsed,
+        'bytes': stats['bytes'],
+        'status': dict((str(k), v) for k, v in stats['status'].items()),
+        'latency': stats['latency'],
+        'rss_growth_kb': rss_after - rss_before if rss_before is not None else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_option('--poolsizes', default='4,16,64',
+                      help='comma separated spider pool sizes to try')
+    parser.add_option('--jobs', type='int', default=500)
+    parser.add_option('--mix', default='fast:80,slow:5,error:10,large:5',
+                      help='comma separated kind:weight pairs')
+    parser.add_option('--latency', default='exp:0.02',
+                      help='server latency distribution, see benchserver.distribution')
+    parser.add_option('--large-size', dest='large_size', type='int', default=2000000)
+    parser.add_option('--timeout', type='float', default=2.0,
+                      help='client socket timeout')
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args()
+
+    server = BenchServer().start()
+    try:
+        runs = []
+        for poolsize in [int(x) for x in options.poolsizes.split(',')]:
+            urls = make_urls(server, options, random.Random(options.seed))
+            best = None
+            for i in range(options.repeat):
+                rc = run(urls, poolsize, options.timeout)
+                if best is None or rc['elapsed'] < best['elapsed']:
+                    best = rc
+            runs.append(best)
+    finally:
+        server.stop()
+
+    params = dict(vars(options))
+    params.pop('output')
+    emit('spider', params, runs, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+compares Queue.Queue with FastTaskQueue under many producers and 
+consumers.  Consumers mark each item done and the run ends when join
+returns, so task accounting is part of the cost.  Each configuration
+is run with an unbounded and a bounded queue, one item at a time and 
+in batches (put_many / get_many / task_done_many).
+
+  python benchmarks/taskqueue_bench.py --items 200000 \
+      --threads 1x1,4x4,16x16 --maxsize 1000 --batch 32
+"""
+
+import threading
+from threading import Thread
+from Queue import Queue
+
+from benchutil import make_parser, emit, best_of
+from melk.util.taskqueue import FastTaskQueue, get_many, put_many, task_done_many
+
+STOP = object()
+
+def produce(q, n, batch):
+    if batch > 1:
+        for i in xrange(0, n, batch):
+            put_many(q, range(i, min(n, i + batch)))
+    else:
+        for i in xrange(n):
+            q.put(i)
+
+def consume(q, batch):
+    if batch > 1:
+        while True:
+            items = get_many(q, batch)
+            task_done_many(q, len(items))
+            if STOP in items:
+                # keep any other consumers' STOPs for them
+                for i in range(items.count(STOP) - 1):
+                    q.put(STOP)
+                return
+    else:
+        while True:
+            item = q.get()
+            q.task_done()
+            if item is STOP:
+                return
+
+def run(queue_class, maxsize, items, producers, consumers, batch):
+    q = queue_class(maxsize)
+    threads = [Thread(target=consume, args=(q, batch)) for i in range(consumers)]
+    per_producer = items // producers
+    threads += [Thread(target=produce, args=(q, per_producer, batch))
+                for i in range(producers)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads[consumers:]:
+        t.join()
+    q.join()
+    for i in range(consumers):
+        q.put(STOP)
+    for t in threads[:consumers]:
+        t.join()
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_option('--items', type='int', default=200000)
+    parser.add_option('--threads', default='1x1,4x4,16x16',
+                      help='producers x consumers, comma separated')
+    parser.add_option('--maxsize', type='int', default=1000)
+    parser.add_option('--batch', type='int', default=32)
+    options, args = parser.parse_args()
+
+    results = []
+    for spec in options.threads.split(','):
+        producers, consumers = [int(x) for x in spec.split('x')]
+        for maxsize in (0, options.maxsize):
+            for batch in (1, options.batch):
+                for queue_class in (Queue, FastTaskQueue):
+                    elapsed, rc = best_of(options.repeat, run, queue_class, maxsize,
+                                          options.items, producers, consumers, batch)
+                    results.append({
+                        'queue': queue_class.__name__,
+                        'producers': producers,
+                        'consumers': consumers,
+                        'maxsize': maxsize,
+                        'batch': batch,
+                        'elapsed': elapsed,
+                        'items_per_second': options.items / elapsed,
+                    })
+
+    params = dict(vars(options))
+    params.pop('output')
+    emit('taskqueue', params, results, options.output)
+
+if __name__ == '__main__':
+    main()
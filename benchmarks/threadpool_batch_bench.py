@@ -0,0 +1,81 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+compares ThreadPool's per job worker loop with batch mode for many
+tiny jobs (computing melk ids), with and without a batch processor.
+
+  python benchmarks/threadpool_batch_bench.py --jobs 100000 \
+      --poolsize 4 --batch-sizes 1,8,32,128
+"""
+
+from benchutil import make_parser, emit, best_of
+from melk.util.hash import melk_id
+from melk.util.taskqueue import TaskQueue
+from melk.util.threadpool import ThreadPool
+
+
+def per_item(iid):
+    return melk_id(iid)
+
+def per_batch(iids):
+    return [melk_id(iid) for iid in iids]
+
+def run(jobs, poolsize, batch_size, batched_processor):
+    if batched_processor:
+        tp = ThreadPool(poolsize=poolsize, output_queue=TaskQueue(),
+                        batch_size=batch_size, batch_processor=per_batch)
+    else:
+        tp = ThreadPool(poolsize=poolsize, output_queue=TaskQueue(),
+                        batch_size=batch_size, processor=per_item)
+    for job in jobs:
+        tp.input_queue.put(job)
+    tp.start()
+    tp.join()
+    tp.shutdown()
+    assert tp.output_queue.qsize() == len(jobs)
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_option('--jobs', type='int', default=100000)
+    parser.add_option('--poolsize', type='int', default=4)
+    parser.add_option('--batch-sizes', dest='batch_sizes', default='1,8,32,128')
+    options, args = parser.parse_args()
+
+    jobs = [u'http://example.com/item/%d' % i for i in range(options.jobs)]
+    results = []
+    for batch_size in [int(x) for x in options.batch_sizes.split(',')]:
+        for batched_processor in (False, True):
+            if batch_size == 1 and batched_processor:
+                continue
+            elapsed, rc = best_of(options.repeat, run, jobs, options.poolsize,
+                                  batch_size, batched_processor)
+            results.append({
+                'batch_size': batch_size,
+                'batch_processor': batched_processor,
+                'elapsed': elapsed,
+                'jobs_per_second': len(jobs) / elapsed,
+            })
+
+    params = dict(vars(options))
+    params.pop('output')
+    emit('threadpool_batch', params, results, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+compares a ThreadPool taking jobs from the shared TaskQueue with one
+using a WorkStealingQueue, for many workers and jobs of very uneven
+cost: mostly trivial with an occasional slow (sleeping) one.  Jobs are 
+put while the pool runs, as they would be in a chain.
+
+  python benchmarks/threadpool_contention_bench.py --jobs 50000 \
+      --workers 8,32,128 --slow-every 100 --slow-time 0.002
+"""
+
+import random
+
+from benchutil import make_parser, emit, best_of
+from melk.util.taskqueue import TaskQueue, WorkStealingQueue
+from melk.util.threadpool import ThreadPool
+import time
+
+
+class Job(object):
+    __slots__ = ('delay',)
+
+    def __init__(self, delay):
+        self.delay = delay
+
+def process(job):
+    if job.delay:
+        time.sleep(job.delay)
+    return job
+
+def run(jobs, workers, queue_class):
+    tp = ThreadPool(poolsize=workers, processor=process,
+                    input_queue=queue_class())
+    tp.start()
+    for job in jobs:
+        tp.input_queue.put(job)
+    tp.join()
+    tp.shutdown()
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_option('--jobs', type='int', default=50000)
+    parser.add_option('--workers', default='8,32,128')
+    parser.add_option('--slow-every', dest='slow_every', type='int', default=100)
+    parser.add_option('--slow-time', dest='slow_time', type='float', default=0.002)
+    options, args = parser.parse_args()
+
+    rand = random.Random(0)
+    jobs = []
+    for i in range(options.jobs):
+        if rand.randrange(options.slow_every) == 0:
+            jobs.append(Job(rand.random() * 2 * options.slow_time))
+        else:
+            jobs.append(Job(0))
+
+    results = []
+    for workers in [int(x) for x in options.workers.split(',')]:
+        for queue_class in (TaskQueue, WorkStealingQueue):
+            elapsed, rc = best_of(options.repeat, run, jobs, workers, queue_class)
+            results.append({
+                'workers': workers,
+                'queue': queue_class.__name__,
+                'elapsed': elapsed,
+                'jobs_per_second': len(jobs) / elapsed,
+            })
+
+    params = dict(vars(options))
+    params.pop('output')
+    emit('threadpool_contention', params, results, options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+adjusts the number of workers of ThreadPools to their load.
+"""
+
+import logging
+import threading
+from threading import Thread
+import traceback
+
+log = logging.getLogger(__name__)
+
+
+class _Periodic(object):
+    """
+    calls self.check every interval seconds on a daemon thread
+    between start and stop.
+    """
+
+    interval = 1.0
+
+    def start(self):
+        self.stop()
+        self._stopped = threading.Event()
+        self._thread = Thread(target=self._run, args=(self._stopped,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        thread = getattr(self, '_thread', None)
+        if thread is not None:
+            self._stopped.set()
+            if thread is not threading.currentThread():
+                thread.join()
+            self._thread = None
+
+    def _run(self, stopped):
+        while True:
+            stopped.wait(self.interval)
+            if stopped.isSet():
+                return
+            try:
+                self.check()
+            except:
+                log.error(traceback.format_exc())
+
+
+class Autoscaler(_Periodic):
+    """
+    grows or shrinks the workers of a ThreadPool between min_workers
+    and max_workers.  Every interval seconds it looks at the pool:
+
+    - if more than grow_depth jobs per worker are waiting in the 
+      input queue, the pool is short of workers.
+    - if nothing is waiting and the workers were busy less than 
+      idle_threshold of the time, the pool has workers to spare.
+
+    the pool is only resized after patience checks in a row agree, 
+    growing by grow_step workers or shrinking by one at a time.
+    """
+
+    def __init__(self, pool, min_workers=1, max_workers=None, interval=1.0,
+                 grow_depth=1.0, idle_threshold=0.3, patience=3, grow_step=2):
+        if max_workers is None:
+            max_workers = pool.poolsize
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError('need 1 <= min_workers <= max_workers, got %r, %r' %
+                             (min_workers, max_workers))
+        self.pool = pool
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.grow_depth = grow_depth
+        self.idle_threshold = idle_threshold
+        self.patience = patience
+        self.grow_step = grow_step
+
+        self._mark = pool.pool_stats.mark()
+        self._trend = 0
+
+    def check(self):
+        """
+        looks at the pool once, resizing it if warranted.  returns 
+        the new pool size if it was resized, otherwise None.
+        """
+        pool = self.pool
+        size = pool.poolsize
+        depth = pool.input_queue.qsize()
+        utilization, self._mark = pool.pool_stats.utilization(self._mark, size)
+
+        if depth > self.grow_depth * size and size < self.max_workers:
+            trend = 1
+        elif depth == 0 and utilization < self.idle_threshold and size > self.min_workers:
+            trend = -1
+        else:
+            trend = 0
+
+        # hysteresis: only act on a signal that persists
+        if trend == 0 or (self._trend > 0) != (trend > 0):
+            self._trend = trend
+        else:
+            self._trend += trend
+        if abs(self._trend) < self.patience:
+            return None
+
+        self._trend = 0
+        if trend > 0:
+            size = min(self.max_workers, size + self.grow_step)
+        else:
+            size = max(self.min_workers, size - 1)
+        log.debug("resizing %s to %d workers (queued=%d, utilization=%0.2f)" %
+                  (pool.name, size, depth, utilization))
+        pool.resize(size)
+        return size
+
+
+class ChainBalancer(_Periodic):
+    """
+    moves worker threads between the stages of a ThreadPoolChain, from 
+    the most idle stage toward the slowest one, keeping the total the 
+    same.  Stages that cannot be resized (eg ProcessPools) are left alone.
+
+    every interval seconds the stages are compared.  The slowest stage is
+    the one with the most work waiting per worker, or failing that the
+    busiest.  A worker moves when the slowest stage is short of workers 
+    (more than grow_depth jobs waiting per worker, or busier than 
+    busy_threshold) while another stage is busy less than idle_threshold
+    of the time, and the same pair has come up patience times in a row.
+    """
+
+    def __init__(self, chain, interval=1.0, grow_depth=1.0, busy_threshold=0.8,
+                 idle_threshold=0.3, patience=3, min_workers=1):
+        self.chain = chain
+        self.interval = interval
+        self.grow_depth = grow_depth
+        self.busy_threshold = busy_threshold
+        self.idle_threshold = idle_threshold
+        self.patience = patience
+        self.min_workers = min_workers
+
+        self._marks = {}
+        self._candidate = None
+        self._count = 0
+
+    def check(self):
+        """
+        compares the stages once.  returns (from stage, to stage) if a 
+        worker was moved, otherwise None.
+        """
+        loads = []
+        for tp in self.chain.stages:
+            if not hasattr(tp, 'resize'):
+                continue
+            mark = self._marks.get(id(tp))
+            if mark is None:
+                mark = tp.pool_stats.mark()
+            utilization, self._marks[id(tp)] = tp.pool_stats.utilization(mark, tp.poolsize)
+            backlog = float(tp.input_queue.qsize()) / tp.poolsize
+            loads.append((backlog, utilization, tp))
+        if len(loads) < 2:
+            return None
+
+        backlog, utilization, slowest = max(loads, key=lambda l: (l[0], l[1]))
+        donors = [l for l in loads if l[2] is not slowest and
+                  l[2].poolsize > self.min_workers and l[0] == 0]
+        if not donors or not (backlog > self.grow_depth or
+                              utilization >= self.busy_threshold):
+            self._candidate = None
+            return None
+        d_backlog, d_utilization, donor = min(donors, key=lambda l: l[1])
+        if d_utilization >= self.idle_threshold:
+            self._candidate = None
+            return None
+
+        candidate = (id(donor), id(slowest))
+        if candidate != self._candidate:
+            self._candidate = candidate
+            self._count = 0
+        self._count += 1
+        if self._count < self.patience:
+            return None
+
+        self._candidate = None
+        log.debug("moving a worker from %s to %s" % (donor.name, slowest.name))
+        donor.resize(donor.poolsize - 1)
+        slowest.resize(slowest.poolsize + 1)
+        return donor, slowest
@@ -0,0 +1,260 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+per host metadata (robots.txt rules, crawl-delay, addresses) shared
+by many fetching threads.
+"""
+
+from robotparser import RobotFileParser
+import socket
+import threading
+import time
+import traceback
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class HostInfo(object):
+    """
+    what is known about a host.
+
+    robots - a RobotFileParser, or None if everything is allowed
+    crawl_delay - seconds to leave between fetches, or None
+    addresses - the ip addresses the host resolved to
+    """
+
+    def __init__(self, host, robots=None, crawl_delay=None, addresses=()):
+        self.host = host
+        self.robots = robots
+        self.crawl_delay = crawl_delay
+        self.addresses = list(addresses)
+        self._lock = threading.Lock()
+        self._next_fetch = 0
+
+    def allowed(self, url, agent):
+        if self.robots is None:
+            return True
+        return self.robots.can_fetch(agent, url)
+
+    def try_turn(self, delay=None):
+        """
+        takes this host's turn if delay (by default the crawl delay)
+        has passed since the last fetch from it started and returns 0,
+        otherwise returns the seconds left without taking it.
+        """
+        if delay is None:
+            delay = self.crawl_delay
+        if not delay:
+            return 0
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if now < self._next_fetch:
+                return self._next_fetch - now
+            self._next_fetch = now + delay
+            return 0
+        finally:
+            self._lock.release()
+
+    def wait_turn(self, delay=None):
+        """
+        blocks until delay (by default the crawl delay) has passed
+        since the last fetch from this host started. returns the time
+        spent waiting.
+        """
+        if delay is None:
+            delay = self.crawl_delay
+        if not delay:
+            return 0
+        self._lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self._next_fetch)
+            self._next_fetch = start + delay
+        finally:
+            self._lock.release()
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def parse_crawl_delay(lines, agent):
+    """
+    finds the Crawl-delay for agent (or failing that for *) in the
+    lines of a robots.txt, robotparser ignores it.
+    """
+    agent = agent.lower()
+    delays = {}
+    group = []
+    in_rules = False
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        field, value = line.split(':', 1)
+        field = field.strip().lower()
+        value = value.strip()
+        if field == 'user-agent':
+            if in_rules:
+                group = []
+                in_rules = False
+            group.append(value.lower())
+        else:
+            in_rules = True
+            if field == 'crawl-delay':
+                try:
+                    delay = float(value)
+                except ValueError:
+                    continue
+                for ua in group:
+                    delays.setdefault(ua, delay)
+
+    for ua, delay in delays.items():
+        if ua != '*' and ua in agent:
+            return delay
+    return delays.get('*')
+
+
+class _Entry(object):
+    def __init__(self):
+        self.ready = threading.Event()
+        self.info = None
+        self.expires = 0
+
+
+class HostCache(object):
+    """
+    a TTL bounded cache of HostInfo shared by many threads.
+
+    when a host is not cached, the first thread asking for it loads
+    it while any others asking for the same host wait for that result
+    rather than loading it again.
+    """
+
+    def __init__(self, ttl=3600, error_ttl=300, max_hosts=10000,
+                 agent='melkjug', resolve=False):
+        """
+        ttl - seconds host information is kept
+        error_ttl - seconds to keep the information for hosts whose
+                    robots.txt could not be fetched
+        max_hosts - about the most hosts kept at once
+        agent - the user agent robots rules are read for
+        resolve - if True, also look up the addresses of hosts
+        """
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_hosts = max_hosts
+        self.agent = agent
+        self.resolve = resolve
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, host, http_client, scheme='http'):
+        """
+        returns the HostInfo for host, loading it with http_client
+        if it is not cached.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(host)
+            if entry is not None and entry.ready.isSet() and entry.expires <= now:
+                entry = None
+            if entry is None:
+                entry = self._entries[host] = _Entry()
+                loading = True
+                if len(self._entries) > self.max_hosts:
+                    self._prune(now)
+            else:
+                loading = False
+        finally:
+            self._lock.release()
+
+        if not loading:
+            entry.ready.wait()
+            return entry.info
+
+        try:
+            info, ttl = self._load(host, http_client, scheme)
+        except:
+            log.error("loading info for %s: %s" % (host, traceback.format_exc()))
+            info, ttl = HostInfo(host), self.error_ttl
+        entry.info = info
+        entry.expires = time.time() + ttl
+        entry.ready.set()
+        return info
+
+    def _prune(self, now):
+        # called with the lock held
+        entries = self._entries
+        for host, entry in entries.items():
+            if entry.ready.isSet() and entry.expires <= now:
+                del entries[host]
+        over = len(entries) - self.max_hosts
+        if over > 0:
+            oldest = sorted((e.expires, h) for h, e in entries.items() if e.ready.isSet())
+            for expires, host in oldest[:over]:
+                del entries[host]
+
+    def invalidate(self, host):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(host)
+            if entry is not None and entry.ready.isSet():
+                del self._entries[host]
+        finally:
+            self._lock.release()
+
+    def _load(self, host, http_client, scheme):
+        """
+        returns (HostInfo, seconds to keep it) for host.
+        """
+        addresses = ()
+        if self.resolve:
+            try:
+                addresses = socket.gethostbyname_ex(host)[2]
+            except socket.error:
+                pass
+
+        url = '%s://%s/robots.txt' % (scheme, host)
+        response, content = http_client.request(url, 'GET')
+        status = response.status
+        if status == 200:
+            lines = content.splitlines()
+            robots = RobotFileParser(url)
+            robots.parse(lines)
+            return HostInfo(host, robots, parse_crawl_delay(lines, self.agent),
+                            addresses), self.ttl
+        if status in (408, 429):
+            # a timeout or being told to back off says nothing about
+            # the rules, allow but check again sooner
+            return HostInfo(host, None, None, addresses), self.error_ttl
+        if status in (401, 403):
+            # treat as forbidding everything
+            robots = RobotFileParser(url)
+            robots.disallow_all = True
+            return HostInfo(host, robots, None, addresses), self.ttl
+        if 400 <= status < 500:
+            # no robots.txt, anything goes
+            return HostInfo(host, None, None, addresses), self.ttl
+        # server trouble, allow but check again sooner
+        return HostInfo(host, None, None, addresses), self.error_ttl
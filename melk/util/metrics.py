@@ -0,0 +1,161 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+low overhead counters and latency histograms for code running
+in many threads.
+
+each thread records into its own shard without taking any locks,
+shards are merged when a snapshot is read.  Recording relies on
+single dict operations being atomic under the GIL, reading copies
+each shard's dicts before merging them.
+"""
+
+import math
+import threading
+import time
+
+# latency buckets grow by this factor, so percentiles are accurate
+# to within about 10%
+BUCKET_BASE = 1.1
+_LOG_BASE = math.log(BUCKET_BASE)
+# values at or below this (in seconds) all land in bucket 0
+BUCKET_MIN = 0.0001
+
+def bucket_of(value):
+    if value <= BUCKET_MIN:
+        return 0
+    return int(math.log(value / BUCKET_MIN) / _LOG_BASE) + 1
+
+def bucket_ceiling(bucket):
+    return BUCKET_MIN * (BUCKET_BASE ** bucket)
+
+def percentile(buckets, fraction):
+    """
+    estimates the given percentile (0.0 - 1.0) of the values
+    recorded in a merged bucket -> count mapping.  Returns None
+    if nothing was recorded.
+    """
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    rank = fraction * total
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= rank:
+            return bucket_ceiling(bucket)
+    return bucket_ceiling(max(buckets))
+
+DEFAULT_PERCENTILES = (0.5, 0.9, 0.99)
+
+def summarize(buckets, percentiles=DEFAULT_PERCENTILES):
+    """
+    summarizes a bucket -> count mapping as a dict of
+    count and percentiles, eg {'count': 10, 'p50': 0.1, ...}
+    """
+    summary = {'count': sum(buckets.values())}
+    for p in percentiles:
+        summary['p%g' % (p * 100)] = percentile(buckets, p)
+    return summary
+
+
+class _Shard(object):
+    __slots__ = ('counts', 'histograms')
+
+    def __init__(self):
+        # name -> number
+        self.counts = {}
+        # name -> {bucket -> count}
+        self.histograms = {}
+
+
+class Metrics(object):
+    """
+    a set of named counters and histograms. Names may be any
+    hashable, eg ('status', 200).
+
+    incr and observe only touch the calling thread's shard.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self.started = time.time()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            self._shards_lock.acquire()
+            try:
+                self._shards.append(shard)
+            finally:
+                self._shards_lock.release()
+            return shard
+
+    def incr(self, name, n=1):
+        counts = self._shard().counts
+        counts[name] = counts.get(name, 0) + n
+
+    def observe(self, name, value):
+        histograms = self._shard().histograms
+        try:
+            buckets = histograms[name]
+        except KeyError:
+            buckets = histograms[name] = {}
+        b = bucket_of(value)
+        buckets[b] = buckets.get(b, 0) + 1
+
+    def merged(self):
+        """
+        returns (counts, histograms) merged over all threads.
+        """
+        self._shards_lock.acquire()
+        try:
+            shards = list(self._shards)
+        finally:
+            self._shards_lock.release()
+
+        counts = {}
+        histograms = {}
+        for shard in shards:
+            for name, n in dict(shard.counts).items():
+                counts[name] = counts.get(name, 0) + n
+            for name, buckets in dict(shard.histograms).items():
+                merged = histograms.setdefault(name, {})
+                for b, n in dict(buckets).items():
+                    merged[b] = merged.get(b, 0) + n
+        return counts, histograms
+
+    def reset(self):
+        """
+        starts over from zero.  Recording that races with a reset
+        may be lost.
+        """
+        self._shards_lock.acquire()
+        try:
+            for shard in self._shards:
+                shard.counts = {}
+                shard.histograms = {}
+            self.started = time.time()
+        finally:
+            self._shards_lock.release()
@@ -1,10 +1,74 @@
-from collections import MutableMapping
-from heapq import heapify, heappop, heappush, heapreplace
-from itertools import izip, repeat
+from collections import Mapping, MutableMapping
+from heapq import heapify, heapreplace
+from itertools import count, islice, izip, repeat
+from operator import itemgetter
 from functools import wraps
 
 from melk.util.obsdict import obsdict
 
+
+# The heap is a list of [cmpval, -seq, key] entries, where seq orders the
+# keys by insertion, with a key -> position in the heap map alongside so
+# that any entry can be found, moved or removed in O(log n).  Among equal
+# cmpvals the most recently inserted is the smallest, so it is the one
+# evicted, and since -seq is unique keys are never compared.
+
+def _sift_up(heap, positions, pos):
+    """
+    moves the entry at pos toward the root until its parent is smaller
+    """
+    entry = heap[pos]
+    while pos > 0:
+        parentpos = (pos - 1) >> 1
+        parent = heap[parentpos]
+        if entry < parent:
+            heap[pos] = parent
+            positions[parent[2]] = pos
+            pos = parentpos
+        else:
+            break
+    heap[pos] = entry
+    positions[entry[2]] = pos
+
+def _sift_down(heap, positions, pos):
+    """
+    moves the entry at pos away from the root until its children are larger
+    """
+    endpos = len(heap)
+    entry = heap[pos]
+    childpos = 2 * pos + 1
+    while childpos < endpos:
+        child = heap[childpos]
+        rightpos = childpos + 1
+        if rightpos < endpos and heap[rightpos] < child:
+            childpos = rightpos
+            child = heap[rightpos]
+        if child < entry:
+            heap[pos] = child
+            positions[child[2]] = pos
+            pos = childpos
+            childpos = 2 * pos + 1
+        else:
+            break
+    heap[pos] = entry
+    positions[entry[2]] = pos
+
+def _nlargest(n, iterable):
+    """
+    returns the n largest items of iterable as a heap.  Like
+    heapq.nlargest, but cheap for the items too small to make it.
+    """
+    it = iter(iterable)
+    result = list(islice(it, n))
+    heapify(result)
+    if len(result) == n:
+        smallest = result[0]
+        for item in it:
+            if item > smallest:
+                heapreplace(result, item)
+                smallest = result[0]
+    return result
+
 # based on OrderedDict recipe for Python >= 2.6:
 # http://code.activestate.com/recipes/576669/
 class nldict(obsdict, MutableMapping):
@@ -173,6 +237,37 @@ class nldict(obsdict, MutableMapping):
         >>> sorted(largest2.items())
         [(-1, 0), (0, 0)]
 
+    Overwriting a key moves it to its new place, whether that is up or
+    down, and never costs another mapping its place::
+
+        >>> window = nldict(3, None, a=1, b=2, c=3)
+        >>> window['c'] = 0
+        >>> window['d'] = 4 # replaces c, now the smallest
+        >>> sorted(window.items())
+        [('a', 1), ('b', 2), ('d', 4)]
+        >>> window['a'] = 5
+        >>> window.popitem()
+        ('b', 2)
+
+    Among equal smallest values, the most recently inserted goes first::
+
+        >>> tied = nldict(3, None)
+        >>> tied.update([('x', 1), ('y', 1), ('z', 1)])
+        >>> tied['w'] = 2
+        >>> sorted(tied)
+        ['w', 'x', 'y']
+
+    Sorted views, largest first, in the reverse of the order mappings
+    would be evicted in::
+
+        >>> tied.top(2)
+        [('w', 2), ('x', 1)]
+        >>> list(tied.iter_sorted(reverse=False))
+        [('y', 1), ('x', 1), ('w', 2)]
+        >>> tied['v'] = 3
+        >>> tied.slice(1, 2)
+        [('w', 2), ('x', 1)]
+
     """
 
     def __init__(self, maxlen, sortkey, *args, **kwds):
@@ -198,16 +293,69 @@ class nldict(obsdict, MutableMapping):
         if sortkey is not None and not hasattr(sortkey, '__call__'):
             raise ValueError('sortkey must be either None or a callable')
         obsdict.__init__(self)
+        # (key, value) pairs largest first, None until asked for
+        self._sorted = None
         self._maxlen = maxlen
         self._sortkey = sortkey
         self._heap = []
+        # key -> position of its entry in _heap
+        self._positions = {}
+        self._seq = 0
         self.update(*args, **kwds)
 
+    def _notify(self, callbackname, *args, **kwds):
+        # every change to the mappings is notified
+        self._sorted = None
+        obsdict._notify(self, callbackname, *args, **kwds)
+
+    def _notify_updated(self, deleted, set):
+        self._sorted = None
+        obsdict._notify_updated(self, deleted, set)
+
     def _reheapify(self):
+        self._sorted = None
         sk = self._sortkey
-        self._heap = [(sk(v), k) for (k, v) in self.iteritems()] if sk else \
-                     [(v, k) for (k, v) in self.iteritems()]
-        heapify(self._heap)
+        # keep the insertion order of keys already in the heap
+        negseqs = dict((e[2], e[1]) for e in self._heap)
+        heap = []
+        for k, v in self.iteritems():
+            negseq = negseqs.get(k)
+            if negseq is None:
+                self._seq += 1
+                negseq = -self._seq
+            heap.append([sk(v) if sk else v, negseq, k])
+        heapify(heap)
+        self._heap = heap
+        self._positions = dict((e[2], i) for i, e in enumerate(heap))
+
+    def _heap_push(self, key, cmpval):
+        self._seq += 1
+        self._heap.append([cmpval, -self._seq, key])
+        _sift_up(self._heap, self._positions, len(self._heap) - 1)
+
+    def _heap_remove(self, key):
+        heap = self._heap
+        pos = self._positions.pop(key)
+        last = heap.pop()
+        if pos < len(heap):
+            # fill the hole with the last entry and move it into place
+            heap[pos] = last
+            self._positions[last[2]] = pos
+            if pos > 0 and last < heap[(pos - 1) >> 1]:
+                _sift_up(heap, self._positions, pos)
+            else:
+                _sift_down(heap, self._positions, pos)
+
+    def _heap_update(self, key, cmpval):
+        heap = self._heap
+        pos = self._positions[key]
+        entry = heap[pos]
+        old = entry[0]
+        entry[0] = cmpval
+        if cmpval < old:
+            _sift_up(heap, self._positions, pos)
+        elif old < cmpval:
+            _sift_down(heap, self._positions, pos)
 
     def _maxlen_get(self):
         return self._maxlen
@@ -241,6 +389,7 @@ class nldict(obsdict, MutableMapping):
         if self._sortkey == value:
             return
         self._sortkey = value
+        self._sorted = None
         if self._maxlen is not None:
             self._reheapify()
 
@@ -251,9 +400,66 @@ class nldict(obsdict, MutableMapping):
         accordingly.
         """)
 
+    def _sorted_items(self):
+        """
+        returns the (key, value) pairs largest first, sorting them only
+        if they changed since last time.
+        """
+        items = self._sorted
+        if items is None:
+            if self._maxlen is not None:
+                # ties go to the earlier inserted, as in the heap
+                items = [(e[2], dict.__getitem__(self, e[2]))
+                         for e in sorted(self._heap, reverse=True)]
+            elif self._sortkey is not None:
+                sk = self._sortkey
+                items = sorted(self.iteritems(), key=lambda kv: sk(kv[1]),
+                               reverse=True)
+            else:
+                items = sorted(self.iteritems(), key=itemgetter(1),
+                               reverse=True)
+            self._sorted = items
+        return items
+
+    def iter_sorted(self, reverse=True):
+        """
+        Iterates over the (key, value) pairs by sort value, largest first
+        unless ``reverse`` is False.  The sorted order is kept until the
+        next change to the mappings, so repeated calls are O(1) to start.
+        Changing mapped values in place is not noticed.
+
+        The iteration is over a snapshot, so the mappings may be changed
+        while iterating.
+        """
+        items = self._sorted_items()
+        return iter(items) if reverse else reversed(items)
+
+    def top(self, k):
+        """
+        Returns a list of the ``k`` largest (key, value) pairs, largest
+        first.
+        """
+        if k < 0:
+            raise ValueError('k must not be negative, got %r' % k)
+        return self._sorted_items()[:k]
+
+    def slice(self, offset, limit):
+        """
+        Returns a list of up to ``limit`` (key, value) pairs starting at
+        the ``offset`` largest, e.g. a page of a river.
+        """
+        if offset < 0 or limit < 0:
+            raise ValueError('offset and limit must not be negative, got %r, %r'
+                             % (offset, limit))
+        return self._sorted_items()[offset:offset + limit]
+
     def clear(self):
-        del self._heap[:]
+        # observers are told before the mappings go, so the heap goes
+        # after them, as does anything sorted during the notifications
         obsdict.clear(self)
+        del self._heap[:]
+        self._positions.clear()
+        self._sorted = None
     
     def copy(self):
         """
@@ -275,27 +481,43 @@ class nldict(obsdict, MutableMapping):
 
     @_onlyifmaxlen
     def __setitem__(self, key, value):
+        """
+        O(log n).  A key already present always takes the new value,
+        otherwise the mapping only goes in if there is room or its value
+        is larger than the smallest, which is then discarded.
+        """
         cmpval = self._sortkey(value) if self._sortkey else value
-        heapitem = (cmpval, key)
-        if len(self) < self._maxlen:
-            heappush(self._heap, heapitem)
+        # the heap and the mappings both change before observers are
+        # told, so that they see them agree
+        if key in self._positions:
+            self._heap_update(key, cmpval)
+            oldval = dict.__getitem__(self, key)
+            dict.__setitem__(self, key, value)
+            self._notify('mapping_deleted', key, oldval)
+            self._notify('mapping_set', key, value)
+        elif len(self) < self._maxlen:
+            self._heap_push(key, cmpval)
             obsdict.__setitem__(self, key, value)
         elif cmpval > self._heap[0][0]:
-            removed = heapreplace(self._heap, heapitem)
-            obsdict.__delitem__(self, removed[1])
-            obsdict.__setitem__(self, key, value)
+            # replace the smallest entry in place
+            heap = self._heap
+            removed = heap[0][2]
+            del self._positions[removed]
+            self._seq += 1
+            heap[0] = [cmpval, -self._seq, key]
+            _sift_down(heap, self._positions, 0)
+            removedval = dict.pop(self, removed)
+            dict.__setitem__(self, key, value)
+            self._notify('mapping_deleted', removed, removedval)
+            self._notify('mapping_set', key, value)
 
     @_onlyifmaxlen
     def __delitem__(self, key):
         """
-        This is not O(1) because we have to traverse the heap to find the item
-        to delete and then reheapify!
+        O(log n)
         """
-        value = obsdict.pop(self, key)
-        cmpval = self._sortkey(value) if self._sortkey else value
-        heapitem = (cmpval, key)
-        self._heap.remove(heapitem)
-        heapify(self._heap)
+        self._heap_remove(key)
+        obsdict.pop(self, key)
 
     @_onlyifmaxlen
     def popitem(self):
@@ -305,17 +527,91 @@ class nldict(obsdict, MutableMapping):
         """
         if not self:
             raise KeyError
-        removed = heappop(self._heap)
-        key = removed[1]
+        key = self._heap[0][2]
+        self._heap_remove(key)
         value = obsdict.pop(self, key)
         return key, value
 
     __iter__ = obsdict.__iter__
 
+    def update(*args, **kwds):
+        """
+        Same as setting each mapping in turn, but when the keys are new
+        and distinct (e.g. loading a window from storage) the ``maxlen``
+        largest are selected in one pass, the heap is rebuilt in linear
+        time and observers get one ``mapping_updated`` with the net
+        change.  Mappings that would have been inserted and evicted again
+        within the update are not reported.
+        """
+        # self is taken from args so that 'self' can be a keyword
+        if not args:
+            raise TypeError('update() takes at least 1 argument (0 given)')
+        self, args = args[0], args[1:]
+        if len(args) > 1:
+            raise TypeError('update() takes at most 2 arguments (%d given)'
+                            % (len(args) + 1))
+        if self._maxlen is None:
+            return MutableMapping.update(self, *args, **kwds)
+
+        # the same order MutableMapping.update would set them in
+        pairs = []
+        if args:
+            other = args[0]
+            if isinstance(other, Mapping):
+                pairs.extend((k, other[k]) for k in other)
+            elif hasattr(other, 'keys'):
+                pairs.extend((k, other[k]) for k in other.keys())
+            else:
+                pairs.extend(other)
+        pairs.extend(kwds.iteritems())
+
+        new = dict(pairs)
+        if len(new) != len(pairs) or not set(self).isdisjoint(new):
+            # overwrites depend on what came before, go one at a time
+            for k, v in pairs:
+                self[k] = v
+            return
+        if pairs:
+            self._bulk_insert(pairs)
+
+    def _bulk_insert(self, pairs):
+        """
+        inserts pairs, whose keys are distinct and not yet present, with
+        the outcome of inserting them one at a time.
+        """
+        sk = self._sortkey
+        firstseq = self._seq + 1
+        values = map(itemgetter(1), pairs)
+        cmpvals = map(sk, values) if sk else values
+        self._seq += len(pairs)
+
+        # inserting one at a time always keeps the maxlen largest
+        # (cmpval, -seq) seen so far, so does selecting them at the end
+        keys = dict((e[1], e[2]) for e in self._heap)
+        candidates = [(e[0], e[1]) for e in self._heap]
+        candidates.extend(izip(cmpvals, count(-firstseq, -1)))
+        kept = _nlargest(self._maxlen, candidates)
+
+        # kept is a heap already, in the same order as the entries
+        heap = []
+        inserted = []
+        for cmpval, negseq in kept:
+            if negseq > -firstseq:
+                key = keys.pop(negseq)
+            else:
+                key, value = pairs[-negseq - firstseq]
+                inserted.append((key, value))
+            heap.append([cmpval, negseq, key])
+        self._heap = heap
+        self._positions = dict((e[2], i) for i, e in enumerate(heap))
+
+        deleted = [(k, dict.pop(self, k)) for k in keys.itervalues()]
+        dict.update(self, inserted)
+        self._notify_updated(deleted, inserted)
+
     # Methods with indirect access via the above methods
 
     setdefault = MutableMapping.setdefault
-    update = MutableMapping.update
     pop = MutableMapping.pop
     keys = MutableMapping.keys
     values = MutableMapping.values
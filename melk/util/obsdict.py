@@ -5,6 +5,11 @@ class obsdict(dict):
     Observers can implement the callbacks ``mapping_set`` and
     ``mapping_deleted`` to be notified of the corresponding events.
 
+    Bulk changes such as ``update`` are sent in one ``mapping_updated``
+    call with lists of the deleted and set ``(key, value)`` pairs to
+    observers that implement it; others get a ``mapping_deleted`` per
+    deleted pair followed by a ``mapping_set`` per set pair.
+
     Example::
 
         >>> class Logger(object):
@@ -39,6 +44,19 @@ class obsdict(dict):
         set 'foo' -> 'bar' on obsdict({...}) at 0x...
         >>> d.clear()
         deleted 'foo' -> 'bar' from obsdict({...}) at 0x...
+
+    An observer implementing ``mapping_updated`` sees an update at once::
+
+        >>> class BatchLogger(Logger):
+        ...     @staticmethod
+        ...     def mapping_updated(map, deleted, set):
+        ...         print 'deleted %r, set %r' % (deleted, sorted(set))
+        ...
+        >>> d.observers[:] = [BatchLogger()]
+        >>> d['foo'] = 'bar'
+        set 'foo' -> 'bar' on obsdict({...}) at 0x...
+        >>> d.update(foo='baz', one=1)
+        deleted [('foo', 'bar')], set [('foo', 'baz'), ('one', 1)]
     """
     def __init__(self, *args, **kw):
         dict.__init__(self, *args, **kw)
@@ -64,6 +82,26 @@ class obsdict(dict):
             else:
                 callback(self, *args, **kwds)
 
+    def _notify_updated(self, deleted, set):
+        """
+        deleted - list of the (key, value) pairs removed
+        set - list of the (key, value) pairs added
+        """
+        if not (deleted or set):
+            return
+        for o in self._observers:
+            try:
+                callback = o.mapping_updated
+            except AttributeError:
+                for callbackname, pairs in (('mapping_deleted', deleted),
+                                            ('mapping_set', set)):
+                    callback = getattr(o, callbackname, None)
+                    if callback is not None:
+                        for key, val in pairs:
+                            callback(self, key, val)
+            else:
+                callback(self, deleted, set)
+
     def __delitem__(self, key):
         val = self[key]
         dict.__delitem__(self, key)
@@ -95,15 +133,10 @@ class obsdict(dict):
         self._notify('mapping_set', key, val)
 
     def update(self, *args, **kwds):
-        for k, v in dict(*args, **kwds).iteritems():
-            try:
-                oldv = self[k]
-            except KeyError:
-                pass
-            else:
-                self._notify('mapping_deleted', k, oldv)
-            self._notify('mapping_set', k, v)
-        dict.update(self, *args, **kwds)
+        new = dict(*args, **kwds)
+        deleted = [(k, self[k]) for k in new if k in self]
+        dict.update(self, new)
+        self._notify_updated(deleted, new.items())
 
     def __str__(self):
         return '%s({%s})' % (self.__class__.__name__,
@@ -0,0 +1,309 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+a TaskQueue kept in a SQLite database, so that queued jobs survive
+the process and backlogs need not fit in memory.
+"""
+
+import cPickle as pickle
+from collections import deque
+import logging
+import threading
+from threading import Thread
+from time import time as _time
+from Queue import Empty, Full
+try:
+    import sqlite3 # python >= 2.5
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from melk.util.taskqueue import Sentinel
+
+log = logging.getLogger(__name__)
+
+
+class PersistentTaskQueue(object):
+    """
+    a queue with the same interface as TaskQueue (and its put_many, 
+    get_many and task_done_many) whose jobs are stored in a SQLite 
+    database at path, eg as the input_queue of a ThreadPool.  Jobs must
+    be picklable.
+
+    a job is only removed from the database when the thread that took it
+    calls task_done, so if the process dies any jobs that were queued or 
+    in progress are queued again when the database is next opened.  Jobs 
+    may therefore be processed more than once.
+
+    writes are committed every sync_every changes or sync_interval 
+    seconds, whichever comes first, rather than one at a time.  Changes 
+    not yet committed are lost in a crash: jobs put may vanish and jobs 
+    done may be done again.  Use sync to commit immediately.
+
+    only a window of prefetch jobs is read into memory at a time.  
+    Sentinels (eg ThreadPool's STOP) are kept in memory and handed out 
+    after every job.
+    """
+
+    def __init__(self, path, maxsize=0, sync_every=1000, sync_interval=0.5,
+                 prefetch=500):
+        self.path = path
+        self.maxsize = maxsize
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.prefetch = prefetch
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._local = threading.local()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # older sqlite, the default journal is fine
+            pass
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, job BLOB)')
+        self._db.commit()
+
+        # everything still in the table was never finished
+        count = self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        self.unfinished_tasks = count
+        # jobs in the table not yet handed out
+        self._queued = count
+        # the highest id read into the buffer so far
+        self._read_id = 0
+        self._buffer = deque()
+        self._sentinels = deque()
+        # ids done but not yet deleted
+        self._acks = []
+        self._dirty = 0
+
+        self._closed = threading.Event()
+        self._syncer = None
+        if sync_interval:
+            self._syncer = Thread(target=self._sync_periodically)
+            self._syncer.setDaemon(True)
+            self._syncer.start()
+
+    def _taken(self):
+        # ids of the jobs the calling thread took but has not marked done,
+        # None for sentinels
+        try:
+            return self._local.taken
+        except AttributeError:
+            taken = self._local.taken = deque()
+            return taken
+
+    def qsize(self):
+        return self._queued + len(self._sentinels)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self._queued
+
+    def put(self, item, block=True, timeout=None):
+        self._put_many([item], block, timeout)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def put_many(self, items):
+        self._put_many(list(items), True, None)
+
+    def _put_many(self, items, block, timeout):
+        if not items:
+            return
+        sentinels = [item for item in items if isinstance(item, Sentinel)]
+        rows = [(sqlite3.Binary(pickle.dumps(item, pickle.HIGHEST_PROTOCOL)),)
+                for item in items if not isinstance(item, Sentinel)]
+        self._lock.acquire()
+        try:
+            if self.maxsize > 0 and rows:
+                self._wait_for_room(len(rows), block, timeout)
+            if rows:
+                self._db.executemany('INSERT INTO jobs (job) VALUES (?)', rows)
+                self._queued += len(rows)
+                self._changed(len(rows))
+            self._sentinels.extend(sentinels)
+            self.unfinished_tasks += len(items)
+            self._not_empty.notify(len(items))
+        finally:
+            self._lock.release()
+
+    def _wait_for_room(self, n, block, timeout):
+        # called with the lock held.  A batch larger than maxsize 
+        # waits for an empty queue.
+        n = min(n, self.maxsize)
+        if timeout is not None:
+            endtime = _time() + timeout
+        while self._queued + n > self.maxsize:
+            if not block:
+                raise Full
+            if timeout is None:
+                self._not_full.wait()
+            else:
+                remaining = endtime - _time()
+                if remaining <= 0.0:
+                    raise Full
+                self._not_full.wait(remaining)
+
+    def _fill_buffer(self):
+        # called with the lock held
+        rows = self._db.execute('SELECT id, job FROM jobs WHERE id > ? '
+                                'ORDER BY id LIMIT ?',
+                                (self._read_id, self.prefetch)).fetchall()
+        if rows:
+            self._read_id = rows[-1][0]
+            self._buffer.extend(rows)
+
+    def _take(self):
+        # called with the lock held, returns (id or None, item)
+        if self._queued:
+            if not self._buffer:
+                self._fill_buffer()
+            if self._buffer:
+                jid, data = self._buffer.popleft()
+                self._queued -= 1
+                if self.maxsize > 0:
+                    self._not_full.notify()
+                return jid, pickle.loads(str(data))
+        if self._sentinels:
+            return None, self._sentinels.popleft()
+        raise Empty
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block, timeout)[0]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, n, block=True, timeout=None):
+        taken = self._taken()
+        self._lock.acquire()
+        try:
+            if timeout is not None:
+                endtime = _time() + timeout
+            while not self.qsize():
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            items = []
+            while len(items) < n:
+                try:
+                    jid, item = self._take()
+                except Empty:
+                    break
+                taken.append(jid)
+                items.append(item)
+            return items
+        finally:
+            self._lock.release()
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_done_many(self, n):
+        """
+        marks the n jobs the calling thread took longest ago done.
+        """
+        taken = self._taken()
+        if n > len(taken):
+            raise ValueError('task_done() called too many times')
+        ids = [taken.popleft() for i in range(n)]
+        self._lock.acquire()
+        try:
+            for jid in ids:
+                if jid is not None:
+                    self._acks.append((jid,))
+            self._changed(n)
+            self.unfinished_tasks -= n
+            if self.unfinished_tasks == 0:
+                self._all_done.notifyAll()
+        finally:
+            self._lock.release()
+
+    def join(self):
+        self._lock.acquire()
+        try:
+            while self.unfinished_tasks:
+                self._all_done.wait()
+        finally:
+            self._lock.release()
+
+    def _changed(self, n):
+        # called with the lock held
+        self._dirty += n
+        if self._dirty >= self.sync_every:
+            self._commit()
+
+    def _commit(self):
+        # called with the lock held
+        if self._acks:
+            self._db.executemany('DELETE FROM jobs WHERE id = ?', self._acks)
+            self._acks = []
+        self._db.commit()
+        self._dirty = 0
+
+    def sync(self):
+        """
+        commits all changes so far to disk
+        """
+        self._lock.acquire()
+        try:
+            self._commit()
+        finally:
+            self._lock.release()
+
+    def _sync_periodically(self):
+        while not self._closed.isSet():
+            self._closed.wait(self.sync_interval)
+            if self._dirty:
+                try:
+                    self.sync()
+                except:
+                    log.exception("syncing %s" % self.path)
+
+    def close(self):
+        """
+        commits any changes and closes the database.  Jobs taken but not
+        done are queued again when it is next opened.
+        """
+        self._closed.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        self._lock.acquire()
+        try:
+            self._commit()
+            self._db.close()
+        finally:
+            self._lock.release()
@@ -0,0 +1,310 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+pipelines of ThreadPools connected in any directed acyclic graph,
+eg one fetching stage feeding separate parsing stages by content
+type which all feed one storing stage.
+"""
+
+import logging
+import threading
+
+from melk.util.taskqueue import put_many, BatchingQueueInputAdapter
+from melk.util.threadpool import bottleneck
+
+log = logging.getLogger(__name__)
+
+
+class Router(object):
+    """
+    the output queue of a pipeline stage with downstream stages.  
+    Each item put on it goes to:
+
+    - every broadcast edge whose predicate accepts it (or that has none)
+    - the first other edge, in the order they were connected, whose 
+      predicate accepts it (or that has none)
+
+    items no edge takes are counted in unrouted and dropped.
+    """
+
+    def __init__(self):
+        # (predicate, queue)
+        self.routes = []
+        self.broadcasts = []
+        self.unrouted = 0
+        # guards unrouted, items are routed by many upstream workers
+        self._lock = threading.Lock()
+
+    def add(self, queue, predicate=None, broadcast=False):
+        if broadcast:
+            self.broadcasts.append((predicate, queue))
+        else:
+            self.routes.append((predicate, queue))
+
+    def _destinations(self, item):
+        dests = [q for pred, q in self.broadcasts if pred is None or pred(item)]
+        for pred, q in self.routes:
+            if pred is None or pred(item):
+                dests.append(q)
+                break
+        if not dests:
+            self._lock.acquire()
+            try:
+                self.unrouted += 1
+            finally:
+                self._lock.release()
+            log.debug("no route for %r" % (item,))
+        return dests
+
+    def put(self, item, block=True, timeout=None):
+        """
+        puts item on each of its destinations in turn, block and 
+        timeout apply to each of them.
+        """
+        for q in self._destinations(item):
+            q.put(item, block, timeout)
+
+    def put_many(self, items):
+        # queue -> items, keeping the order of items for each queue
+        byqueue = []
+        for item in items:
+            for q in self._destinations(item):
+                for dq, qitems in byqueue:
+                    if dq is q:
+                        qitems.append(item)
+                        break
+                else:
+                    byqueue.append((q, [item]))
+        for q, qitems in byqueue:
+            put_many(q, qitems)
+
+
+class _Stage(object):
+    def __init__(self, name, pool, in_queue):
+        self.name = name
+        self.pool = pool
+        self.in_queue = in_queue
+        self.downstream = []
+        self.upstream = []
+        self.router = None
+
+
+class Pipeline(object):
+    """
+    a set of named ThreadPools connected into a directed acyclic graph.
+
+    add each stage, then connect them, eg:
+
+    >>> from melk.util.threadpool import ThreadPool
+    >>> from melk.util.taskqueue import TaskQueue
+    >>> p = Pipeline()
+    >>> fetch = p.add('fetch', ThreadPool(2, lambda x: x))
+    >>> odd = p.add('odd', ThreadPool(2, lambda x: 'odd %d' % x))
+    >>> even = p.add('even', ThreadPool(2, lambda x: 'even %d' % x))
+    >>> store = p.add('store', ThreadPool(2, lambda x: x.upper()))
+    >>> p.connect('fetch', 'odd', lambda x: x % 2)
+    >>> p.connect('fetch', 'even')
+    >>> p.connect('odd', 'store')
+    >>> p.connect('even', 'store')
+    >>> p.output_queue = TaskQueue()
+    >>> for i in range(4):
+    ...     p.put(i)
+    >>> p.start()
+    >>> p.join()
+    >>> sorted(p.output_queue.get() for i in range(4))
+    ['EVEN 0', 'EVEN 2', 'ODD 1', 'ODD 3']
+    >>> p.shutdown()
+
+    like a ThreadPoolChain, it should not be changed once started.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        # names in the order added
+        self._names = []
+
+    def add(self, name, threadpool, in_queue=None):
+        """
+        adds threadpool as the stage called name, returns threadpool.
+
+        in_queue - optional adapted version of the input queue of the 
+                   threadpool that upstream stages put on, if not specified
+                   threadpool.input_queue is used.
+        """
+        if name in self._stages:
+            raise ValueError('there is already a stage named %r' % name)
+        if in_queue is None:
+            in_queue = threadpool.input_queue
+        self._stages[name] = _Stage(name, threadpool, in_queue)
+        self._names.append(name)
+        return threadpool
+
+    def connect(self, upstream, downstream, when=None, broadcast=False):
+        """
+        sends the output of the stage named upstream to the stage named
+        downstream.  
+
+        when - an optional 1 argument function, only outputs for which it
+               returns true are sent along this edge.
+        broadcast - if False, each output goes along only the first matching
+                    non-broadcast edge of upstream.  If True, every matching 
+                    output goes along this edge as well.
+        """
+        up = self._stages[upstream]
+        down = self._stages[downstream]
+        if upstream == downstream or upstream in self._reachable(downstream):
+            raise ValueError('connecting %r to %r would make a cycle' %
+                             (upstream, downstream))
+        if up.router is None:
+            up.router = Router()
+            up.pool.output_queue = up.router
+        up.router.add(down.in_queue, when, broadcast)
+        up.downstream.append(down)
+        down.upstream.append(up)
+
+    def _reachable(self, name):
+        seen = set()
+        todo = [self._stages[name]]
+        while todo:
+            for s in todo.pop().downstream:
+                if s.name not in seen:
+                    seen.add(s.name)
+                    todo.append(s)
+        return seen
+
+    def _ordered(self):
+        """
+        the stages, each after all of its upstream stages
+        """
+        order = []
+        indegree = dict((name, len(self._stages[name].upstream)) for name in self._names)
+        ready = [name for name in self._names if indegree[name] == 0]
+        while ready:
+            stage = self._stages[ready.pop(0)]
+            order.append(stage)
+            for down in stage.downstream:
+                indegree[down.name] -= 1
+                if indegree[down.name] == 0:
+                    ready.append(down.name)
+        return order
+
+    def stage(self, name):
+        return self._stages[name].pool
+
+    @property
+    def stages(self):
+        """
+        the threadpools in the pipeline, each after all of its upstream pools
+        """
+        return [s.pool for s in self._ordered()]
+
+    @property
+    def sources(self):
+        """
+        the names of the stages with no upstream stages
+        """
+        return [name for name in self._names if not self._stages[name].upstream]
+
+    @property
+    def sinks(self):
+        """
+        the names of the stages with no downstream stages
+        """
+        return [name for name in self._names if not self._stages[name].downstream]
+
+    def _get_input_queue(self):
+        sources = self.sources
+        if len(sources) != 1:
+            raise ValueError('pipeline has %d source stages, use put(item, stage)' %
+                             len(sources))
+        return self._stages[sources[0]].in_queue
+
+    input_queue = property(_get_input_queue)
+
+    def put(self, item, stage=None):
+        """
+        places item on the input queue of stage, by default the only
+        source stage.
+        """
+        if stage is None:
+            q = self.input_queue
+        else:
+            q = self._stages[stage].in_queue
+        q.put(item)
+
+    def _get_output_queue(self):
+        queues = []
+        for name in self.sinks:
+            q = self._stages[name].pool.output_queue
+            if q not in queues:
+                queues.append(q)
+        if len(queues) != 1:
+            raise ValueError('pipeline sinks have %d output queues' % len(queues))
+        return queues[0]
+
+    def _set_output_queue(self, val):
+        """
+        sets the output queue of every sink stage
+        """
+        for name in self.sinks:
+            self._stages[name].pool.output_queue = val
+
+    output_queue = property(_get_output_queue, _set_output_queue)
+
+    def start(self):
+        # downstream first, so there is somewhere for output to go
+        for tp in reversed(self.stages):
+            tp.start()
+
+    def join(self):
+        """
+        blocks until every job queued has passed all the way through.
+        Each stage is joined only after all of its upstream stages, so 
+        nothing more can arrive at it.
+        """
+        for stage in self._ordered():
+            # push anything held by a batching adapter first
+            flush = getattr(stage.in_queue, 'flush', None)
+            if flush is not None:
+                flush()
+            stage.pool.join()
+
+    def stats(self):
+        """
+        returns {'stages': [stats of each pool], 'bottleneck': name of 
+        the busiest stage} as ThreadPoolChain.stats does, naming the 
+        stages as they were added.
+        """
+        stages = []
+        for stage in self._ordered():
+            stats = stage.pool.stats()
+            stats['name'] = stage.name
+            stages.append(stats)
+        return {'stages': stages, 'bottleneck': bottleneck(stages)}
+
+    def shutdown(self, wait=True, drain=True):
+        """
+        shuts down each stage after all of its upstream stages, see 
+        ThreadPoolChain.shutdown.
+        """
+        for stage in self._ordered():
+            if isinstance(stage.in_queue, BatchingQueueInputAdapter):
+                stage.in_queue.close()
+            stage.pool.shutdown(wait=wait or drain, drain=drain)
@@ -0,0 +1,405 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+import cPickle as pickle
+import logging
+import multiprocessing
+import multiprocessing.pool
+import threading
+from threading import Thread
+import time
+import traceback
+
+from melk.util.taskqueue import TaskQueue as Queue
+from melk.util.taskqueue import get_many, put_many, task_done_many
+from melk.util.threadpool import STOP, JobDropped, DEFAULT_POOLSIZE, PoolStats
+from melk.util.trace import Traced
+from Queue import Empty
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNKSIZE = 16
+
+def _call(job):
+    return job()
+
+def _run_chunk(payload):
+    """
+    runs in a child process.  payload is a pickled (processor, jobs), 
+    returns a pickled (results, errors) where results are (index of 
+    job, result) and errors are formatted tracebacks.  The pickling is 
+    done here rather than by multiprocessing so that an unpicklable job
+    or result is reported rather than wedging the pool.
+    """
+    errors = []
+    results = []
+    try:
+        processor, jobs = pickle.loads(payload)
+        for i, job in enumerate(jobs):
+            try:
+                results.append((i, processor(job)))
+            except JobDropped:
+                pass
+            except:
+                errors.append(traceback.format_exc())
+        return pickle.dumps((results, errors), pickle.HIGHEST_PROTOCOL)
+    except:
+        errors.append(traceback.format_exc())
+        return pickle.dumps(([], errors), pickle.HIGHEST_PROTOCOL)
+
+
+class _WatchedPool(multiprocessing.pool.Pool):
+    """
+    counts the children that died abnormally, multiprocessing replaces
+    them without a word.
+    """
+    crashes = 0
+
+    def _join_exited_workers(self):
+        # called on the worker handling thread, before it forgets them
+        for child in self._pool:
+            if child.exitcode not in (None, 0):
+                log.error("child %d died with exit code %s" %
+                          (child.pid, child.exitcode))
+                self.crashes += 1
+        return multiprocessing.pool.Pool._join_exited_workers(self)
+
+
+class ProcessPool(object):
+    """
+    processes items placed in its input queue in a pool of child 
+    processes, for cpu bound work that threads cannot speed up.
+
+    It has the same input_queue / output_queue / start / join / shutdown
+    contract as ThreadPool, so it can take the place of one in a 
+    ThreadPoolChain.  Jobs are taken off the input queue in chunks by
+    a dispatching thread and sent to the children, results are placed 
+    on the output queue as each chunk comes back.
+
+    processor, jobs and results must all be picklable; processor should
+    be a module level function.  Errors are logged.
+
+    multiprocessing never reports a chunk whose child process died, so
+    the pool watches its children.  Once one dies abnormally, chunks
+    that were outstanding then and have still not come back after
+    crash_grace seconds are counted as errors, so that join returns.
+    """
+
+    def __init__(self, poolsize=None,
+                 processor=None,
+                 output_queue=None,
+                 maxsize=0,
+                 chunksize=DEFAULT_CHUNKSIZE,
+                 jobs_per_child=None,
+                 name=None,
+                 crash_grace=5.0,
+                 chunk_timeout=None):
+        """
+        poolsize - the number of processes, defaults to the number of cpus
+        processor - a picklable 1 argument function used to process jobs, 
+                    by default jobs are assumed to be 0 argument callables.
+        output_queue - if specified, results are placed on this queue
+        maxsize - if greater than 0, the most jobs the input queue holds
+        chunksize - the most jobs sent to a child at once
+        jobs_per_child - if specified, child processes are replaced after
+                         processing about this many jobs
+        name - a name for the pool in its stats, defaults to the class name
+        crash_grace - seconds to wait for chunks outstanding when a child 
+                      dies before giving them up
+        chunk_timeout - if specified, chunks that take longer than this 
+                        many seconds are given up
+        """
+        self.input_queue = Queue(maxsize)
+        self.output_queue = output_queue
+
+        if poolsize is None:
+            try:
+                poolsize = multiprocessing.cpu_count()
+            except NotImplementedError:
+                poolsize = DEFAULT_POOLSIZE
+        self.poolsize = poolsize
+
+        if processor is None:
+            processor = _call
+        self.processor = processor
+        self.chunksize = chunksize
+        self.jobs_per_child = jobs_per_child
+        self.crash_grace = crash_grace
+        self.chunk_timeout = chunk_timeout
+
+        self._pool = None
+        self._dispatcher = None
+        self._watcher = None
+        # _ChunkDone -> the time to give it up, or None
+        self._outstanding = {}
+        self._outstanding_cond = threading.Condition(threading.Lock())
+        # True once a chunk has been given up, the multiprocessing 
+        # pool then can't be closed cleanly
+        self._lost = False
+
+        if name is None:
+            name = self.__class__.__name__
+        self.name = name
+        self.pool_stats = PoolStats(name, self.input_queue)
+
+    @property
+    def workers(self):
+        if self._pool is None:
+            return 0
+        return self.poolsize
+
+    def stats(self):
+        """
+        see ThreadPool.stats.  Time spent processing a chunk is counted
+        from when it is sent to the children, so includes a little 
+        time waiting for a free child.
+        """
+        return self.pool_stats.snapshot(self.workers)
+
+    def start(self):
+        maxtasks = None
+        if self.jobs_per_child is not None:
+            maxtasks = max(1, self.jobs_per_child // self.chunksize)
+        self._pool = _WatchedPool(self.poolsize, maxtasksperchild=maxtasks)
+        # keep the children busy without pulling everything off the input queue
+        self._inflight = threading.Semaphore(self.poolsize * 2)
+        self._lost = False
+        self._dispatcher = Thread(target=self._dispatch, args=(self._pool,))
+        self._dispatcher.setDaemon(True)
+        self._dispatcher.start()
+        self._watcher = Thread(target=self._watch, args=(self._pool,))
+        self._watcher.setDaemon(True)
+        self._watcher.start()
+
+    def join(self):
+        self.input_queue.join()
+
+    def shutdown(self, wait=True, drain=True):
+        """
+        stops the pool, see ThreadPool.shutdown.  The pool may be 
+        started again afterwards.
+        """
+        if self._pool is None:
+            return
+        if not drain:
+            self._discard_queued()
+        self.input_queue.put(STOP)
+        pool = self._pool
+        if wait:
+            self._dispatcher.join()
+            self._wait_outstanding()
+            if self._lost:
+                # the lost chunks are still in multiprocessing's books
+                pool.terminate()
+            pool.join()
+        self._pool = None
+        self._dispatcher = None
+        self._watcher = None
+
+    def _wait_outstanding(self):
+        self._outstanding_cond.acquire()
+        try:
+            while self._outstanding:
+                self._outstanding_cond.wait()
+        finally:
+            self._outstanding_cond.release()
+
+    def _watch(self, pool, interval=0.25):
+        """
+        gives up chunks lost with a child process or past chunk_timeout
+        """
+        crashes = 0
+        while self._pool is pool or self._outstanding:
+            time.sleep(interval)
+            crashed = pool.crashes != crashes
+            crashes = pool.crashes
+            self._expire_chunks(crashed)
+
+    def _expire_chunks(self, crashed):
+        now = time.time()
+        expired = []
+        self._outstanding_cond.acquire()
+        try:
+            for chunk, deadline in self._outstanding.items():
+                if self.chunk_timeout is not None:
+                    timeout = chunk.sent + self.chunk_timeout
+                    if deadline is None or timeout < deadline:
+                        deadline = timeout
+                if crashed:
+                    grace = now + self.crash_grace
+                    if deadline is None or grace < deadline:
+                        deadline = grace
+                self._outstanding[chunk] = deadline
+                if deadline is not None and deadline <= now:
+                    expired.append(chunk)
+        finally:
+            self._outstanding_cond.release()
+        for chunk in expired:
+            if self._take_chunk(chunk):
+                log.error("%s: giving up a chunk of %d jobs sent %0.1fs ago" %
+                          (self.name, chunk.njobs, now - chunk.sent))
+                self._lost = True
+                self._chunk_done(chunk.njobs, chunk.sent, None, chunk.traces)
+
+    def _take_chunk(self, chunk):
+        """
+        True for the first caller only, who then finishes the chunk
+        """
+        self._outstanding_cond.acquire()
+        try:
+            if chunk not in self._outstanding:
+                return False
+            del self._outstanding[chunk]
+            self._outstanding_cond.notifyAll()
+            return True
+        finally:
+            self._outstanding_cond.release()
+
+    def _discard_queued(self):
+        while True:
+            try:
+                jobs = get_many(self.input_queue, 1000, False)
+            except Empty:
+                return
+            for job in jobs:
+                if job.__class__ is Traced:
+                    job.trace.end('dropped')
+            task_done_many(self.input_queue, len(jobs))
+
+    def _dispatch(self, pool):
+        q = self.input_queue
+        while True:
+            try:
+                jobs = get_many(q, self.chunksize)
+                work = [job for job in jobs if job is not STOP]
+                if len(work) < len(jobs):
+                    if work:
+                        self._send(pool, work)
+                    task_done_many(q, len(jobs) - len(work))
+                    pool.close()
+                    return
+                self._send(pool, work)
+            except:
+                log.error(traceback.format_exc())
+
+    def _send(self, pool, jobs):
+        # traces stay in this process, see _chunk_done
+        traces = None
+        if [job for job in jobs if job.__class__ is Traced]:
+            traces = []
+            jobs = list(jobs)
+            for i, job in enumerate(jobs):
+                if job.__class__ is Traced:
+                    traces.append(job.trace)
+                    jobs[i] = job.job
+                else:
+                    traces.append(None)
+        try:
+            payload = pickle.dumps((self.processor, jobs), pickle.HIGHEST_PROTOCOL)
+        except:
+            log.error("could not pickle jobs: %s" % traceback.format_exc())
+            self._end_traces(traces, time.time(), ())
+            task_done_many(self.input_queue, len(jobs))
+            return
+        self._inflight.acquire()
+        chunk = _ChunkDone(self, len(jobs), time.time(), traces)
+        self._outstanding_cond.acquire()
+        try:
+            self._outstanding[chunk] = None
+        finally:
+            self._outstanding_cond.release()
+        try:
+            pool.apply_async(_run_chunk, (payload,), callback=chunk)
+        except:
+            # the chunk was never sent, don't leave its jobs unfinished
+            if self._take_chunk(chunk):
+                self._chunk_done(chunk.njobs, chunk.sent, None, traces)
+            raise
+
+    def _chunk_done(self, njobs, sent, payload, traces=None):
+        """
+        called on the multiprocessing result handling thread, with
+        a payload of None for a chunk that was lost.
+        """
+        nerrors = njobs
+        dropped = 0
+        results = ()
+        try:
+            try:
+                if payload is not None:
+                    results, errors = pickle.loads(payload)
+                    nerrors = len(errors)
+                    dropped = njobs - len(results) - nerrors
+                    for error in errors:
+                        log.error(error)
+            except:
+                log.error(traceback.format_exc())
+            if traces is not None:
+                results = self._end_traces(traces, sent, results)
+            if self.output_queue is not None and results:
+                put_many(self.output_queue, [rc for i, rc in results])
+        finally:
+            self._inflight.release()
+            self.pool_stats.record(sent, time.time(), njobs, nerrors, dropped)
+            task_done_many(self.input_queue, njobs)
+
+    def _end_traces(self, traces, sent, results):
+        """
+        records this stage in the traces of a chunk of jobs sent at sent, 
+        returns results with those of traced jobs in Traced envelopes.
+        """
+        if traces is None:
+            return results
+        now = time.time()
+        for trace in traces:
+            if trace is not None:
+                trace.record(self.name, sent, now)
+        wrapped = []
+        finished = set()
+        for i, rc in results:
+            trace = traces[i]
+            if trace is not None:
+                finished.add(i)
+                if self.end_traces:
+                    trace.end()
+                else:
+                    rc = Traced(trace, rc)
+            wrapped.append((i, rc))
+        for i, trace in enumerate(traces):
+            if trace is not None and i not in finished:
+                trace.end('failed')
+        return wrapped
+
+    # if True, traced jobs leave this pool bare and their traces end 
+    # here, see melk.util.trace
+    end_traces = False
+
+class _ChunkDone(object):
+    def __init__(self, pool, njobs, sent, traces=None):
+        self.pool = pool
+        self.njobs = njobs
+        self.sent = sent
+        self.traces = traces
+
+    def __call__(self, payload):
+        if self.pool._take_chunk(self):
+            self.pool._chunk_done(self.njobs, self.sent, payload, self.traces)
+        else:
+            log.error("%s: dropping a chunk of %d jobs that came back after "
+                      "it was given up" % (self.pool.name, self.njobs))
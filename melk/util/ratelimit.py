@@ -0,0 +1,247 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    thread safe token bucket.  Tokens accrue at rate per second up
+    to capacity.
+
+    Takers reserve tokens rather than waiting for them to be present:
+    the level may go negative and each taker sleeps off its own share
+    of the debt outside of the lock.  The lock is only held for a
+    little arithmetic, so many threads can share a bucket cheaply,
+    and the rate can be changed at any time.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        rate - tokens per second, None for unlimited
+        capacity - the most tokens that can accrue, ie the largest
+                   burst allowed. defaults to one second's worth.
+        """
+        self._lock = threading.Lock()
+        self._rate = None
+        self._capacity = None
+        # True if capacity was given rather than following the rate
+        self._fixed_capacity = False
+        self._level = 0.0
+        self._last = time.time()
+        self.set_rate(rate, capacity)
+        # start out with a full bucket
+        if self._capacity is not None:
+            self._level = self._capacity
+
+    def set_rate(self, rate, capacity=None):
+        """
+        changes the rate, and the capacity if given.  A capacity given
+        before is kept, otherwise it is one second's worth of the new
+        rate.
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be either None or positive, got %r' % rate)
+        self._lock.acquire()
+        try:
+            self._refill(time.time())
+            if capacity is not None:
+                self._fixed_capacity = True
+            elif self._fixed_capacity:
+                capacity = self._capacity
+            if rate is not None and capacity is None:
+                capacity = max(rate, 1.0)
+            self._rate = rate
+            self._capacity = capacity
+            if rate is not None:
+                self._level = min(self._level, capacity)
+            else:
+                self._level = 0.0
+        finally:
+            self._lock.release()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def idle(self):
+        """
+        True if the bucket is full, ie no different from a new one
+        """
+        self._lock.acquire()
+        try:
+            if self._rate is None:
+                return True
+            self._refill(time.time())
+            return self._level >= self._capacity
+        finally:
+            self._lock.release()
+
+    def _refill(self, now):
+        if self._rate is not None:
+            self._level = min(self._capacity,
+                              self._level + (now - self._last) * self._rate)
+        self._last = now
+
+    def reserve(self, n=1):
+        """
+        takes n tokens, returns the number of seconds the caller should
+        wait before going ahead.  Pass 0 to find out how long until the
+        bucket is out of debt.
+        """
+        self._lock.acquire()
+        try:
+            if self._rate is None:
+                return 0.0
+            now = time.time()
+            self._refill(now)
+            self._level -= n
+            if self._level >= 0:
+                return 0.0
+            return -self._level / self._rate
+        finally:
+            self._lock.release()
+
+    def consume(self, n=1):
+        """
+        takes n tokens, blocking until they are paid for.  returns the
+        time spent waiting.
+        """
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def charge(self, n):
+        """
+        takes n tokens without waiting, eg for bytes already received.
+        Later takers wait until the debt is paid off.
+        """
+        self.reserve(n)
+
+
+class RateLimiter(object):
+    """
+    limits requests per second and bytes per second, overall and
+    optionally per host.  Any of the limits may be None for unlimited
+    and all of them can be changed while in use with set_limits.
+
+    call acquire(host) before making a request and charge(host, nbytes)
+    once the size of the response is known.  Since response sizes are
+    only known after the fact, bytes are paid for by the requests that
+    follow them.
+    """
+
+    LIMITS = ('requests_per_second', 'bytes_per_second',
+              'host_requests_per_second', 'host_bytes_per_second')
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None,
+                 host_requests_per_second=None, host_bytes_per_second=None,
+                 max_hosts=10000):
+        """
+        max_hosts - about the most hosts buckets are kept for, those
+                    of idle hosts are dropped beyond it.
+        """
+        self._lock = threading.Lock()
+        self.max_hosts = max_hosts
+        # prune when there are more hosts than this
+        self._prune_at = max_hosts
+        self.requests = TokenBucket(requests_per_second)
+        self.bytes = TokenBucket(bytes_per_second)
+        self.host_requests_per_second = host_requests_per_second
+        self.host_bytes_per_second = host_bytes_per_second
+        # host -> (request bucket, byte bucket)
+        self._hosts = {}
+
+    def set_limits(self, **kw):
+        """
+        changes any of the limits named in RateLimiter.LIMITS, eg
+        limiter.set_limits(bytes_per_second=1e6)
+        """
+        for name in kw:
+            if name not in self.LIMITS:
+                raise TypeError('unknown limit %r' % name)
+        if 'requests_per_second' in kw:
+            self.requests.set_rate(kw['requests_per_second'])
+        if 'bytes_per_second' in kw:
+            self.bytes.set_rate(kw['bytes_per_second'])
+
+        if 'host_requests_per_second' in kw or 'host_bytes_per_second' in kw:
+            self._lock.acquire()
+            try:
+                self.host_requests_per_second = kw.get('host_requests_per_second',
+                                                       self.host_requests_per_second)
+                self.host_bytes_per_second = kw.get('host_bytes_per_second',
+                                                    self.host_bytes_per_second)
+                buckets = self._hosts.values()
+            finally:
+                self._lock.release()
+            for reqs, nbytes in buckets:
+                reqs.set_rate(self.host_requests_per_second)
+                nbytes.set_rate(self.host_bytes_per_second)
+
+    def _host_buckets(self, host):
+        try:
+            return self._hosts[host]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                buckets = self._hosts.get(host)
+                if buckets is None:
+                    buckets = (TokenBucket(self.host_requests_per_second),
+                               TokenBucket(self.host_bytes_per_second))
+                    self._hosts[host] = buckets
+                    if len(self._hosts) > self._prune_at:
+                        self._prune()
+                return buckets
+            finally:
+                self._lock.release()
+
+    def _prune(self):
+        # called with the lock held.  A full bucket is the same as a
+        # new one, so dropping it loses nothing.
+        for host, (reqs, nbytes) in self._hosts.items():
+            if reqs.idle() and nbytes.idle():
+                del self._hosts[host]
+        # if most hosts are busy, don't go through them all again soon
+        self._prune_at = max(self.max_hosts, 2 * len(self._hosts))
+
+    def acquire(self, host=None):
+        """
+        blocks until a request to host may be made. returns the
+        time spent waiting.
+        """
+        wait = max(self.requests.reserve(1), self.bytes.reserve(0))
+        if host is not None and (self.host_requests_per_second is not None or
+                                 self.host_bytes_per_second is not None):
+            reqs, nbytes = self._host_buckets(host)
+            wait = max(wait, reqs.reserve(1), nbytes.reserve(0))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def charge(self, host, nbytes):
+        self.bytes.charge(nbytes)
+        if host is not None and self.host_bytes_per_second is not None:
+            self._host_buckets(host)[1].charge(nbytes)
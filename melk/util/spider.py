@@ -17,28 +17,66 @@
 # Boston, MA  02110-1301
 # USA
 
+import itertools
 import logging 
+import mmap
+import random
+from StringIO import StringIO
+import tempfile
 import threading
 from threading import Thread 
+import time
+from urlparse import urlparse
+from httplib2 import Response
 from melk.util.http import NoKeepaliveHttp as Http
-from melk.util.threadpool import ThreadPool
+from melk.util.metrics import Metrics, summarize
+from melk.util.threadpool import ThreadPool, JobDropped, Requeue
 import traceback 
+import zlib
 
 log = logging.getLogger(__name__)
 
+# numbers jobs in the order they are made, see Spider.cancel
+_job_seq = itertools.count(1)
+
 
 class SpiderJob:
-    def __init__(self, url, **kw):
+    def __init__(self, url, deadline=None, cancel_token=None, tags=(), **kw):
         """
         construct a job that fetches a specific url. 
         url - the url to fetch. 
+        deadline - optional time (as in time.time()) after which the 
+                   job is no longer worth doing.
+        cancel_token - optional melk.util.threadpool.CancelToken, the 
+                       job is not done if the token is cancelled.
+        tags - labels that can be used to cancel a group of jobs, see
+               Spider.cancel
 
         All additional keyword arguments may be used to customize 
         the Http constructor if necessary.  These will only be used
         if no http_client is specified to __call__.
         """
         self.url = url
+        self.deadline = deadline
+        self.cancel_token = cancel_token
+        self.tags = tuple(tags)
+        self.created = time.time()
+        self.seq = _job_seq.next()
         self.http_args = dict(kw)
+        # retries made so far, and when the next may be made
+        self.attempt = 0
+        self.not_before = None
+
+    @property
+    def host(self):
+        return url_host(self.url)
+
+    def expired(self, now=None):
+        if self.deadline is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now >= self.deadline
 
     def __call__(self, http_client=None):
         log.debug("fetching %s..." % self.url)
@@ -49,11 +87,477 @@ class SpiderJob:
         log.debug("%s -> %s fromcache=%s" % (self.url, response.status, response.fromcache))
         return SpiderResult(self.url, response, content)
 
-class SpiderResult: 
-    def __init__(self, url, response=None, content=None):
+class SpiderResult(object):
+    def __init__(self, url, response=None, content=None, error=None):
+        """
+        error - if the fetch was not attempted or was abandoned by the 
+                spider itself (eg CircuitOpen), the reason for it.  
+                response then holds a synthesized error response in the 
+                style of httplib2's force_exception_to_status_code.
+        """
         self.url = url
         self.response = response
+        self._charge = None
         self.content = content
+        self.error = error
+
+    def _get_content(self):
+        if self._body is None:
+            return self._content
+        return self._body.read()
+
+    def _set_content(self, content):
+        self.release()
+        self._content = content
+        self._body = None
+
+    content = property(_get_content, _set_content, doc="""\
+        the body of the response.  If the spider compressed or spooled 
+        the body, it is decompressed or read back on each access.
+        """)
+
+    def open_content(self):
+        """
+        returns a file-like object reading the body, for parsers that 
+        accept one.  This avoids a copy of spooled bodies, which are 
+        memory mapped.
+        """
+        if self._body is None:
+            return StringIO(self._content or '')
+        return self._body.open()
+
+    def _store(self, body, charge):
+        """
+        body - a CompressedBody or SpooledBody replacing the content, 
+               or None to keep the content as it is.
+        charge - the memory budget charged for holding the content
+        """
+        self.release()
+        if body is not None:
+            self._content = None
+            self._body = body
+        self._charge = charge
+
+    def release(self):
+        """
+        gives back the memory budget held by this result to the spider 
+        that fetched it.  This happens when the result is garbage 
+        collected, call this to do it sooner.
+        """
+        charge, self._charge = self._charge, None
+        if charge is not None:
+            charge.release()
+
+class CompressedBody(object):
+    """
+    a response body held zlib compressed in memory
+    """
+    def __init__(self, data, level=6):
+        self._data = zlib.compress(data, level)
+        # bytes held in memory
+        self.size = len(self._data)
+
+    def read(self):
+        return zlib.decompress(self._data)
+
+    def open(self):
+        return StringIO(self.read())
+
+class SpooledBody(object):
+    """
+    a response body written out to an anonymous temporary file 
+    and read back through mmap.
+    """
+    def __init__(self, data, dir=None):
+        self._file = tempfile.TemporaryFile(dir=dir)
+        self._file.write(data)
+        self._file.flush()
+        # bytes held on disk (and mapped when read), also counted so
+        # that a budget bounds the number of open temporary files
+        self.size = len(data)
+
+    def open(self):
+        return _MappedFile(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self):
+        m = self.open()
+        try:
+            return m[:]
+        finally:
+            m.close()
+
+class _MappedFile(mmap.mmap):
+    # mmap.read insists on a size
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size() - self.tell()
+        return mmap.mmap.read(self, size)
+
+class ByteBudget(object):
+    """
+    caps the number of bytes held by results that have been fetched
+    but not yet released.  Workers reserve() room for a body before
+    fetching it, as much as the average body so far, and settle the
+    reservation once the size is known, so the total only goes over
+    max_bytes by however much bodies being fetched exceed the average.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition(threading.Lock())
+        # for the average size of a body
+        self._settled_bytes = 0
+        self._settled = 0
+
+    def wait(self):
+        """
+        blocks until the budget is not exhausted. returns True if 
+        it had to wait.
+        """
+        self._cond.acquire()
+        try:
+            waited = False
+            while self.used >= self.max_bytes:
+                waited = True
+                self._cond.wait()
+            return waited
+        finally:
+            self._cond.release()
+
+    def charge(self, nbytes):
+        self._cond.acquire()
+        try:
+            self.used += nbytes
+        finally:
+            self._cond.release()
+        return _Charge(self, nbytes)
+
+    def reserve(self):
+        """
+        blocks until there is room for a body of the average size
+        so far, then charges for it.  returns the charge, whose
+        waited attribute is True if it had to wait.  Once the size
+        of the body is known, settle the charge with it.
+        """
+        self._cond.acquire()
+        try:
+            if self._settled:
+                nbytes = self._settled_bytes // self._settled
+            else:
+                nbytes = 0
+            waited = False
+            # something must be fetched even if it won't fit
+            while self.used > 0 and (self.used >= self.max_bytes or
+                                     self.used + nbytes > self.max_bytes):
+                waited = True
+                self._cond.wait()
+            self.used += nbytes
+        finally:
+            self._cond.release()
+        charge = _Charge(self, nbytes)
+        charge.waited = waited
+        return charge
+
+    def _settle(self, reserved, nbytes):
+        self._cond.acquire()
+        try:
+            self.used += nbytes - reserved
+            self._settled_bytes += nbytes
+            self._settled += 1
+            if nbytes < reserved:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _release(self, nbytes):
+        self._cond.acquire()
+        try:
+            self.used -= nbytes
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+class _Charge(object):
+    waited = False
+
+    def __init__(self, budget, nbytes):
+        self._budget = budget
+        self._nbytes = nbytes
+
+    def settle(self, nbytes):
+        """
+        changes the charge to nbytes, the actual size of what it is for
+        """
+        if self._budget is not None:
+            self._budget._settle(self._nbytes, nbytes)
+            self._nbytes = nbytes
+
+    def release(self):
+        budget, self._budget = self._budget, None
+        if budget is not None:
+            budget._release(self._nbytes)
+
+    def __del__(self):
+        self.release()
+
+def error_result(url, error, status, reason):
+    """
+    constructs a SpiderResult for a fetch that was never made, 
+    shaped like the ones httplib2 produces for failed requests 
+    when force_exception_to_status_code is set.
+    """
+    content = str(error)
+    response = Response({'content-type': 'text/plain',
+                         'status': str(status),
+                         'content-length': str(len(content))})
+    response.reason = reason
+    return SpiderResult(url, response, content, error=error)
+
+def url_host(url):
+    return (urlparse(url).hostname or '').lower()
+
+
+class RetryPolicy(object):
+    """
+    describes when and how soon a failed fetch should be retried.
+
+    a fetch is retried if its response status is in retry_statuses 
+    (by default request timeouts, as produced by httplib2 for dead 
+    hosts, and the transient 5xx statuses).  the nth retry waits 
+    min(max_delay, base_delay * 2**n) scaled by a random factor in 
+    [1 - jitter, 1].
+    """
+
+    DEFAULT_RETRY_STATUSES = (408, 500, 502, 503, 504)
+
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0,
+                 jitter=0.5, retry_statuses=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        if retry_statuses is None:
+            retry_statuses = self.DEFAULT_RETRY_STATUSES
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def should_retry(self, status, attempt):
+        """
+        attempt - the number of retries already made for the job
+        """
+        return attempt < self.max_retries and status in self.retry_statuses
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1.0 - self.jitter * random.random())
+
+
+class CircuitOpen(Exception):
+    """
+    used as the error of a SpiderResult when its fetch was skipped 
+    because the circuit for the host is open.
+    """
+    pass
+
+class RobotsDisallowed(Exception):
+    """
+    used as the error of a SpiderResult when its url is forbidden 
+    by the host's robots.txt
+    """
+    pass
+
+class CircuitBreaker(object):
+    """
+    per host circuit breaker.  After threshold consecutive failures 
+    for a host, the circuit for that host opens and fetches to it are 
+    refused until cooldown seconds have passed.  Then a single trial 
+    fetch is let through (half open); if it succeeds the circuit 
+    closes, otherwise it opens for another cooldown.  A trial that is
+    abandoned, or whose outcome is never recorded within cooldown 
+    seconds, gives way to another.
+
+    a response counts as a failure if its status is in failure_statuses,
+    by default timeouts and gateway errors, ie a dead or hung host.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    DEFAULT_FAILURE_STATUSES = (408, 502, 503, 504)
+
+    def __init__(self, threshold=5, cooldown=60.0, failure_statuses=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        if failure_statuses is None:
+            failure_statuses = self.DEFAULT_FAILURE_STATUSES
+        self.failure_statuses = frozenset(failure_statuses)
+
+        self._lock = threading.Lock()
+        # host -> [state, consecutive failures, opened or trial started at]
+        self._hosts = {}
+        # totals, for reporting
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self, host):
+        """
+        returns True if a fetch to host may proceed now.
+        """
+        self._lock.acquire()
+        try:
+            info = self._hosts.get(host)
+            if info is None or info[0] == self.CLOSED:
+                return True
+            now = time.time()
+            if now - info[2] >= self.cooldown:
+                # let a single trial request through
+                info[0] = self.HALF_OPEN
+                info[2] = now
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def abandon(self, host):
+        """
+        called when a fetch allowed to host is not made after all (or
+        fails without a status), so that a trial fetch it was given
+        goes to the next one instead.
+        """
+        self._lock.acquire()
+        try:
+            info = self._hosts.get(host)
+            if info is not None and info[0] == self.HALF_OPEN:
+                info[0] = self.OPEN
+                info[2] = time.time() - self.cooldown
+        finally:
+            self._lock.release()
+
+    def record(self, host, status):
+        """
+        records the outcome of a fetch to host. returns True if this 
+        caused the circuit for the host to open.
+        """
+        failed = status in self.failure_statuses
+        self._lock.acquire()
+        try:
+            info = self._hosts.get(host)
+            if not failed:
+                if info is not None:
+                    del self._hosts[host]
+                return False
+            if info is None:
+                info = self._hosts[host] = [self.CLOSED, 0, 0]
+            info[1] += 1
+            if info[0] == self.HALF_OPEN or \
+               (info[0] == self.CLOSED and info[1] >= self.threshold):
+                info[0] = self.OPEN
+                info[2] = time.time()
+                self.trips += 1
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def state(self, host):
+        info = self._hosts.get(host)
+        if info is None:
+            return self.CLOSED
+        return info[0]
+
+    def open_hosts(self):
+        self._lock.acquire()
+        try:
+            return [h for h, info in self._hosts.items() if info[0] != self.CLOSED]
+        finally:
+            self._lock.release()
+
+
+class SpiderMetrics(Metrics):
+    """
+    fetch statistics for a Spider, overall and per host.
+
+    snapshot() returns a plain dict suitable for serializing:
+    {'uptime': seconds, 'fetches': n, 'fetches_per_second': r,
+     'bytes': n, 'cache_hits': n, 'cache_hit_rate': r,
+     'status': {200: n, ...}, 'latency': {'count': n, 'p50': s, ...},
+     'events': {'retry': n, 'circuit_open': n, ...},
+     'hosts': {host: {...same keys, less uptime and rates...}}}
+    """
+
+    def __init__(self, per_host=True):
+        """
+        per_host - if False, only overall figures are kept. 
+        """
+        Metrics.__init__(self)
+        self.per_host = per_host
+
+    def record_fetch(self, host, status, elapsed, nbytes, fromcache):
+        self._record(None, status, elapsed, nbytes, fromcache)
+        if self.per_host:
+            self._record(host, status, elapsed, nbytes, fromcache)
+
+    def _record(self, host, status, elapsed, nbytes, fromcache):
+        self.incr((host, 'fetches'))
+        self.incr((host, 'status', status))
+        self.incr((host, 'bytes'), nbytes)
+        if fromcache:
+            self.incr((host, 'cache_hits'))
+        self.observe((host, 'latency'), elapsed)
+
+    def record_event(self, host, event):
+        """
+        counts something that happened instead of or in addition 
+        to a fetch, eg a retry or a job skipped by the circuit breaker.
+        """
+        self.incr((None, 'events', event))
+        if self.per_host:
+            self.incr((host, 'events', event))
+
+    def snapshot(self):
+        counts, histograms = self.merged()
+        uptime = time.time() - self.started
+
+        def blank():
+            return {'fetches': 0, 'bytes': 0, 'cache_hits': 0,
+                    'status': {}, 'events': {}, 'latency': summarize({})}
+
+        overall = blank()
+        hosts = {}
+        for name, n in counts.items():
+            host = name[0]
+            if host is None:
+                stats = overall
+            else:
+                stats = hosts.get(host)
+                if stats is None:
+                    stats = hosts[host] = blank()
+            if len(name) == 3:
+                stats[name[1]][name[2]] = n
+            else:
+                stats[name[1]] = n
+        for (host, _), buckets in histograms.items():
+            if host is None:
+                overall['latency'] = summarize(buckets)
+            elif host in hosts:
+                hosts[host]['latency'] = summarize(buckets)
+
+        for stats in [overall] + hosts.values():
+            if stats['fetches']:
+                stats['cache_hit_rate'] = float(stats['cache_hits']) / stats['fetches']
+            else:
+                stats['cache_hit_rate'] = 0.0
+
+        overall['uptime'] = uptime
+        if uptime > 0:
+            overall['fetches_per_second'] = overall['fetches'] / uptime
+        else:
+            overall['fetches_per_second'] = 0.0
+        overall['hosts'] = hosts
+        return overall
+
 
 class Spider(ThreadPool):
     """
@@ -61,16 +565,272 @@ class Spider(ThreadPool):
     SpiderResults in output_queue (if provided)
     """
 
-    def __init__(self, cache=None, **kw):
+    def __init__(self, cache=None, retry=None, breaker=None, metrics=None,
+                 max_inflight_bytes=None, compress_threshold=None,
+                 spool_threshold=None, spool_dir=None, rate_limiter=None,
+                 host_cache=None, obey_robots=True, **kw):
         """
         @param cache a folder to use as a cache or an httplib2 cache
+        @param retry an optional RetryPolicy, failed fetches are not 
+               retried if unspecified.
+        @param breaker an optional CircuitBreaker, shared by all workers
+        @param metrics the SpiderMetrics to record fetches in, a new 
+               one is made if unspecified.
+        @param max_inflight_bytes if specified, fetching stalls while the
+               bodies of results not yet released hold this many bytes 
+               of memory.  See SpiderResult.release
+        @param compress_threshold if specified, bodies of at least this 
+               many bytes are kept zlib compressed.
+        @param spool_threshold if specified, bodies of at least this many
+               bytes are spooled to temporary files in spool_dir
+        @param rate_limiter an optional melk.util.ratelimit.RateLimiter 
+               shared by all workers (and possibly other spiders)
+        @param host_cache an optional melk.util.hostcache.HostCache. If 
+               given, crawl-delays are respected and if obey_robots is 
+               set urls forbidden by robots.txt are not fetched.
         """
         ThreadPool.__init__(self, **kw)
 
         self._cache = cache
+        self.retry = retry
+        self.breaker = breaker
+        if metrics is None:
+            metrics = SpiderMetrics()
+        self.metrics = metrics
+
+        self.budget = None
+        if max_inflight_bytes is not None:
+            self.budget = ByteBudget(max_inflight_bytes)
+        self.compress_threshold = compress_threshold
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.rate_limiter = rate_limiter
+        self.host_cache = host_cache
+        self.obey_robots = obey_robots
+
+        # tag or host -> the job seq at the last cancel() naming it
+        self._cancelled_tags = {}
+        self._cancelled_hosts = {}
+        self._cancel_lock = threading.Lock()
+        # jobs being done, guarded by _cancel_lock
+        self._active = 0
+
+    def cancel(self, tag=None, host=None):
+        """
+        cancels all jobs made before now with the given tag or for
+        the given host.  Cancelled jobs that are still queued are 
+        dropped without being fetched.
+
+        The cancel is forgotten once the spider runs out of work, so
+        it does not apply to jobs made before it but only queued after
+        that.
+        """
+        seq = _job_seq.next()
+        self._cancel_lock.acquire()
+        try:
+            if tag is not None:
+                self._cancelled_tags[tag] = seq
+            if host is not None:
+                self._cancelled_hosts[host.lower()] = seq
+        finally:
+            self._cancel_lock.release()
+
+    def _job_started(self):
+        self._cancel_lock.acquire()
+        try:
+            self._active += 1
+        finally:
+            self._cancel_lock.release()
+
+    def _job_finished(self, requeued=False):
+        self._cancel_lock.acquire()
+        try:
+            self._active -= 1
+            # a requeued job is not on the queue yet, but still to do
+            if (self._active == 0 and not requeued and
+                (self._cancelled_tags or self._cancelled_hosts) and
+                self.input_queue.qsize() == 0):
+                # nothing left that a cancel could match
+                self._cancelled_tags.clear()
+                self._cancelled_hosts.clear()
+        finally:
+            self._cancel_lock.release()
+
+    def _cancelled(self, job):
+        if job.cancel_token is not None and job.cancel_token.cancelled:
+            return True
+        if self._cancelled_hosts:
+            at = self._cancelled_hosts.get(job.host)
+            if at is not None and job.seq < at:
+                return True
+        if self._cancelled_tags:
+            for tag in job.tags:
+                at = self._cancelled_tags.get(tag)
+                if at is not None and job.seq < at:
+                    return True
+        return False
+
+    def _check_live(self, job):
+        """
+        raises JobDropped if the job has been cancelled or 
+        is past its deadline.
+        """
+        if self._cancelled(job):
+            self.metrics.record_event(job.host, 'cancelled')
+            raise JobDropped('cancelled')
+        if job.expired():
+            self.metrics.record_event(job.host, 'expired')
+            raise JobDropped('deadline passed')
 
     def _do(self, job):
-        return job(self._get_http_client()) 
+        self._job_started()
+        requeued = False
+        try:
+            self._check_live(job)
+            charge = None
+            if self.budget is not None:
+                charge = self.budget.reserve()
+                if charge.waited:
+                    self.metrics.record_event(job.host, 'stalled')
+            try:
+                result = self._fetch(job)
+                self._store(result, charge)
+            except:
+                if charge is not None:
+                    charge.release()
+                raise
+            return result
+        except Requeue:
+            requeued = True
+            raise
+        finally:
+            self._job_finished(requeued)
+
+    def _store(self, result, charge=None):
+        """
+        charge - the budget reserved for the result's body, settled
+                 with the size kept
+        """
+        content = result.content
+        if not content:
+            if charge is not None:
+                charge.release()
+            return
+        nbytes = len(content)
+        if self.spool_threshold is not None and nbytes >= self.spool_threshold:
+            body = SpooledBody(content, self.spool_dir)
+        elif self.compress_threshold is not None and nbytes >= self.compress_threshold:
+            body = CompressedBody(content)
+        else:
+            body = None
+
+        if body is not None:
+            nbytes = body.size
+        elif charge is None:
+            return
+
+        if charge is not None:
+            charge.settle(nbytes)
+        result._store(body, charge)
+
+    def _fetch(self, job):
+        host = job.host
+        info = None
+        while True:
+            self._check_live(job)
+            if job.not_before is not None:
+                # backing off before a retry
+                self._wait_until(job.not_before)
+                job.not_before = None
+
+            if self.host_cache is not None:
+                if info is None:
+                    info = self.host_cache.get(host, _PoliteHttp(self, host),
+                                               urlparse(job.url).scheme or 'http')
+                    if self.obey_robots and not info.allowed(job.url, self.host_cache.agent):
+                        log.debug("%s: forbidden by robots.txt" % job.url)
+                        self.metrics.record_event(host, 'robots_disallowed')
+                        return error_result(job.url, RobotsDisallowed(job.url), 403,
+                                            'Forbidden by robots.txt')
+                if self.can_requeue():
+                    self._take_turn(info)
+                elif info.wait_turn() > 0:
+                    self.metrics.record_event(host, 'crawl_delayed')
+
+            # checked last, as a trial fetch it allows must be made
+            if self.breaker is not None and not self.breaker.allow(host):
+                log.debug("%s: circuit open for %s, skipping" % (job.url, host))
+                self.metrics.record_event(host, 'circuit_open')
+                return error_result(job.url, CircuitOpen(host), 503, 'Circuit Open')
+
+            try:
+                if self.rate_limiter is not None and self.rate_limiter.acquire(host) > 0:
+                    self.metrics.record_event(host, 'throttled')
+
+                self._local.requeued = 0
+                start = time.time()
+                result = job(self._get_http_client())
+                elapsed = time.time() - start
+            except:
+                if self.breaker is not None:
+                    self.breaker.abandon(host)
+                raise
+
+            response = result.response
+            status = response.status
+            nbytes = len(result.content or '')
+            fromcache = getattr(response, 'fromcache', False)
+            self.metrics.record_fetch(host, status, elapsed, nbytes, fromcache)
+            if self.rate_limiter is not None and not fromcache:
+                self.rate_limiter.charge(host, nbytes)
+
+            if self.breaker is not None and self.breaker.record(host, status):
+                log.warn("circuit opened for %s after %s -> %s" % (host, job.url, status))
+                self.metrics.record_event(host, 'circuit_trip')
+            if self.retry is None or not self.retry.should_retry(status, job.attempt):
+                return result
+
+            delay = self.retry.delay(job.attempt)
+            job.attempt += 1
+            job.not_before = time.time() + delay
+            self.metrics.record_event(host, 'retry')
+            log.debug("%s -> %s, retry %d in %0.2fs" % (job.url, status, job.attempt, delay))
+
+    def _wait_until(self, when):
+        """
+        waits until the time when, or raises Requeue so that the worker
+        can get on with other jobs meanwhile.
+        """
+        wait = when - time.time()
+        if wait <= 0:
+            return
+        if self.can_requeue():
+            self._requeue(wait)
+        time.sleep(wait)
+
+    def _take_turn(self, info):
+        """
+        takes the host's turn, or raises Requeue so that the worker can
+        get on with other hosts meanwhile.
+        """
+        wait = info.try_turn()
+        if wait <= 0:
+            return
+        self.metrics.record_event(info.host, 'crawl_delayed')
+        self._requeue(wait)
+
+    def _requeue(self, wait):
+        """
+        raises Requeue for a job that can't go ahead for wait seconds
+        """
+        # once about everything queued has been put back, there is
+        # nothing ready to do, so pause rather than spin
+        requeued = getattr(self._local, 'requeued', 0) + 1
+        if requeued > self.input_queue.qsize():
+            time.sleep(min(wait, 0.1))
+            requeued = 0
+        self._local.requeued = requeued
+        raise Requeue()
 
     def _get_http_client(self):
         # this is implemented as a thread local
@@ -84,6 +844,34 @@ class Spider(ThreadPool):
         """
         return DefaultHttp(cache=self._cache)
 
+class _PoliteHttp(object):
+    """
+    an http client for requests made on the spider's own account,
+    eg for robots.txt, that go through its rate limiter and circuit
+    breaker like the fetches of jobs do.
+    """
+    def __init__(self, spider, host):
+        self.spider = spider
+        self.host = host
+
+    def request(self, url, method="GET"):
+        spider = self.spider
+        if spider.breaker is not None and not spider.breaker.allow(self.host):
+            raise CircuitOpen(self.host)
+        try:
+            if spider.rate_limiter is not None:
+                spider.rate_limiter.acquire(self.host)
+            response, content = spider._get_http_client().request(url, method)
+        except:
+            if spider.breaker is not None:
+                spider.breaker.abandon(self.host)
+            raise
+        if spider.rate_limiter is not None and not getattr(response, 'fromcache', False):
+            spider.rate_limiter.charge(self.host, len(content or ''))
+        if spider.breaker is not None:
+            spider.breaker.record(self.host, response.status)
+        return response, content
+
 DEFAULT_HTTP_ARGS = {
     'timeout': 15,
 }
@@ -17,9 +17,19 @@
 # Boston, MA  02110-1301
 # USA
 
+import logging
 import threading
-from Queue import Queue
+import heapq
+import itertools
+import random
+from collections import deque
+import traceback
+from time import time as _time
+from Queue import Queue, Empty, Full
 from peak.util.proxies import ObjectWrapper
+from melk.util.trace import Traced
+
+log = logging.getLogger(__name__)
 
 if hasattr(Queue, 'join'):
     TaskQueue = Queue
@@ -31,8 +41,8 @@ else:
         this is a part of python 2.5, should probably check for it there
         """
 
-        def __init__(self):
-            Queue.__init__(self)
+        def __init__(self, maxsize=0):
+            Queue.__init__(self, maxsize)
             self.all_tasks_done = threading.Condition(self.mutex)
             self.unfinished_tasks = 0
 
@@ -81,6 +91,850 @@ else:
             finally:
                 self.all_tasks_done.release()
 
+def get_many(queue, n, block=True, timeout=None):
+    """
+    removes and returns a list of up to n items from queue, taking the
+    queue's lock once rather than once per item.  Blocks (as Queue.get) 
+    only until at least one item is available.
+
+    uses the queue's own get_many if it has one, works on the internals 
+    of a standard Queue.Queue otherwise.
+    """
+    if hasattr(queue, 'get_many'):
+        return queue.get_many(n, block, timeout)
+
+    queue.not_empty.acquire()
+    try:
+        if not block:
+            if not queue._qsize():
+                raise Empty
+        elif timeout is None:
+            while not queue._qsize():
+                queue.not_empty.wait()
+        else:
+            endtime = _time() + timeout
+            while not queue._qsize():
+                remaining = endtime - _time()
+                if remaining <= 0.0:
+                    raise Empty
+                queue.not_empty.wait(remaining)
+        items = []
+        while len(items) < n and queue._qsize():
+            items.append(queue._get())
+        if queue.maxsize > 0:
+            queue.not_full.notify(len(items))
+        return items
+    finally:
+        queue.not_empty.release()
+
+def put_many(queue, items):
+    """
+    places each of items on queue, taking the queue's lock once if 
+    the queue is an unbounded standard Queue.Queue.  Uses the queue's 
+    own put_many if it has one.
+    """
+    if hasattr(queue, 'put_many'):
+        return queue.put_many(items)
+
+    if not isinstance(queue, Queue) or queue.maxsize > 0:
+        for item in items:
+            queue.put(item)
+        return
+
+    if not items:
+        return
+    queue.not_full.acquire()
+    try:
+        for item in items:
+            queue._put(item)
+        queue.unfinished_tasks += len(items)
+        queue.not_empty.notify(len(items))
+    finally:
+        queue.not_full.release()
+
+def task_done_many(queue, n):
+    """
+    the same as calling queue.task_done() n times
+    """
+    if hasattr(queue, 'task_done_many'):
+        return queue.task_done_many(n)
+
+    if n == 0:
+        return
+    queue.all_tasks_done.acquire()
+    try:
+        unfinished = queue.unfinished_tasks - n
+        if unfinished <= 0:
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            queue.all_tasks_done.notifyAll()
+        queue.unfinished_tasks = unfinished
+    finally:
+        queue.all_tasks_done.release()
+
+class Sentinel(object):
+    """
+    a marker placed on a queue to signal its consumers rather than 
+    as work to be done.  Queues that look at their items, eg to 
+    prioritize them, should pass sentinels along without doing so.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<Sentinel %s>' % self.name
+
+class _Prioritized(object):
+    __slots__ = ('priority', 'item')
+
+    def __init__(self, priority, item):
+        self.priority = priority
+        self.item = item
+
+# classes that pools wrap jobs in on their way through a queue, 
+# keeping the job as their job attribute
+_envelopes = set([Traced])
+
+def register_envelope(cls):
+    """
+    makes job_priority and job_key look inside instances of cls, 
+    which keep the job they wrap as their job attribute.
+    """
+    _envelopes.add(cls)
+    return cls
+
+def unwrap_job(job):
+    """
+    returns the job inside any envelopes around it
+    """
+    while job.__class__ in _envelopes:
+        job = job.job
+    return job
+
+def job_priority(job):
+    """
+    the default priority of a job, its priority attribute if it has
+    one and 0 otherwise.
+    """
+    return getattr(unwrap_job(job), 'priority', 0)
+
+class PriorityTaskQueue(TaskQueue):
+    """
+    a TaskQueue that hands out the job with the lowest priority value
+    first, and jobs of equal priority in the order they were put.  
+    eg, giving interactive jobs priority -1 lets them jump ahead of 
+    background jobs at the default of 0.
+
+    the priority of a job is given to put, or else is found by calling 
+    priority(job).  Sentinels are handed out only after every job.
+    """
+
+    def __init__(self, maxsize=0, priority=job_priority):
+        self._priority = priority
+        TaskQueue.__init__(self, maxsize)
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        if priority is not None:
+            item = _Prioritized(priority, item)
+        TaskQueue.put(self, item, block, timeout)
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        self.heap = []
+        self.sentinels = deque()
+        self._seq = 0
+
+    def _qsize(self, len=len):
+        return len(self.heap) + len(self.sentinels)
+
+    def _put(self, item):
+        if isinstance(item, Sentinel):
+            self.sentinels.append(item)
+            return
+        if isinstance(item, _Prioritized):
+            priority, item = item.priority, item.item
+        else:
+            priority = self._priority(item)
+        self._seq += 1
+        heapq.heappush(self.heap, (priority, self._seq, item))
+
+    def _get(self):
+        if self.heap:
+            return heapq.heappop(self.heap)[2]
+        return self.sentinels.popleft()
+
+def job_key(job):
+    """
+    the default fair share key of a job, its key attribute if it has
+    one and None otherwise.
+    """
+    return getattr(unwrap_job(job), 'key', None)
+
+class FairShareTaskQueue(TaskQueue):
+    """
+    a TaskQueue that takes turns between the keys (eg users or hosts) 
+    of the jobs put on it, handing out one job of each key with jobs
+    waiting in round robin.  Jobs of the same key are handed out in 
+    the order they were put, so one key with thousands of jobs queued 
+    does not hold up the others.
+
+    the key of a job is found by calling key(job).  Sentinels are
+    handed out only after every job.
+    """
+
+    def __init__(self, maxsize=0, key=job_key):
+        self._key = key
+        TaskQueue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        # key -> deque of jobs
+        self.queues = {}
+        # keys with jobs waiting, in turn order
+        self.turns = deque()
+        self.sentinels = deque()
+        self._size = 0
+
+    def _qsize(self, len=len):
+        return self._size + len(self.sentinels)
+
+    def _put(self, item):
+        if isinstance(item, Sentinel):
+            self.sentinels.append(item)
+            return
+        key = self._key(item)
+        q = self.queues.get(key)
+        if q is None:
+            q = self.queues[key] = deque()
+            self.turns.append(key)
+        q.append(item)
+        self._size += 1
+
+    def _get(self):
+        if not self._size:
+            return self.sentinels.popleft()
+        key = self.turns.popleft()
+        q = self.queues[key]
+        item = q.popleft()
+        if q:
+            self.turns.append(key)
+        else:
+            del self.queues[key]
+        self._size -= 1
+        return item
+
+class FastTaskQueue(object):
+    """
+    a drop in replacement for TaskQueue with less locking, eg as the 
+    input_queue of a ThreadPool.
+
+    items are kept in a deque.  Taking an item from a non empty queue
+    takes no lock at all, putting one or marking one done takes a single
+    lock once, and waiting threads are only notified when there are any.
+    put_many, get_many and task_done_many handle many items at a time
+    for the cost of one.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._getters = 0
+        self._putters = 0
+        self._joiners = 0
+        self.unfinished_tasks = 0
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._items)
+
+    def _wait(self, cond, timeout, endtime):
+        # called with the lock held, raises Empty if the time is up
+        if timeout is None:
+            cond.wait()
+        else:
+            remaining = endtime - _time()
+            if remaining <= 0.0:
+                raise Empty
+            cond.wait(remaining)
+
+    def put(self, item, block=True, timeout=None):
+        self._lock.acquire()
+        try:
+            if self.maxsize > 0 and len(self._items) >= self.maxsize:
+                self._wait_for_room(block, timeout)
+            self._items.append(item)
+            self.unfinished_tasks += 1
+            if self._getters:
+                self._not_empty.notify()
+        finally:
+            self._lock.release()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def _wait_for_room(self, block, timeout):
+        # called with the lock held
+        if not block:
+            raise Full
+        if timeout is not None:
+            endtime = _time() + timeout
+        else:
+            endtime = None
+        self._putters += 1
+        try:
+            while len(self._items) >= self.maxsize:
+                try:
+                    self._wait(self._not_full, timeout, endtime)
+                except Empty:
+                    raise Full
+        finally:
+            self._putters -= 1
+
+    def put_many(self, items):
+        items = list(items)
+        while items:
+            self._lock.acquire()
+            try:
+                if self.maxsize > 0:
+                    if len(self._items) >= self.maxsize:
+                        self._wait_for_room(True, None)
+                    n = self.maxsize - len(self._items)
+                else:
+                    n = len(items)
+                self._items.extend(items[:n])
+                self.unfinished_tasks += len(items[:n])
+                if self._getters:
+                    self._not_empty.notify(min(n, self._getters))
+                items = items[n:]
+            finally:
+                self._lock.release()
+
+    def _made_room(self, n):
+        if self._putters:
+            self._lock.acquire()
+            try:
+                self._not_full.notify(n)
+            finally:
+                self._lock.release()
+
+    def get(self, block=True, timeout=None):
+        try:
+            # deque operations are atomic
+            item = self._items.popleft()
+        except IndexError:
+            pass
+        else:
+            if self._putters:
+                self._made_room(1)
+            return item
+
+        self._lock.acquire()
+        try:
+            if timeout is not None:
+                endtime = _time() + timeout
+            else:
+                endtime = None
+            self._getters += 1
+            try:
+                while True:
+                    try:
+                        item = self._items.popleft()
+                        break
+                    except IndexError:
+                        if not block:
+                            raise Empty
+                        self._wait(self._not_empty, timeout, endtime)
+            finally:
+                self._getters -= 1
+            if self._putters:
+                self._not_full.notify()
+            return item
+        finally:
+            self._lock.release()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, n, block=True, timeout=None):
+        items = [self.get(block, timeout)]
+        popleft = self._items.popleft
+        try:
+            while len(items) < n:
+                items.append(popleft())
+        except IndexError:
+            pass
+        if self._putters and len(items) > 1:
+            self._made_room(len(items) - 1)
+        return items
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_done_many(self, n):
+        self._lock.acquire()
+        try:
+            unfinished = self.unfinished_tasks - n
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                if self._joiners:
+                    self._all_done.notifyAll()
+            self.unfinished_tasks = unfinished
+        finally:
+            self._lock.release()
+
+    def join(self):
+        self._lock.acquire()
+        try:
+            self._joiners += 1
+            try:
+                while self.unfinished_tasks:
+                    self._all_done.wait()
+            finally:
+                self._joiners -= 1
+        finally:
+            self._lock.release()
+
+class ShardedTaskQueue(object):
+    """
+    a queue for a ThreadPool (as its input_queue) made of nshards
+    TaskQueues.  Jobs are placed on a shard by the hash of their key, 
+    found by calling key(job), and each shard is taken from by a single
+    worker, so the jobs of one key are processed one at a time in the 
+    order they were put, while different keys go in parallel.  Workers 
+    only ever share a lock with the threads putting jobs on their shard.
+
+    the pool must have exactly nshards workers, which ThreadPool checks
+    (and so does not resize or autoscale such a pool).  The first nshards 
+    threads to wait for jobs each own a shard until they unregister (as 
+    retiring ThreadPool workers do), further ones wait for a shard to be
+    released.  Sentinels are dealt out to the shards in turn, so a STOP 
+    per worker stops each of them once its shard is drained.
+    """
+
+    def __init__(self, nshards, key=job_key, maxsize=0):
+        """
+        maxsize - if greater than 0, the most jobs each shard holds
+        """
+        if nshards < 1:
+            raise ValueError('nshards must be at least 1, got %r' % nshards)
+        self.shards = [TaskQueue(maxsize) for i in range(nshards)]
+        self.maxsize = maxsize
+        self._key = key
+        self._turn = itertools.count()
+        self._local = threading.local()
+        self._free = threading.Condition(threading.Lock())
+        self._unowned = range(nshards)
+
+    def shard_of(self, item):
+        return self.shards[hash(self._key(item)) % len(self.shards)]
+
+    def _own_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        self._free.acquire()
+        try:
+            while not self._unowned:
+                self._free.wait()
+            shard = self.shards[self._unowned.pop(0)]
+        finally:
+            self._free.release()
+        self._local.shard = shard
+        return shard
+
+    def unregister(self):
+        """
+        called by a worker that will take no more jobs, releases its shard
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            return
+        del self._local.shard
+        self._free.acquire()
+        try:
+            self._unowned.append(self.shards.index(shard))
+            self._unowned.sort()
+            self._free.notify()
+        finally:
+            self._free.release()
+
+    def _taken(self):
+        # the shards of the jobs the calling thread took and has not 
+        # marked done
+        try:
+            return self._local.taken
+        except AttributeError:
+            taken = self._local.taken = deque()
+            return taken
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, Sentinel):
+            shard = self.shards[self._turn.next() % len(self.shards)]
+        else:
+            shard = self.shard_of(item)
+        shard.put(item, block, timeout)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def put_many(self, items):
+        byshard = {}
+        for item in items:
+            if isinstance(item, Sentinel):
+                i = self._turn.next() % len(self.shards)
+            else:
+                i = hash(self._key(item)) % len(self.shards)
+            byshard.setdefault(i, []).append(item)
+        for i, shard_items in byshard.items():
+            put_many(self.shards[i], shard_items)
+
+    def get_many(self, n, block=True, timeout=None):
+        if block:
+            # threads that wait for jobs are workers
+            shards = [self._own_shard()]
+        else:
+            shards = self.shards
+            if hasattr(self._local, 'shard'):
+                shards = [self._local.shard]
+        for shard in shards:
+            try:
+                items = get_many(shard, n, block, timeout)
+            except Empty:
+                continue
+            self._taken().extend([shard] * len(items))
+            return items
+        raise Empty
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block, timeout)[0]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_done_many(self, n):
+        taken = self._taken()
+        if n > len(taken):
+            raise ValueError('task_done() called too many times')
+        counts = {}
+        for i in range(n):
+            shard = taken.popleft()
+            counts[shard] = counts.get(shard, 0) + 1
+        for shard, count in counts.items():
+            task_done_many(shard, count)
+
+    def qsize(self):
+        return sum([shard.qsize() for shard in self.shards])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    @property
+    def unfinished_tasks(self):
+        return sum([shard.unfinished_tasks for shard in self.shards])
+
+    def join(self):
+        # jobs never move between shards, so once each has been
+        # seen finished the whole queue has
+        for shard in self.shards:
+            shard.join()
+
+# returned by WorkStealingQueue._take when there is nothing to take
+_NOTHING = Sentinel('nothing')
+
+class WorkStealingQueue(object):
+    """
+    an unbounded queue for a ThreadPool (as its input_queue) with many
+    workers, which spreads jobs over a deque per worker rather than 
+    sharing one locked queue between them.
+
+    each thread waiting for jobs gets its own deque.  Jobs put by a worker
+    go on its own deque, jobs put by other threads on a shared one.  A 
+    worker takes the oldest job on its own deque, or else takes a share
+    of the jobs waiting on the shared deque (moving the rest of its share
+    onto its own), or failing that steals the newest job from another 
+    worker.  So a worker held up by a slow job does not hold up the jobs
+    it took with it.  Sentinels are handed out only after every job.
+
+    deque operations are atomic, so putting and taking jobs involves no
+    locks unless some worker is idle waiting for one.  Supports the same
+    task_done / join accounting as TaskQueue, with a count kept under a 
+    lock as Queue.Queue does.
+    """
+
+    # the most jobs a worker takes from the shared deque at a time
+    max_share = 32
+
+    def __init__(self, maxsize=0):
+        if maxsize > 0:
+            raise ValueError('WorkStealingQueue is unbounded')
+        self.maxsize = 0
+        self._local = threading.local()
+        # the worker deques, replaced rather than changed in place
+        self._deques = []
+        # jobs put by threads other than the workers
+        self._inject = deque()
+        # whether jobs may be waiting on worker deques, if not there 
+        # is no use looking for some to steal
+        self._stealable = False
+        self._sentinels = deque()
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._sleepers = 0
+        # sleepers notified that have not woken yet
+        self._waking = 0
+        self._all_done = threading.Condition(self._lock)
+        self._joiners = 0
+        self.unfinished_tasks = 0
+
+    def _own_deque(self):
+        try:
+            return self._local.deque
+        except AttributeError:
+            d = self._local.deque = deque()
+            self._lock.acquire()
+            try:
+                self._deques = self._deques + [d]
+            finally:
+                self._lock.release()
+            return d
+
+    def unregister(self):
+        """
+        called by a worker that will take no more jobs, any left on its
+        deque go to the others.
+        """
+        d = getattr(self._local, 'deque', None)
+        if d is None:
+            return
+        del self._local.deque
+        self._lock.acquire()
+        try:
+            self._deques = [x for x in self._deques if x is not d]
+            n = 0
+            while True:
+                try:
+                    self._inject.append(d.popleft())
+                except IndexError:
+                    break
+                n += 1
+            self._wake(n)
+        finally:
+            self._lock.release()
+
+    def _deque_for_put(self):
+        d = getattr(self._local, 'deque', None)
+        if d is not None:
+            self._stealable = True
+            return d
+        return self._inject
+
+    def _wake(self, n):
+        # called with the lock held.  Only one worker is woken at a time,
+        # once it gets going it wakes the next if there is more to do, so
+        # workers are not woken for jobs others will have taken by then.
+        # n is the number of jobs put, which need at most as many workers.
+        if n > 0 and self._sleepers and not self._waking:
+            self._waking = 1
+            self._not_empty.notify()
+
+    def put(self, item, block=True, timeout=None):
+        # counted in the same turn of the lock as waking a worker, and 
+        # before the job can be taken, so the count can't go below zero
+        self._lock.acquire()
+        try:
+            self.unfinished_tasks += 1
+            if isinstance(item, Sentinel):
+                self._sentinels.append(item)
+            else:
+                self._deque_for_put().append(item)
+            if self._sleepers:
+                self._wake(1)
+        finally:
+            self._lock.release()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def put_many(self, items):
+        if not items:
+            return
+        jobs = [item for item in items if not isinstance(item, Sentinel)]
+        self._lock.acquire()
+        try:
+            self.unfinished_tasks += len(items)
+            if len(jobs) < len(items):
+                self._sentinels.extend([item for item in items if isinstance(item, Sentinel)])
+            self._deque_for_put().extend(jobs)
+            if self._sleepers:
+                self._wake(len(items))
+        finally:
+            self._lock.release()
+
+    def _take(self, own):
+        # returns _NOTHING rather than raising Empty, as exceptions are
+        # slow and idle workers come up empty handed often.  For the same
+        # reason deques are checked before popping, they may still be 
+        # emptied by another thread in between.
+        try:
+            if own:
+                return own.popleft()
+            if self._inject:
+                return self._take_share(own)
+        except IndexError:
+            pass
+        deques = self._deques
+        n = len(deques)
+        if n > 1 and self._stealable:
+            # cleared before looking, so that jobs put on a worker 
+            # deque meanwhile set it again
+            self._stealable = False
+            start = random.randrange(n)
+            for i in xrange(n):
+                d = deques[(start + i) % n]
+                if d and d is not own:
+                    try:
+                        job = d.pop()
+                    except IndexError:
+                        continue
+                    self._stealable = True
+                    return job
+        try:
+            if self._inject:
+                # raced with another taker above
+                return self._inject.popleft()
+            if self._sentinels:
+                return self._sentinels.popleft()
+        except IndexError:
+            pass
+        return _NOTHING
+
+    def _take_share(self, own):
+        # takes the oldest shared job, and moves a fair share of those
+        # behind it onto own, where other workers may steal them back
+        inject = self._inject
+        job = inject.popleft()
+        if own is not None:
+            n = min(len(inject) // (len(self._deques) or 1), self.max_share)
+            if n > 0:
+                self._stealable = True
+                try:
+                    for i in xrange(n):
+                        own.append(inject.popleft())
+                except IndexError:
+                    pass
+        return job
+
+    def get(self, block=True, timeout=None):
+        # threads that wait for jobs are workers
+        if block:
+            own = self._own_deque()
+        else:
+            own = getattr(self._local, 'deque', None)
+        job = self._take(own)
+        if job is not _NOTHING:
+            return job
+        if not block:
+            raise Empty
+
+        if timeout is not None:
+            endtime = _time() + timeout
+        self._lock.acquire()
+        try:
+            self._sleepers += 1
+            try:
+                while True:
+                    # checked again once counted as a sleeper so that
+                    # a put in the meantime is not missed
+                    job = self._take(own)
+                    if job is not _NOTHING:
+                        if self._sleepers > 1 and (self._inject or self._stealable or
+                                                   self._sentinels):
+                            # wake the next worker for what is left
+                            self._wake(1)
+                        return job
+                    if timeout is None:
+                        self._not_empty.wait()
+                    else:
+                        remaining = endtime - _time()
+                        if remaining <= 0.0:
+                            raise Empty
+                        self._not_empty.wait(remaining)
+                    if self._waking > 0:
+                        self._waking -= 1
+            finally:
+                self._sleepers -= 1
+        finally:
+            self._lock.release()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, n, block=True, timeout=None):
+        items = [self.get(block, timeout)]
+        own = getattr(self._local, 'deque', None)
+        while len(items) < n:
+            job = self._take(own)
+            if job is _NOTHING:
+                break
+            items.append(job)
+        return items
+
+    def qsize(self):
+        return (sum([len(d) for d in self._deques]) + len(self._inject) +
+                len(self._sentinels))
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_done_many(self, n):
+        self._lock.acquire()
+        try:
+            unfinished = self.unfinished_tasks - n
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                if self._joiners:
+                    self._all_done.notifyAll()
+            self.unfinished_tasks = unfinished
+        finally:
+            self._lock.release()
+
+    def join(self):
+        self._lock.acquire()
+        try:
+            self._joiners += 1
+            try:
+                while self.unfinished_tasks:
+                    self._all_done.wait()
+            finally:
+                self._joiners -= 1
+        finally:
+            self._lock.release()
+
 class QueueInputAdapter(ObjectWrapper): 
     """
     wraps a Queue and performs an arbitrary transformation
@@ -93,15 +947,200 @@ class QueueInputAdapter(ObjectWrapper):
             self._transform = input_adaptation
         self.__subject__ = queue
 
-    def put(self, item):
-        if item is None:
-            return
+    def put(self, item, block=True, timeout=None):
+        item = self._adapt(item)
+        if item is not None:
+            return self.__subject__.put(item, block, timeout)
+
+    def put_many(self, items):
+        items = [self._adapt(item) for item in items]
+        put_many(self.__subject__, [item for item in items if item is not None])
 
+    def _adapt(self, item):
+        if item is None:
+            return None
+        if item.__class__ is Traced:
+            # transform the job in the envelope
+            job = item.job
+            if self._transform is not None:
+                job = self._transform(job)
+            if job is None:
+                item.trace.end('filtered')
+                return None
+            return Traced(item.trace, job)
         if self._transform is not None:
             item = self._transform(item)
-
-        if item is not None:
-            return self.__subject__.put(item)
+        return item
 
     def _transform(self, item):
-        return item
\ No newline at end of file
+        return item
+
+class BatchingQueueInputAdapter(QueueInputAdapter):
+    """
+    a QueueInputAdapter that holds on to the (transformed) items put 
+    on it and pushes them onto the wrapped queue together, as soon as 
+    batch_size items are held or window seconds after the first of them
+    was put.  Holding items for a while allows duplicates to be coalesced,
+    eg ten requests to refresh a feed in one second become one job.
+
+    items are pushed with put_many, or if as_batch is True as a single
+    list (eg for a ThreadPool with a batch_processor).  Sentinels are 
+    passed along at once, after any items held.
+
+    join, and the join of a ThreadPoolChain or Pipeline the adapter is 
+    part of, pushes the items held first.  Their shutdown closes it 
+    before shutting down the pool it feeds.  Once closed, items are 
+    pushed as soon as they are put.
+    """
+
+    batch_size = 100
+    window = 1.0
+    as_batch = False
+    # the number of items replaced by later ones with the same key
+    coalesced = 0
+
+    _key = None
+    _lock = None
+    _held = None
+    _keys = None
+    _deadline = None
+    _timer = None
+    _closed = False
+
+    def __init__(self, queue, input_adaptation=None, batch_size=100, window=1.0,
+                 key=None, as_batch=False):
+        """
+        key - an optional 1 argument function.  An item with the same key 
+              as one already held replaces it (in its place).
+        """
+        QueueInputAdapter.__init__(self, queue, input_adaptation)
+        self.batch_size = batch_size
+        self.window = window
+        self.as_batch = as_batch
+        self._key = key
+        self._lock = threading.Condition(threading.Lock())
+        self._held = []
+        # key -> index in _held
+        self._keys = {}
+
+    def put(self, item, block=True, timeout=None):
+        """
+        block and timeout apply to pushing onto the wrapped queue, as 
+        happens for a sentinel or when the put fills a batch.  If it 
+        stays full, Full is raised and the items are held on to.
+        """
+        self._put_many([item], block, timeout)
+
+    def put_many(self, items):
+        self._put_many(items)
+
+    def _put_many(self, items, block=True, timeout=None):
+        self._lock.acquire()
+        try:
+            for item in items:
+                if isinstance(item, Sentinel):
+                    self._flush(block, timeout)
+                    self.__subject__.put(item, block, timeout)
+                    continue
+                item = self._adapt(item)
+                if item is not None:
+                    self._hold(item)
+            if self._closed or len(self._held) >= self.batch_size:
+                self._flush(block, timeout)
+        finally:
+            self._lock.release()
+
+    def _hold(self, item):
+        # called with the lock held
+        if self._key is not None:
+            if item.__class__ is Traced:
+                k = self._key(item.job)
+            else:
+                k = self._key(item)
+            i = self._keys.get(k)
+            if i is not None:
+                replaced = self._held[i]
+                if replaced.__class__ is Traced:
+                    replaced.trace.end('coalesced')
+                self._held[i] = item
+                self.coalesced += 1
+                return
+            self._keys[k] = len(self._held)
+        self._held.append(item)
+        if len(self._held) == 1 and not self._closed:
+            self._deadline = _time() + self.window
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._flush_when_due)
+                self._timer.setDaemon(True)
+                self._timer.start()
+            else:
+                self._lock.notify()
+
+    def _flush(self, block=True, timeout=None):
+        # called with the lock held, so that batches are pushed in order
+        if not self._held:
+            return
+        items = self._held
+        self._held = []
+        self._keys = {}
+        self._deadline = None
+        pushed = 0
+        try:
+            if self.as_batch:
+                self.__subject__.put(items, block, timeout)
+            elif block and timeout is None:
+                put_many(self.__subject__, items)
+            else:
+                for item in items:
+                    self.__subject__.put(item, block, timeout)
+                    pushed += 1
+        except Full:
+            # hold on to the rest, to be pushed later
+            for item in items[pushed:]:
+                self._hold(item)
+            raise
+
+    def _flush_when_due(self):
+        self._lock.acquire()
+        try:
+            while not self._closed:
+                if self._deadline is None:
+                    self._lock.wait()
+                    continue
+                remaining = self._deadline - _time()
+                if remaining > 0:
+                    self._lock.wait(remaining)
+                    continue
+                try:
+                    self._flush()
+                except:
+                    log.error(traceback.format_exc())
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        pushes any items held onto the wrapped queue now
+        """
+        self._lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def join(self):
+        self.flush()
+        self.__subject__.join()
+
+    def close(self):
+        """
+        pushes any items held and stops the thread that pushes them 
+        when they are due
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._lock.notify()
+            self._flush()
+        finally:
+            self._lock.release()
@@ -17,16 +17,474 @@
 # Boston, MA  02110-1301
 # USA
 
+import sys
 import threading
 from threading import Thread
+import time
 import traceback
-from melk.util.taskqueue import TaskQueue as Queue
+from melk.util.taskqueue import TaskQueue as Queue, Sentinel
+from melk.util.taskqueue import get_many, put_many, task_done_many
+from melk.util.taskqueue import register_envelope, ShardedTaskQueue
+from melk.util.taskqueue import BatchingQueueInputAdapter
+from melk.util.metrics import Metrics, summarize
+from melk.util.autoscale import Autoscaler
+from melk.util.trace import Traced
+from collections import deque
+from Queue import Empty
 import logging
 
 log = logging.getLogger(__name__)
 
 DEFAULT_POOLSIZE = 10
 
+# placed on the input queue to stop one worker
+STOP = Sentinel('stop')
+
+class JobDropped(Exception):
+    """
+    may be raised while processing a job to abandon it quietly,
+    eg because it was cancelled or is past its deadline.  Nothing 
+    is placed on the output queue for the job.
+    """
+    pass
+
+class Requeue(Exception):
+    """
+    may be raised while processing a job to put it back on the input
+    queue to be done later, eg because what it needs is busy.  Only
+    raise it if ThreadPool.can_requeue() is True.
+    """
+    pass
+
+class CancelToken(object):
+    """
+    shared between a set of jobs and whoever may want to cancel them.  
+    Jobs check the token before doing their work.
+    """
+    def __init__(self):
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+class CancelledError(Exception):
+    """
+    raised when asking for the result of a cancelled Future
+    """
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """
+    the eventual result of a job submitted to a ThreadPool.  If 
+    processing the job raised an exception, asking for the result
+    raises it again (with its original traceback).
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    CANCELLED = 'cancelled'
+    FINISHED = 'finished'
+
+    def __init__(self):
+        self._state = self.PENDING
+        self._result = None
+        self._exc_info = None
+        self._cond = threading.Condition(threading.Lock())
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        cancels the job if it has not started yet, returns True 
+        if the job will not run.
+        """
+        self._cond.acquire()
+        try:
+            if self._state == self.RUNNING or self._state == self.FINISHED:
+                return False
+            if self._state == self.PENDING:
+                self._state = self.CANCELLED
+                self._cond.notifyAll()
+                callbacks = self._callbacks
+                self._callbacks = []
+            else:
+                callbacks = []
+        finally:
+            self._cond.release()
+        self._run_callbacks(callbacks)
+        return True
+
+    def cancelled(self):
+        return self._state == self.CANCELLED
+
+    def running(self):
+        return self._state == self.RUNNING
+
+    def done(self):
+        return self._state == self.CANCELLED or self._state == self.FINISHED
+
+    def _wait(self, timeout):
+        self._cond.acquire()
+        try:
+            if timeout is None:
+                while not self.done():
+                    self._cond.wait()
+            else:
+                end = time.time() + timeout
+                while not self.done():
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if self._state == self.CANCELLED:
+                raise CancelledError()
+            if self._state != self.FINISHED:
+                raise TimeoutError()
+        finally:
+            self._cond.release()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        arranges for fn(future) to be called once the future is done,
+        on the thread that finishes it (or now if it is already done).
+        """
+        self._cond.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._cond.release()
+        self._run_callbacks([fn])
+
+    def set_running(self):
+        """
+        returns False if the future was cancelled and the job should
+        not be run.
+        """
+        self._cond.acquire()
+        try:
+            if self._state == self.CANCELLED:
+                return False
+            self._state = self.RUNNING
+            return True
+        finally:
+            self._cond.release()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """
+        exc_info - as returned by sys.exc_info()
+        """
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        self._cond.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._state = self.FINISHED
+            self._cond.notifyAll()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._cond.release()
+        self._run_callbacks(callbacks)
+
+    def _run_callbacks(self, callbacks):
+        for fn in callbacks:
+            try:
+                fn(self)
+            except:
+                log.error(traceback.format_exc())
+
+def as_completed(futures, timeout=None):
+    """
+    iterates over the given futures as they complete (finish or are 
+    cancelled).  raises TimeoutError if they are not all done within
+    timeout seconds.
+    """
+    futures = list(futures)
+    done = Queue()
+    for f in futures:
+        f.add_done_callback(done.put)
+    if timeout is not None:
+        end = time.time() + timeout
+    for i in range(len(futures)):
+        if timeout is None:
+            yield done.get()
+        else:
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise TimeoutError()
+            try:
+                yield done.get(True, remaining)
+            except Empty:
+                raise TimeoutError()
+
+class _FutureJob(object):
+    """
+    a job placed on the input queue by ThreadPool.submit.  fn is
+    called with args, or if fn is None the pool processes job
+    as usual.
+    """
+    __slots__ = ('future', 'fn', 'args', 'job')
+
+    def __init__(self, future, fn, args=(), job=None):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.job = job
+
+register_envelope(_FutureJob)
+
+class _Sequenced(object):
+    __slots__ = ('seq', 'job')
+
+    def __init__(self, seq, job):
+        self.seq = seq
+        self.job = job
+
+register_envelope(_Sequenced)
+
+class _SequencedQueue(Queue):
+    """
+    the input queue of an ordered ThreadPool, numbers each job put 
+    on it.  Sentinels and submitted jobs are not numbered.
+    """
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self.next_seq = 0
+
+    def _put(self, item):
+        # called holding the queue's lock, so jobs are numbered
+        # in the order they are queued
+        if not (isinstance(item, Sentinel) or item.__class__ is _FutureJob):
+            item = _Sequenced(self.next_seq, item)
+            self.next_seq += 1
+        Queue._put(self, item)
+
+# the outcome of a job that produced no output
+_NO_RESULT = Sentinel('no result')
+
+class ReorderBuffer(object):
+    """
+    releases the results of numbered jobs in number order, as soon
+    as every earlier job is finished.  Jobs further than window ahead 
+    of the next result due wait their turn, so at most about window
+    results are held.
+    """
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1, got %r' % window)
+        self.window = window
+        self.next = 0
+        self._done = {}
+        self._cond = threading.Condition()
+        # releases put their results in the order of their tickets,
+        # without holding _cond
+        self._tickets = 0
+        self._next_ticket = 0
+        self._put_cond = threading.Condition(threading.Lock())
+
+    def wait_turn(self, seq):
+        self._cond.acquire()
+        try:
+            while seq >= self.next + self.window:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def release(self, seqs, results, output_queue):
+        """
+        records the results of the jobs numbered seqs (_NO_RESULT for 
+        those that failed or were dropped), putting any results now in
+        order on output_queue.
+        """
+        self._cond.acquire()
+        try:
+            done = self._done
+            for seq, rc in zip(seqs, results):
+                done[seq] = rc
+            ready = []
+            while self.next in done:
+                rc = done.pop(self.next)
+                if rc is not _NO_RESULT:
+                    ready.append(rc)
+                self.next += 1
+            ticket = None
+            if ready and output_queue is not None:
+                ticket = self._tickets
+                self._tickets += 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        if ticket is not None:
+            self._put_in_turn(ticket, ready, output_queue)
+
+    def _put_in_turn(self, ticket, ready, output_queue):
+        # a full output queue holds up only the releases behind it
+        self._put_cond.acquire()
+        try:
+            while self._next_ticket != ticket:
+                self._put_cond.wait()
+        finally:
+            self._put_cond.release()
+        try:
+            put_many(output_queue, ready)
+        finally:
+            self._put_cond.acquire()
+            try:
+                self._next_ticket += 1
+                self._put_cond.notifyAll()
+            finally:
+                self._put_cond.release()
+
+    @property
+    def pending(self):
+        """
+        the number of results held waiting for earlier jobs
+        """
+        return len(self._done)
+
+def _check_batch_results(jobs, results):
+    """
+    results of a batch are matched to its jobs by position, so there
+    must be one for each
+    """
+    if len(results) != len(jobs):
+        raise ValueError('batch_processor returned %d results for %d jobs'
+                         % (len(results), len(jobs)))
+
+def _map_chunk(fn, chunk):
+    return [fn(item) for item in chunk]
+
+class PoolStats(object):
+    """
+    records how busy a pool is: jobs, errors, time spent processing
+    and the depth of its input queue over time.  Recording takes no 
+    locks, see melk.util.metrics.
+    """
+
+    def __init__(self, name, queue, sample_interval=1.0, history=600):
+        """
+        sample_interval - seconds between samples of the input queue depth
+        history - the number of queue depth samples kept
+        """
+        self.name = name
+        self.queue = queue
+        self.sample_interval = sample_interval
+        self.depths = deque(maxlen=history)
+        self._metrics = Metrics()
+        self._next_sample = 0
+        self._mark = (time.time(), 0.0)
+
+    def record(self, started, finished, njobs=1, errors=0, dropped=0):
+        m = self._metrics
+        elapsed = finished - started
+        m.incr('jobs', njobs)
+        m.incr('busy', elapsed)
+        if njobs == 1:
+            m.observe('service', elapsed)
+        elif njobs > 1:
+            m.observe('service', elapsed / njobs)
+        if errors:
+            m.incr('errors', errors)
+        if dropped:
+            m.incr('dropped', dropped)
+        if finished >= self._next_sample:
+            self._next_sample = finished + self.sample_interval
+            self.sample(finished)
+
+    def sample(self, now=None):
+        if now is None:
+            now = time.time()
+        self.depths.append((now, self.queue.qsize()))
+
+    def mark(self):
+        """
+        returns a mark to measure utilization from, see utilization
+        """
+        return (time.time(), self._metrics.merged()[0].get('busy', 0.0))
+
+    def utilization(self, mark, workers, counts=None):
+        """
+        returns (the fraction of the time since mark that workers spent
+        processing jobs, a new mark).
+        """
+        now = time.time()
+        if counts is None:
+            counts = self._metrics.merged()[0]
+        busy = counts.get('busy', 0.0)
+        mark_time, mark_busy = mark
+        if workers > 0 and now > mark_time:
+            utilization = min(1.0, (busy - mark_busy) / (workers * (now - mark_time)))
+        else:
+            utilization = 0.0
+        return utilization, (now, busy)
+
+    def snapshot(self, workers):
+        """
+        utilization is the fraction of the time since the last snapshot
+        that the workers spent processing jobs.
+        """
+        self.sample()
+        counts, histograms = self._metrics.merged()
+        busy = counts.get('busy', 0.0)
+        utilization, self._mark = self.utilization(self._mark, workers, counts)
+
+        jobs = counts.get('jobs', 0)
+        service = summarize(histograms.get('service', {}))
+        if jobs:
+            service['mean'] = busy / jobs
+        else:
+            service['mean'] = None
+        return {
+            'name': self.name,
+            'workers': workers,
+            'jobs': jobs,
+            'errors': counts.get('errors', 0),
+            'dropped': counts.get('dropped', 0),
+            'busy': busy,
+            'utilization': utilization,
+            'service_time': service,
+            'queue_depth': self.depths[-1][1],
+            'queue_depth_history': list(self.depths),
+        }
+
+def bottleneck(stages):
+    """
+    returns the name of the busiest of a list of pool stats, the one 
+    with the highest utilization or among equally utilized pools the 
+    one with the deepest queue.  None if there are no pools.
+    """
+    if not stages:
+        return None
+    busiest = max(stages, key=lambda s: (round(s['utilization'], 2),
+                                         s['queue_depth']))
+    return busiest['name']
+
 class ThreadPool:
     """
     Simple threadpool that processes
@@ -38,11 +496,27 @@ class ThreadPool:
     
     By default it is assumed that jobs are 0 argument callables,
     a job is processed by calling it.
+
+    Alternatively, use submit or map to get the result of each job
+    as a Future rather than through the output queue.
+
+    In ordered mode, results reach the output queue in the order their 
+    jobs were queued rather than as they finish.  Make each pool of a 
+    ThreadPoolChain ordered to keep a chain's output in input order.
     """
 
     def __init__(self, poolsize=None,
                  processor=None,
-                 output_queue=None):
+                 output_queue=None,
+                 maxsize=0,
+                 batch_size=1,
+                 batch_processor=None,
+                 name=None,
+                 min_workers=None,
+                 max_workers=None,
+                 input_queue=None,
+                 ordered=False,
+                 window=1000):
         """
         poolsize - the number of threads to use to process jobs, defaults to 10
         processor - an optional 1 argument function which is used to process jobs
@@ -50,48 +524,496 @@ class ThreadPool:
                     to be zero argument callables.
         output_queue - if specified, the return value of proccessing a job will be placed
                        on this output queue.
+        maxsize - if greater than 0, the most jobs the input queue holds. Putting 
+                  jobs on a full queue blocks until there is room.
+        batch_size - if greater than 1, workers take up to this many jobs from the 
+                     input queue at a time and put their results on the output queue
+                     together.  Worthwhile for many small jobs.
+        batch_processor - an optional 1 argument function which processes a list 
+                          of jobs and returns a list of results, used in place of 
+                          processor when batch_size is greater than 1.  Subclasses
+                          may implement _do_batch instead.
+        name - a name for the pool in its stats, defaults to the class name
+        min_workers, max_workers - if max_workers is given, the number of workers 
+                                   is scaled between these (min_workers defaults 
+                                   to 1) according to load, starting at poolsize.
+                                   See melk.util.autoscale.Autoscaler
+        input_queue - an optional queue to take jobs from in place of a new 
+                      TaskQueue, eg a PriorityTaskQueue, FairShareTaskQueue or
+                      WorkStealingQueue.  It must support task_done and join, 
+                      maxsize is ignored.  A pool taking from a ShardedTaskQueue
+                      has one worker per shard (poolsize defaults to this) and 
+                      cannot be resized or autoscaled.
+        ordered - if True, results are put on the output queue in the order their 
+                  jobs were queued.  Results that finish early are held back 
+                  until those before them are done.
+        window - in ordered mode, workers do not start on a job more than window 
+                 jobs ahead of the next result due, which bounds the number of 
+                 results held back.
         """
-        self.input_queue = Queue()
+        self.ordered = ordered
+        self._reorder = None
+        if ordered:
+            if input_queue is not None:
+                # the workers could all end up waiting on a job that 
+                # is stuck behind the jobs they hold
+                raise ValueError('ordered pools number jobs in their own FIFO input queue')
+            input_queue = _SequencedQueue(maxsize)
+            self._reorder = ReorderBuffer(window)
+        elif input_queue is None:
+            input_queue = Queue(maxsize)
+        self.input_queue = input_queue
         self.output_queue = output_queue
 
+        if isinstance(input_queue, ShardedTaskQueue):
+            # a worker too many waits forever for a shard, one too few 
+            # leaves a shard that is never drained
+            nshards = len(input_queue.shards)
+            if poolsize is None:
+                poolsize = nshards
+            if poolsize != nshards:
+                raise ValueError('a pool taking from %d shards needs %d workers, got %r' % 
+                                 (nshards, nshards, poolsize))
+            if max_workers is not None:
+                raise ValueError('a pool taking from shards cannot be autoscaled')
+
         if poolsize is None:
             poolsize = DEFAULT_POOLSIZE
+        self.poolsize = poolsize
  
         if processor is not None:
             self._do = processor
+        self.batch_size = batch_size
+        if batch_processor is not None:
+            self._do_batch = batch_processor
 
         self._local = threading.local()
 
         self._threads = []
-        for i in range(poolsize):
-            t = Thread(target=self._worker)
-            t.setDaemon(True)
-            self._threads.append(t)
+        self._threads_lock = threading.Lock()
+        self._running = False
+        # STOPs queued but not yet taken by a worker
+        self._pending_stops = 0
+
+        if name is None:
+            name = self.__class__.__name__
+        self.name = name
+        self.pool_stats = PoolStats(name, self.input_queue)
+
+        self.autoscaler = None
+        if max_workers is not None:
+            if min_workers is None:
+                min_workers = 1
+            self.poolsize = max(min_workers, min(max_workers, poolsize))
+            self.autoscaler = Autoscaler(self, min_workers, max_workers)
 
     def start(self):
-        for t in self._threads:
-            t.start()
+        """
+        starts poolsize worker threads.  A pool that has been shut 
+        down may be started again, one that is running may not.
+        """
+        self._threads_lock.acquire()
+        try:
+            if self._running:
+                raise RuntimeError('pool is already running')
+            for i in range(self.poolsize):
+                self._spawn()
+            self._running = True
+        finally:
+            self._threads_lock.release()
+        if self.autoscaler is not None:
+            self.autoscaler.start()
+
+    def resize(self, poolsize):
+        """
+        changes the number of worker threads.  Extra workers stop
+        once they finish the jobs queued ahead of the resize.
+        """
+        if poolsize < 1:
+            raise ValueError('poolsize must be at least 1, got %r' % poolsize)
+        if (isinstance(self.input_queue, ShardedTaskQueue) and 
+            poolsize != len(self.input_queue.shards)):
+            raise ValueError('a pool taking from shards cannot be resized')
+        self._threads_lock.acquire()
+        try:
+            delta = poolsize - self.poolsize
+            self.poolsize = poolsize
+            if not self._running:
+                return
+            for i in range(delta):
+                self._spawn()
+            if delta < 0:
+                self._pending_stops -= delta
+        finally:
+            self._threads_lock.release()
+        for i in range(-delta):
+            self.input_queue.put(STOP)
+
+    def _spawn(self):
+        # called with _threads_lock held
+        t = Thread(target=self._worker)
+        t.setDaemon(True)
+        self._threads.append(t)
+        t.start()
+        return t
+
+    def _retire(self, t):
+        # called by the retiring worker
+        unregister = getattr(self.input_queue, 'unregister', None)
+        if unregister is not None:
+            unregister()
+        self._threads_lock.acquire()
+        try:
+            self._threads.remove(t)
+            self._pending_stops -= 1
+        finally:
+            self._threads_lock.release()
+
+    @property
+    def workers(self):
+        """
+        the number of running worker threads
+        """
+        return len(self._threads)
     
     def join(self):
         self.input_queue.join()
+
+    def stats(self):
+        """
+        returns a snapshot of the pool's PoolStats as a dict.
+        """
+        return self.pool_stats.snapshot(self.workers)
+
+    def put(self, job, block=True, timeout=None):
+        """
+        places job on the input queue.  If the queue is bounded and full,
+        waits for room (for at most timeout seconds if given) unless block 
+        is False.  Raises Queue.Full if there is still no room.
+        """
+        self.input_queue.put(job, block, timeout)
+
+    def shutdown(self, wait=True, drain=True):
+        """
+        stops the worker threads once they finish the jobs they are 
+        working on.
+
+        drain - if True, the jobs already queued are processed first, 
+                otherwise they are discarded (and their futures cancelled)
+        wait - if True, blocks until the workers have stopped
+        """
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
+
+        self._threads_lock.acquire()
+        try:
+            threads = list(self._threads)
+            nstops = len(threads) - self._pending_stops
+            self._pending_stops += nstops
+            self._running = False
+        finally:
+            self._threads_lock.release()
+
+        if not drain:
+            self._discard_queued()
+        for i in range(nstops):
+            self.input_queue.put(STOP)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def _discard_queued(self):
+        stops = 0
+        while True:
+            try:
+                job = self.input_queue.get_nowait()
+            except Empty:
+                break
+            try:
+                if job is STOP:
+                    stops += 1
+                elif job.__class__ is _FutureJob:
+                    job.future.cancel()
+                elif job.__class__ is _Sequenced:
+                    self._reorder.release([job.seq], [_NO_RESULT], self.output_queue)
+                    job = job.job
+                if job.__class__ is Traced:
+                    job.trace.end('dropped')
+            finally:
+                self.input_queue.task_done()
+        # from an earlier shutdown, some worker still needs these
+        for i in range(stops):
+            self.input_queue.put(STOP)
             
 
+    def submit(self, job):
+        """
+        places job on the input queue, returns a Future for the result
+        of processing it.  The result does not go to the output queue.
+        """
+        future = Future()
+        self.input_queue.put(_FutureJob(future, None, job=job))
+        return future
+
+    def submit_call(self, fn, *args):
+        """
+        like submit, but the job is the call fn(*args) rather than 
+        something for the pool to process.
+        """
+        future = Future()
+        self.input_queue.put(_FutureJob(future, fn, args))
+        return future
+
+    def map(self, fn, iterable, chunksize=1):
+        """
+        calls fn on each item of iterable in the pool's threads, returns 
+        an iterator over the results in order.  If fn is None the items are
+        processed as jobs.  Items are sent to the workers in lists of 
+        chunksize, use a larger chunksize for many cheap calls.
+
+        all items are queued immediately, if a call raised an exception it 
+        is raised when its result is reached.
+        """
+        if fn is None:
+            fn = self._do
+        items = list(iterable)
+        futures = []
+        for i in range(0, len(items), chunksize):
+            futures.append(self.submit_call(_map_chunk, fn, items[i:i+chunksize]))
+        return self._map_results(futures)
+
+    def _map_results(self, futures):
+        for f in futures:
+            for rc in f.result():
+                yield rc
+
+    def _run_future(self, fjob):
+        if not fjob.future.set_running():
+            return
+        try:
+            if fjob.fn is None:
+                rc = self._do(fjob.job)
+            else:
+                rc = fjob.fn(*fjob.args)
+        except:
+            fjob.future.set_exception(sys.exc_info())
+        else:
+            fjob.future.set_result(rc)
+
+    def can_requeue(self):
+        """
+        True if the job being processed by the calling worker may be
+        put back on the input queue by raising Requeue.  Futures,
+        batches and jobs in ordered mode may not, nor may any job of a
+        pool whose input queue is bounded, as putting it back could 
+        block for good once the queue is refilled.
+        """
+        if getattr(self.input_queue, 'maxsize', 0) > 0:
+            return False
+        return getattr(self._local, 'requeue', False)
+
     def _worker(self):
+        if self.batch_size > 1:
+            return self._batch_worker()
         while(True):
             try:
-                job = self.input_queue.get()
+                job = item = self.input_queue.get()
+                if job is STOP:
+                    self.input_queue.task_done()
+                    self._retire(threading.currentThread())
+                    return
+                seq = None
+                if job.__class__ is _Sequenced:
+                    seq, job = job.seq, job.job
+                    self._reorder.wait_turn(seq)
+                trace = None
+                if job.__class__ is Traced:
+                    trace, job = job.trace, job.job
+                start = time.time()
+                errors = dropped = 0
+                requeue = False
                 try:
-                    rc = self._do(job)
-                    if self.output_queue is not None:
-                        self.output_queue.put(rc)
+                    if job.__class__ is _FutureJob:
+                        self._run_future(job)
+                    else:
+                        rc = _NO_RESULT
+                        self._local.requeue = seq is None
+                        try:
+                            try:
+                                rc = self._do(job)
+                            except JobDropped, e:
+                                dropped = 1
+                                log.debug("dropped %r: %s" % (job, e))
+                            except Requeue:
+                                if seq is not None:
+                                    errors = 1
+                                    raise
+                                requeue = True
+                            except:
+                                errors = 1
+                                raise
+                        finally:
+                            self._local.requeue = False
+                            if trace is not None and not requeue:
+                                rc = self._pass_trace(trace, start, rc,
+                                                      dropped and 'dropped' or 'error')
+                            if seq is not None:
+                                self._reorder.release([seq], [rc], self.output_queue)
+                        if seq is None and rc is not _NO_RESULT and self.output_queue is not None:
+                            self.output_queue.put(rc)
                 finally:
+                    if requeue:
+                        # before task_done, so a join can't slip through
+                        self.input_queue.put(item)
+                    else:
+                        self.pool_stats.record(start, time.time(), 1, errors, dropped)
                     self.input_queue.task_done()
             except:
                 log.error(traceback.format_exc())
 
+    def _batch_worker(self):
+        q = self.input_queue
+        while(True):
+            try:
+                jobs = get_many(q, self.batch_size)
+                work = [job for job in jobs if job is not STOP]
+                stops = len(jobs) - len(work)
+                seqs = [job.seq for job in work if job.__class__ is _Sequenced]
+                if seqs:
+                    self._reorder.wait_turn(min(seqs))
+                start = time.time()
+                errors = dropped = 0
+                try:
+                    try:
+                        errors, dropped = self._process_batch(work)
+                    except:
+                        errors = len(work)
+                        raise
+                finally:
+                    self.pool_stats.record(start, time.time(), len(work), errors, dropped)
+                    task_done_many(q, len(jobs))
+                if stops > 0:
+                    # one is ours, the rest belong to other workers
+                    for i in range(stops - 1):
+                        q.put(STOP)
+                    self._retire(threading.currentThread())
+                    return
+            except:
+                log.error(traceback.format_exc())
+
+    def _process_batch(self, jobs):
+        """
+        returns the number of (errors, dropped jobs)
+        """
+        if [job for job in jobs if job.__class__ is _FutureJob]:
+            self._run_future_batch([job for job in jobs if job.__class__ is _FutureJob])
+            jobs = [job for job in jobs if job.__class__ is not _FutureJob]
+        if not jobs:
+            return 0, 0
+
+        seqs = None
+        if jobs[0].__class__ is _Sequenced:
+            seqs = [job.seq for job in jobs]
+            jobs = [job.job for job in jobs]
+
+        traces = None
+        if [job for job in jobs if job.__class__ is Traced]:
+            traces = []
+            for i, job in enumerate(jobs):
+                if job.__class__ is Traced:
+                    traces.append(job.trace)
+                    jobs[i] = job.job
+                else:
+                    traces.append(None)
+
+        start = time.time()
+        errors = dropped = 0
+        # the result of each job
+        results = [_NO_RESULT] * len(jobs)
+        try:
+            if self._do_batch is not None:
+                try:
+                    rcs = list(self._do_batch(jobs))
+                except JobDropped, e:
+                    log.debug("dropped batch of %d: %s" % (len(jobs), e))
+                    dropped = len(jobs)
+                else:
+                    _check_batch_results(jobs, rcs)
+                    results = rcs
+            else:
+                for i, job in enumerate(jobs):
+                    try:
+                        results[i] = self._do(job)
+                    except JobDropped, e:
+                        dropped += 1
+                        log.debug("dropped %r: %s" % (job, e))
+                    except:
+                        errors += 1
+                        log.error(traceback.format_exc())
+        finally:
+            if traces is not None:
+                for i, trace in enumerate(traces):
+                    if trace is not None:
+                        results[i] = self._pass_trace(trace, start, results[i], 'failed')
+            if seqs is not None:
+                self._reorder.release(seqs, results, self.output_queue)
+
+        if seqs is None and self.output_queue is not None:
+            put_many(self.output_queue, [rc for rc in results if rc is not _NO_RESULT])
+        return errors, dropped
+
+    def _run_future_batch(self, fjobs):
+        if self._do_batch is None:
+            for fjob in fjobs:
+                self._run_future(fjob)
+            return
+
+        # submitted jobs are processed together by _do_batch
+        batch = []
+        for fjob in fjobs:
+            if fjob.fn is not None:
+                self._run_future(fjob)
+            elif fjob.future.set_running():
+                batch.append(fjob)
+        if not batch:
+            return
+        try:
+            results = list(self._do_batch([fjob.job for fjob in batch]))
+            _check_batch_results(batch, results)
+        except:
+            exc_info = sys.exc_info()
+            for fjob in batch:
+                fjob.future.set_exception(exc_info)
+        else:
+            for fjob, rc in zip(batch, results):
+                fjob.future.set_result(rc)
+
+    def _pass_trace(self, trace, start, rc, outcome):
+        """
+        records this stage in the trace of a job started at start, returns 
+        what to output for the job's result rc.  outcome is the outcome of 
+        the trace if there is no result.
+        """
+        trace.record(self.name, start, time.time())
+        if rc is _NO_RESULT:
+            trace.end(outcome)
+            return rc
+        if self.end_traces:
+            trace.end()
+            return rc
+        return Traced(trace, rc)
+
     def _do(self, job):
         return job()
 
+    # optionally, a method processing a list of jobs and returning
+    # a list of results, see batch_size
+    _do_batch = None
+
+    # if True, traced jobs leave this pool bare and their traces end 
+    # here, see melk.util.trace
+    end_traces = False
+
 
 class DeferredCall(object): 
     """
@@ -143,6 +1065,13 @@ class ThreadPoolChain(object):
 
         self._chain.append(threadpool)
         
+    @property
+    def stages(self):
+        """
+        the threadpools in the chain, in order
+        """
+        return list(self._chain)
+
     def _get_output_queue(self):
         if len(self._chain) > 0:
             return self._chain[-1].output_queue
@@ -158,6 +1087,38 @@ class ThreadPoolChain(object):
         for tp in self._chain:
             tp.start()
 
+    def stats(self):
+        """
+        returns {'stages': [stats of each pool in the chain], 
+                 'bottleneck': name of the busiest stage}
+
+        the bottleneck is the stage with the highest utilization, or 
+        among equally utilized stages the one with the deepest queue. 
+        """
+        stages = [tp.stats() for tp in self._chain]
+        return {'stages': stages, 'bottleneck': bottleneck(stages)}
+
+    def shutdown(self, wait=True, drain=True):
+        """
+        shuts down each threadpool in the chain, see ThreadPool.shutdown.
+        When draining, each stage is drained before the next is shut down
+        so that nothing in flight is lost, which implies waiting.  A
+        batching adapter feeding a stage is closed first, pushing the
+        items it holds.
+        """
+        queue = self.input_queue
+        for tp in self._chain:
+            if isinstance(queue, BatchingQueueInputAdapter):
+                queue.close()
+            tp.shutdown(wait=wait or drain, drain=drain)
+            queue = tp.output_queue
+
     def join(self):
+        queue = self.input_queue
         for tp in self._chain:
-            tp.join()
\ No newline at end of file
+            # push anything held by a batching adapter first
+            flush = getattr(queue, 'flush', None)
+            if flush is not None:
+                flush()
+            tp.join()
+            queue = tp.output_queue
\ No newline at end of file
@@ -0,0 +1,165 @@
+# Copyright (C) 2007 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+following individual jobs through the stages of a ThreadPoolChain.
+
+a sampled job travels in a Traced envelope carrying its Trace.  Each
+ThreadPool the envelope passes through records how long the job waited
+in its queue and how long it took to process, and wraps the result in 
+the envelope again for the next stage.  The pool marked end_traces 
+(Tracer.attach marks the last of a chain) finishes the trace and 
+outputs the bare result.
+
+jobs that are not sampled travel as they are, so when nothing is traced
+the only cost is a class check per job.
+"""
+
+from collections import deque
+import itertools
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Trace(object):
+    """
+    the history of one job.
+
+    spans - a list of (stage name, queue wait, service time) 
+    outcome - None while the job is in flight, then one of 'ok', 
+              'dropped', 'error', 'failed' (dropped or error in a batch),
+              'filtered' (by a QueueInputAdapter) or 'coalesced' (with 
+              a later job by a BatchingQueueInputAdapter)
+    """
+
+    def __init__(self, tracer, trace_id, job):
+        self.tracer = tracer
+        self.id = trace_id
+        self.job = repr(job)[:200]
+        self.started = time.time()
+        self.enqueued = self.started
+        self.finished = None
+        self.outcome = None
+        self.spans = []
+
+    def record(self, stage, start, end):
+        self.spans.append((stage, start - self.enqueued, end - start))
+
+    def end(self, outcome='ok'):
+        self.finished = time.time()
+        self.outcome = outcome
+        if self.tracer is not None:
+            self.tracer._ended(self)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def format(self):
+        lines = ['trace %s %s %0.3fs %s' % (self.id, self.job, self.elapsed,
+                                            self.outcome or 'in flight')]
+        for stage, wait, service in self.spans:
+            lines.append('  %-20s wait %0.3fs service %0.3fs' % (stage, wait, service))
+        return '\n'.join(lines)
+
+
+class Traced(object):
+    """
+    the envelope a traced job travels in between stages
+    """
+    __slots__ = ('trace', 'job')
+
+    def __init__(self, trace, job):
+        self.trace = trace
+        self.job = job
+        trace.enqueued = time.time()
+
+    def __repr__(self):
+        return '<Traced %s %r>' % (self.trace.id, self.job)
+
+
+class Tracer(object):
+    """
+    starts traces for a fraction of jobs and keeps the slow ones.
+
+    sample_rate - the fraction of jobs to trace
+    slow - traces taking at least this many seconds end to end are kept
+           (and logged) as slow traces, None to keep all of them
+    keep - the most slow traces kept, older ones are forgotten
+    """
+
+    def __init__(self, sample_rate=0.01, slow=10.0, keep=100):
+        self.sample_rate = sample_rate
+        self.slow = slow
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._slow = deque(maxlen=keep)
+        # the number of traces ended
+        self.ended = 0
+
+    def wrap(self, job):
+        """
+        returns job in a Traced envelope if it is sampled, job otherwise.
+        """
+        if job is None or random.random() >= self.sample_rate:
+            return job
+        return Traced(Trace(self, self._ids.next(), job), job)
+
+    def attach(self, chain):
+        """
+        traces a sample of the jobs put on chain's input queue until
+        they leave its last stage.  Call once the chain is assembled.
+        """
+        # imported here, taskqueue itself knows about Traced envelopes
+        from melk.util.taskqueue import QueueInputAdapter
+        chain.input_queue = QueueInputAdapter(chain.input_queue, self.wrap)
+        chain.stages[-1].end_traces = True
+
+    def _ended(self, trace):
+        self._lock.acquire()
+        try:
+            self.ended += 1
+            if self.slow is not None and trace.elapsed < self.slow:
+                return
+            self._slow.append(trace)
+        finally:
+            self._lock.release()
+        if self.slow is not None:
+            log.info("slow job:\n%s" % trace.format())
+
+    def slow_traces(self):
+        """
+        returns the slow traces kept, oldest first
+        """
+        self._lock.acquire()
+        try:
+            return list(self._slow)
+        finally:
+            self._lock.release()
+
+    def dump(self, out):
+        """
+        writes the slow traces kept to the file like out
+        """
+        for trace in self.slow_traces():
+            out.write(trace.format() + '\n')
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from melk.util.autoscale import ChainBalancer
+from melk.util.threadpool import ThreadPool, ThreadPoolChain
+from melk.util.taskqueue import TaskQueue
+
+
+def _wait_for(cond, timeout=2.0):
+    end = time.time() + timeout
+    while not cond() and time.time() < end:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_autoscaler_grows_on_backlog():
+    gate = threading.Event()
+    def blocked(job):
+        gate.wait()
+        return job
+
+    tp = ThreadPool(poolsize=1, processor=blocked, output_queue=TaskQueue(),
+                    min_workers=1, max_workers=4)
+    scaler = tp.autoscaler
+    scaler.patience = 2
+    # drive the scaler by hand rather than on its timer
+    tp.autoscaler = None
+    for i in range(20):
+        tp.input_queue.put(i)
+    tp.start()
+
+    assert scaler.check() is None
+    assert scaler.check() == 3
+    assert tp.workers == 3
+    assert scaler.check() is None
+    assert scaler.check() == 4
+    # never beyond max_workers
+    assert scaler.check() is None
+    assert scaler.check() is None
+    assert tp.poolsize == 4
+
+    gate.set()
+    tp.join()
+    assert tp.output_queue.qsize() == 20
+    tp.shutdown()
+
+
+def test_autoscaler_shrinks_when_idle():
+    tp = ThreadPool(poolsize=4, processor=lambda x: x, min_workers=2, max_workers=4)
+    scaler = tp.autoscaler
+    tp.autoscaler = None
+    scaler.patience = 2
+    tp.start()
+    time.sleep(0.01)
+    assert scaler.check() is None
+    assert scaler.check() == 3
+    assert _wait_for(lambda: tp.workers == 3)
+    assert scaler.check() is None
+    assert scaler.check() == 2
+    assert scaler.check() is None
+    assert scaler.check() is None
+    assert _wait_for(lambda: tp.workers == 2)
+    tp.shutdown()
+
+
+def test_autoscaler_thread():
+    gate = threading.Event()
+    def blocked(job):
+        gate.wait()
+        return job
+    tp = ThreadPool(poolsize=1, processor=blocked, max_workers=3)
+    tp.autoscaler.interval = 0.01
+    tp.autoscaler.patience = 1
+    for i in range(10):
+        tp.input_queue.put(i)
+    tp.start()
+    assert _wait_for(lambda: tp.workers == 3)
+    gate.set()
+    tp.join()
+    tp.shutdown()
+    assert tp.workers == 0
+
+
+def test_chain_balancer():
+    gate = threading.Event()
+    def blocked(job):
+        gate.wait()
+        return job
+
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(poolsize=3, processor=lambda x: x, name='fetch'))
+    chain.append(ThreadPool(poolsize=1, processor=blocked, output_queue=TaskQueue(),
+                            name='parse'))
+    fetch, parse = chain.stages
+    balancer = ChainBalancer(chain, patience=2)
+    for i in range(20):
+        chain.input_queue.put(i)
+    chain.start()
+    assert _wait_for(lambda: fetch.input_queue.qsize() == 0)
+
+    assert balancer.check() is None
+    assert balancer.check() == (fetch, parse)
+    assert fetch.poolsize == 2
+    assert parse.workers == 2
+    assert balancer.check() is None
+    assert balancer.check() == (fetch, parse)
+    # fetch is down to its last worker
+    assert balancer.check() is None
+    assert balancer.check() is None
+    assert fetch.poolsize == 1
+    assert parse.poolsize == 3
+
+    gate.set()
+    chain.join()
+    assert chain.output_queue.qsize() == 20
+    chain.shutdown()
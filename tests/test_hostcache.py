@@ -0,0 +1,192 @@
+import threading
+import time
+from httplib2 import Response
+from melk.util.hostcache import HostCache, parse_crawl_delay
+from melk.util.spider import Spider, SpiderJob, RobotsDisallowed
+from melk.util.taskqueue import TaskQueue
+
+ROBOTS = """
+User-agent: otherbot
+Disallow: /
+Crawl-delay: 30
+
+User-agent: *
+Disallow: /private
+Crawl-delay: 0.05
+"""
+
+class RobotsHttp:
+    def __init__(self, robots, delay=0):
+        self.robots = robots
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, url, method="GET"):
+        self._lock.acquire()
+        self.requests.append(url)
+        self._lock.release()
+        if url.endswith('/robots.txt'):
+            time.sleep(self.delay)
+            if self.robots is None:
+                return Response({'status': '404'}), 'not found'
+            return Response({'status': '200'}), self.robots
+        return Response({'status': '200'}), 'content of %s' % url
+
+
+def test_parse_crawl_delay():
+    lines = ROBOTS.splitlines()
+    assert parse_crawl_delay(lines, 'melkjug') == 0.05
+    assert parse_crawl_delay(lines, 'OtherBot/1.0') == 30
+    assert parse_crawl_delay([], 'melkjug') is None
+
+
+def test_host_cache_single_flight():
+    http = RobotsHttp(ROBOTS, delay=0.1)
+    cache = HostCache()
+    infos = []
+    def lookup():
+        infos.append(cache.get('example.com', http))
+
+    threads = [threading.Thread(target=lookup) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert http.requests == ['http://example.com/robots.txt']
+    assert len(infos) == 10
+    for info in infos:
+        assert info is infos[0]
+    assert infos[0].crawl_delay == 0.05
+    assert not infos[0].allowed('http://example.com/private/x', 'melkjug')
+    assert infos[0].allowed('http://example.com/public', 'melkjug')
+
+
+def test_host_cache_ttl():
+    http = RobotsHttp(None)
+    cache = HostCache(ttl=0.05)
+    info = cache.get('example.com', http)
+    assert info.robots is None
+    assert cache.get('example.com', http) is info
+    time.sleep(0.06)
+    assert cache.get('example.com', http) is not info
+    assert len(http.requests) == 2
+
+
+def test_spider_robots():
+    http = RobotsHttp(ROBOTS)
+
+    class RobotsSpider(Spider):
+        def _make_http_client(self):
+            return http
+
+    spider = RobotsSpider(host_cache=HostCache(), poolsize=4, output_queue=TaskQueue())
+    for path in ['/a', '/b', '/c', '/private/d']:
+        spider.input_queue.put(SpiderJob('http://example.com' + path))
+    start = time.time()
+    spider.start()
+    spider.join()
+
+    # three fetches spaced by the crawl delay
+    assert time.time() - start >= 0.1
+    assert http.requests.count('http://example.com/robots.txt') == 1
+    assert 'http://example.com/private/d' not in http.requests
+    results = [spider.output_queue.get() for i in range(4)]
+    forbidden = [r for r in results if isinstance(r.error, RobotsDisallowed)]
+    assert len(forbidden) == 1
+    assert forbidden[0].response.status == 403
+
+
+def test_host_cache_timeouts_are_not_cached_long():
+    class TimeoutHttp:
+        def request(self, url, method="GET"):
+            return Response({'status': '408'}), 'timed out'
+    cache = HostCache(ttl=3600, error_ttl=0.01)
+    info = cache.get('example.com', TimeoutHttp())
+    time.sleep(0.02)
+    assert cache.get('example.com', TimeoutHttp()) is not info
+
+
+def test_spider_crawl_delay_does_not_hold_up_other_hosts():
+    http = RobotsHttp(None)
+    # only slow.example.com has a long crawl delay
+    def request(url, method="GET"):
+        if url == 'http://slow.example.com/robots.txt':
+            http.requests.append(url)
+            return Response({'status': '200'}), 'User-agent: *\nCrawl-delay: 0.2\n'
+        return RobotsHttp.request(http, url, method)
+
+    class RobotsSpider(Spider):
+        def _make_http_client(self):
+            return http
+    http.request = request
+
+    spider = RobotsSpider(host_cache=HostCache(), poolsize=1, output_queue=TaskQueue())
+    urls = ['http://slow.example.com/a', 'http://slow.example.com/b'] + \
+           ['http://fast.example.com/%d' % i for i in range(3)]
+    for url in urls:
+        spider.input_queue.put(SpiderJob(url))
+    start = time.time()
+    spider.start()
+    spider.join()
+
+    assert time.time() - start >= 0.2
+    fetched = [url for url in http.requests if not url.endswith('robots.txt')]
+    assert sorted(fetched) == sorted(urls)
+    # the fast host's jobs went ahead while slow.example.com waited
+    assert fetched.index('http://slow.example.com/b') == 4
+    assert spider.output_queue.qsize() == 5
+
+
+def test_spider_crawl_delay_with_bounded_queue():
+    http = RobotsHttp('User-agent: *\nCrawl-delay: 0.05\n')
+
+    class RobotsSpider(Spider):
+        def _make_http_client(self):
+            return http
+
+    spider = RobotsSpider(host_cache=HostCache(), poolsize=2, maxsize=2,
+                          output_queue=TaskQueue())
+    spider.start()
+    def produce():
+        for i in range(10):
+            spider.input_queue.put(SpiderJob('http://example.com/%d' % i))
+    producer = threading.Thread(target=produce)
+    producer.setDaemon(True)
+    producer.start()
+    # workers wait their turn rather than putting jobs back on the
+    # full queue, which could block them for good
+    producer.join(5)
+    assert not producer.isAlive()
+    spider.join()
+    assert spider.output_queue.qsize() == 10
+    spider.shutdown()
+
+
+def test_spider_robots_do_not_strand_circuit_trial():
+    from melk.util.spider import CircuitBreaker, CircuitOpen
+    http = RobotsHttp(ROBOTS)
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+
+    class RobotsSpider(Spider):
+        def _make_http_client(self):
+            return http
+
+    spider = RobotsSpider(host_cache=HostCache(), breaker=breaker, poolsize=1,
+                          output_queue=TaskQueue())
+    # robots.txt is fetched before the circuit opens
+    spider.input_queue.put(SpiderJob('http://example.com/ok'))
+    spider.start()
+    spider.join()
+    breaker.record('example.com', 504)
+    time.sleep(0.06)
+    # a url forbidden by robots.txt takes no trial, the next job does
+    spider.input_queue.put(SpiderJob('http://example.com/private/x'))
+    spider.input_queue.put(SpiderJob('http://example.com/ok2'))
+    spider.join()
+    results = [spider.output_queue.get() for i in range(3)]
+    assert isinstance(results[1].error, RobotsDisallowed)
+    assert results[2].error is None
+    assert breaker.state('example.com') == CircuitBreaker.CLOSED
+    spider.shutdown()
@@ -0,0 +1,41 @@
+import threading
+from melk.util.metrics import Metrics, percentile, summarize
+
+
+def test_metrics_merge_threads():
+    m = Metrics()
+
+    def record():
+        for i in range(1000):
+            m.incr('hits')
+            m.observe('latency', 0.01)
+
+    threads = [threading.Thread(target=record) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    counts, histograms = m.merged()
+    assert counts['hits'] == 4000
+    assert sum(histograms['latency'].values()) == 4000
+
+    m.reset()
+    counts, histograms = m.merged()
+    assert counts == {}
+
+
+def test_percentiles():
+    m = Metrics()
+    for i in range(1, 101):
+        m.observe('latency', i / 100.0)
+    counts, histograms = m.merged()
+    buckets = histograms['latency']
+
+    # buckets are accurate to about 10%
+    assert 0.5 <= percentile(buckets, 0.5) <= 0.55
+    assert 0.99 <= percentile(buckets, 0.99) <= 1.1
+    summary = summarize(buckets)
+    assert summary['count'] == 100
+    assert summary['p90'] >= summary['p50']
+    assert percentile({}, 0.5) is None
@@ -0,0 +1,140 @@
+import random
+
+from melk.util.nldict import nldict
+
+
+class Recorder(object):
+    def __init__(self):
+        self.deleted = []
+        self.set = []
+
+    def mapping_deleted(self, map, key, val):
+        self.deleted.append((key, val))
+
+    def mapping_set(self, map, key, val):
+        self.set.append((key, val))
+
+
+class BatchRecorder(Recorder):
+    def __init__(self):
+        Recorder.__init__(self)
+        self.batches = 0
+
+    def mapping_updated(self, map, deleted, set):
+        self.batches += 1
+        self.deleted.extend(deleted)
+        self.set.extend(set)
+
+
+def one_at_a_time(d, pairs):
+    for k, v in pairs:
+        d[k] = v
+
+
+def test_bulk_update_matches_one_at_a_time():
+    rand = random.Random(0)
+    for trial in range(200):
+        maxlen = rand.randint(1, 20)
+        # few distinct values so there are plenty of ties
+        before = [(k, rand.randint(0, 10)) for k in range(rand.randint(0, 30))]
+        pairs = [(k, rand.randint(0, 10)) for k in range(100, 100 + rand.randint(0, 60))]
+        rand.shuffle(pairs)
+
+        bulk = nldict(maxlen, None, before)
+        single = nldict(maxlen, None)
+        one_at_a_time(single, before)
+        assert bulk == single
+        bulk.update(pairs)
+        one_at_a_time(single, pairs)
+        assert bulk == single
+
+        # and they go on evicting the same mappings
+        while single:
+            assert bulk.popitem() == single.popitem()
+
+
+def test_bulk_update_notifies_once():
+    d = nldict(3, None, a=1, b=2)
+    batch = BatchRecorder()
+    items = Recorder()
+    d.observers.extend([batch, items])
+    d.update([('c', 0), ('d', 3), ('e', 4), ('f', 5)])
+    assert sorted(d) == ['d', 'e', 'f']
+    assert batch.batches == 1
+    for recorder in (batch, items):
+        # c and d were never kept, so they are not reported
+        assert sorted(recorder.deleted) == [('a', 1), ('b', 2)]
+        assert sorted(recorder.set) == [('d', 3), ('e', 4), ('f', 5)]
+
+
+def test_update_with_existing_keys():
+    d = nldict(2, None, a=1, b=2)
+    d.update([('a', 5), ('c', 3), ('c', 0)])
+    assert sorted(d.items()) == [('a', 5), ('c', 0)]
+
+
+def test_sorted_views():
+    rand = random.Random(1)
+    for maxlen in (None, 10):
+        d = nldict(maxlen, lambda v: -v)
+        d.update((k, rand.randint(0, 5)) for k in range(20))
+        expected = sorted(d.items(), key=lambda kv: kv[1])
+        if maxlen is not None:
+            # ties are in insertion order
+            assert d.top(20) == expected
+        assert [v for k, v in d.top(3)] == [v for k, v in expected[:3]]
+        assert d.slice(2, 3) == d.top(5)[2:]
+        assert list(d.iter_sorted(reverse=False)) == d.top(20)[::-1]
+
+        # changes are seen, including from within notifications
+        seen = []
+        class Observer(object):
+            def mapping_set(self, map, key, val):
+                seen.append(map.top(1))
+        d.observers.append(Observer())
+        d['new'] = -1
+        assert d.top(1) == seen[-1] == [('new', -1)]
+        del d['new']
+        assert d.top(1) != [('new', -1)]
+        d.sortkey = None
+        assert d.top(1)[0][1] == max(d.values())
+        try:
+            d.top(-1)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+
+def test_sorted_views_during_eviction():
+    d = nldict(2, None, a=1, b=2)
+    seen = []
+    class Observer(object):
+        def mapping_deleted(self, map, key, val):
+            seen.append((key, map.top(5)))
+        def mapping_set(self, map, key, val):
+            seen.append((key, map.top(5)))
+    d.observers.append(Observer())
+    d['c'] = 3
+    # the mappings have all changed by the time observers hear of it
+    assert seen == [('a', [('c', 3), ('b', 2)]), ('c', [('c', 3), ('b', 2)])]
+    d['b'] = 4
+    assert seen[-1] == ('b', [('b', 4), ('c', 3)])
+    assert sorted(d.items()) == [('b', 4), ('c', 3)]
+
+
+def test_sorted_views_after_clear():
+    for maxlen in (None, 10):
+        d = nldict(maxlen, None, a=1, b=2)
+        seen = []
+        class Observer(object):
+            def mapping_deleted(self, map, key, val):
+                seen.append(map.top(5))
+        d.observers.append(Observer())
+        d.clear()
+        # observers see the mappings being cleared
+        assert seen == [[('b', 2), ('a', 1)]] * 2
+        assert len(d) == 0
+        assert d.top(5) == []
+        d['c'] = 3
+        assert d.top(5) == [('c', 3)]
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+from melk.util.persistqueue import PersistentTaskQueue
+from melk.util.taskqueue import TaskQueue, Sentinel, get_many, put_many, task_done_many
+from melk.util.threadpool import ThreadPool
+
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+
+def test_persistent_queue_recovery():
+    path = os.path.join(tmpdir, 'recovery.db')
+    q = PersistentTaskQueue(path, prefetch=3)
+    put_many(q, [{'url': 'http://example.com/%d' % i} for i in range(10)])
+    q.put({'url': 'last'})
+    assert q.qsize() == 11
+    assert q.get() == {'url': 'http://example.com/0'}
+    q.task_done()
+    jobs = get_many(q, 4)
+    assert [j['url'][-1] for j in jobs] == ['1', '2', '3', '4']
+    # 1 and 2 done, 3 and 4 in progress when we "crash"
+    task_done_many(q, 2)
+    assert q.unfinished_tasks == 8
+    q.close()
+
+    q = PersistentTaskQueue(path)
+    assert q.qsize() == 8
+    assert q.unfinished_tasks == 8
+    rest = get_many(q, 10)
+    assert [j['url'][-1] for j in rest] == ['3', '4', '5', '6', '7', '8', '9', 't']
+    task_done_many(q, 8)
+    q.join()
+    q.close()
+
+    q = PersistentTaskQueue(path)
+    assert q.qsize() == 0
+    q.close()
+
+
+def test_persistent_queue_limits():
+    from Queue import Empty, Full
+    q = PersistentTaskQueue(os.path.join(tmpdir, 'limits.db'), maxsize=2,
+                            sync_interval=None)
+    stop = Sentinel('stop')
+    q.put(1)
+    q.put(stop)
+    q.put(2)
+    try:
+        q.put(3, timeout=0.01)
+    except Full:
+        pass
+    else:
+        assert False
+    assert [q.get(), q.get(), q.get()] == [1, 2, stop]
+    try:
+        q.get(timeout=0.01)
+    except Empty:
+        pass
+    else:
+        assert False
+    task_done_many(q, 3)
+    try:
+        q.task_done()
+    except ValueError:
+        pass
+    else:
+        assert False
+    q.close()
+
+
+def test_persistent_queue_pool():
+    path = os.path.join(tmpdir, 'pool.db')
+    tp = ThreadPool(poolsize=4, processor=lambda x: x * 2, output_queue=TaskQueue(),
+                    input_queue=PersistentTaskQueue(path, sync_every=50))
+    for i in range(200):
+        tp.put(i)
+    tp.start()
+    tp.join()
+    tp.shutdown()
+    assert sorted(get_many(tp.output_queue, 1000)) == range(0, 400, 2)
+    tp.input_queue.close()
+
+    q = PersistentTaskQueue(path)
+    assert q.qsize() == 0
+    q.close()
@@ -0,0 +1,152 @@
+from melk.util.pipeline import Pipeline
+from melk.util.threadpool import ThreadPool
+from melk.util.taskqueue import TaskQueue
+
+
+def drain(q):
+    items = []
+    while q.qsize() > 0:
+        items.append(q.get())
+    return items
+
+
+def test_pipeline_fan_out_fan_in():
+    import time
+    def fetch(url):
+        if url.endswith('.rss'):
+            return ('rss', url)
+        if url.endswith('.html'):
+            return ('html', url)
+        return ('other', url)
+    def parse_rss(doc):
+        time.sleep(0.001)
+        return 'feed:' + doc[1]
+    def parse_html(doc):
+        return 'page:' + doc[1]
+
+    p = Pipeline()
+    p.add('fetch', ThreadPool(4, fetch))
+    p.add('rss', ThreadPool(2, parse_rss))
+    p.add('html', ThreadPool(2, parse_html))
+    p.add('store', ThreadPool(2, lambda x: x))
+    p.add('audit', ThreadPool(1, lambda doc: doc[1]))
+    p.connect('fetch', 'rss', when=lambda doc: doc[0] == 'rss')
+    p.connect('fetch', 'html', when=lambda doc: doc[0] == 'html')
+    p.connect('fetch', 'audit', broadcast=True)
+    p.connect('rss', 'store')
+    p.connect('html', 'store')
+
+    assert p.sources == ['fetch']
+    assert p.sinks == ['store', 'audit']
+    stages = p.stages
+    assert stages.index(p.stage('store')) > stages.index(p.stage('rss'))
+    assert stages.index(p.stage('store')) > stages.index(p.stage('html'))
+
+    p.output_queue = TaskQueue()
+    urls = ['a%d.rss' % i for i in range(20)] + ['b%d.html' % i for i in range(20)] + ['c.txt']
+    for url in urls:
+        p.put(url)
+    p.start()
+    p.join()
+
+    outputs = drain(p.output_queue)
+    stored = sorted(o for o in outputs if ':' in o)
+    audited = sorted(o for o in outputs if ':' not in o)
+    assert stored == sorted(['feed:a%d.rss' % i for i in range(20)] +
+                            ['page:b%d.html' % i for i in range(20)])
+    assert audited == sorted(urls)
+    # c.txt only went to the broadcast edge
+    assert p.stage('fetch').output_queue.unrouted == 0
+
+    stats = p.stats()
+    assert len(stats['stages']) == 5
+    assert stats['stages'][0]['name'] == 'fetch'
+    assert stats['stages'][0]['jobs'] == 41
+    p.shutdown()
+    assert p.stage('store').workers == 0
+
+
+def test_pipeline_shutdown_pushes_held_items():
+    from melk.util.taskqueue import BatchingQueueInputAdapter
+    p = Pipeline()
+    p.add('fetch', ThreadPool(2, lambda x: x))
+    store = ThreadPool(2, lambda x: x, output_queue=TaskQueue())
+    p.add('store', store, BatchingQueueInputAdapter(store.input_queue,
+                                                    batch_size=1000, window=60))
+    p.connect('fetch', 'store')
+    p.start()
+    for i in range(10):
+        p.put(i)
+    p.shutdown()
+    assert sorted(drain(store.output_queue)) == range(10)
+    assert store.workers == 0
+
+
+def test_pipeline_unrouted_and_cycles():
+    p = Pipeline()
+    p.add('a', ThreadPool(1, lambda x: x))
+    p.add('b', ThreadPool(1, lambda x: x, output_queue=TaskQueue()))
+    p.connect('a', 'b', when=lambda x: x > 0)
+    for bad in (('b', 'a'), ('a', 'a')):
+        try:
+            p.connect(*bad)
+        except ValueError:
+            pass
+        else:
+            assert False, 'connected %r' % (bad,)
+
+    for i in range(-2, 3):
+        p.put(i)
+    p.start()
+    p.join()
+    assert sorted(drain(p.output_queue)) == [1, 2]
+    assert p.stage('a').output_queue.unrouted == 3
+    p.shutdown()
+
+
+def test_pipeline_adapted_stage():
+    from melk.util.taskqueue import QueueInputAdapter
+    p = Pipeline()
+    p.add('fetch', ThreadPool(2, lambda x: x))
+    store = ThreadPool(2, lambda x: x, output_queue=TaskQueue())
+    p.add('store', store, QueueInputAdapter(store.input_queue, lambda x: x * 2))
+    p.connect('fetch', 'store')
+    p.start()
+    for i in range(10):
+        p.put(i)
+    p.join()
+    assert sorted(drain(store.output_queue)) == range(0, 20, 2)
+    p.shutdown()
+
+
+def test_router_put_passes_block_and_timeout():
+    import threading
+    from Queue import Full
+    from melk.util.pipeline import Router
+    router = Router()
+    full = TaskQueue(1)
+    full.put('x')
+    router.add(full)
+    try:
+        router.put('y', timeout=0.01)
+        assert False, 'expected Full'
+    except Full:
+        pass
+    try:
+        router.put('y', False)
+        assert False, 'expected Full'
+    except Full:
+        pass
+
+    # unrouted is counted exactly from many threads
+    router = Router()
+    router.add(TaskQueue(), lambda x: False)
+    def put():
+        for i in range(1000):
+            router.put(i)
+    threads = [threading.Thread(target=put) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert router.unrouted == 8000
@@ -0,0 +1,104 @@
+import os
+from melk.util.processpool import ProcessPool
+from melk.util.threadpool import ThreadPool, ThreadPoolChain
+from melk.util.taskqueue import TaskQueue
+
+
+def square(x):
+    return x * x
+
+def pid_of(x):
+    return os.getpid()
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError(x)
+    return x
+
+def die_on_three(x):
+    if x == 3:
+        os._exit(1)
+    return x
+
+
+def test_processpool():
+    pp = ProcessPool(poolsize=2, processor=square, output_queue=TaskQueue(), chunksize=4)
+    for i in range(50):
+        pp.input_queue.put(i)
+    pp.start()
+    pp.join()
+    assert sorted(pp.output_queue.get() for i in range(50)) == [i * i for i in range(50)]
+    assert pp.output_queue.qsize() == 0
+
+    # errors are logged, other results still arrive
+    pp.processor = fail_on_three
+    for i in range(5):
+        pp.input_queue.put(i)
+    pp.join()
+    assert sorted(pp.output_queue.get() for i in range(4)) == [0, 1, 2, 4]
+    pp.shutdown()
+
+
+def test_processpool_child_dies():
+    pp = ProcessPool(poolsize=2, processor=die_on_three, output_queue=TaskQueue(),
+                     chunksize=1, crash_grace=0.1)
+    for i in range(6):
+        pp.input_queue.put(i)
+    pp.start()
+    # returns rather than waiting for the lost job forever
+    pp.join()
+    assert sorted(pp.output_queue.get() for i in range(5)) == [0, 1, 2, 4, 5]
+    assert pp.stats()['errors'] == 1
+    pp.shutdown()
+
+
+def test_processpool_recycling():
+    pp = ProcessPool(poolsize=1, processor=pid_of, output_queue=TaskQueue(),
+                     chunksize=1, jobs_per_child=2)
+    for i in range(6):
+        pp.input_queue.put(i)
+    pp.start()
+    pp.join()
+    pids = set(pp.output_queue.get() for i in range(6))
+    assert len(pids) == 3
+    assert os.getpid() not in pids
+    pp.shutdown()
+
+
+def test_processpool_in_chain():
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(poolsize=2, processor=lambda x: x + 1))
+    chain.append(ProcessPool(poolsize=2, processor=square))
+    chain.append(ThreadPool(poolsize=2, processor=lambda x: -x, output_queue=TaskQueue()))
+    for i in range(20):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+    assert sorted(chain.output_queue.get() for i in range(20)) == \
+           sorted(-(i + 1) ** 2 for i in range(20))
+    chain.shutdown()
+
+
+def test_processpool_traced():
+    from melk.util.trace import Tracer
+    chain = ThreadPoolChain()
+    chain.append(ProcessPool(poolsize=2, processor=fail_on_three, chunksize=4, name='work'))
+    chain.append(ThreadPool(poolsize=2, processor=lambda x: x, output_queue=TaskQueue(),
+                            name='store'))
+    tracer = Tracer(sample_rate=1.0, slow=None)
+    tracer.attach(chain)
+    for i in range(10):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+    assert sorted(chain.output_queue.get() for i in range(9)) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    traces = tracer.slow_traces()
+    assert len(traces) == 10
+    for trace in traces:
+        if trace.job == '3':
+            assert trace.outcome == 'failed'
+            assert [span[0] for span in trace.spans] == ['work']
+        else:
+            assert trace.outcome == 'ok'
+            assert [span[0] for span in trace.spans] == ['work', 'store']
+    chain.shutdown()
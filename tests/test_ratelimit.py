@@ -0,0 +1,87 @@
+import threading
+import time
+from melk.util.ratelimit import TokenBucket, RateLimiter
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100, capacity=10)
+    # the initial burst is free up to capacity...
+    assert bucket.reserve(0) == 0
+    for i in range(10):
+        assert bucket.reserve(1) == 0
+    # ...then takers wait their turn
+    assert 0 < bucket.reserve(1) <= 0.011
+    assert 0.01 < bucket.reserve(1) <= 0.021
+
+    bucket.set_rate(None)
+    assert bucket.reserve(1000) == 0
+
+
+def test_token_bucket_threads():
+    bucket = TokenBucket(200, capacity=1)
+    start = time.time()
+
+    def take():
+        for i in range(10):
+            bucket.consume(1)
+
+    threads = [threading.Thread(target=take) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 80 tokens at 200/s
+    assert time.time() - start >= 0.35
+
+
+def test_rate_limiter_bytes():
+    limiter = RateLimiter(bytes_per_second=1000)
+    assert limiter.acquire('a') == 0
+    limiter.charge('a', 2000)
+    # pays off the 2000 - 1000 byte debt
+    wait = limiter.acquire('b')
+    assert 0.9 < wait <= 1.01
+
+    limiter.set_limits(bytes_per_second=None)
+    limiter.charge('a', 1e9)
+    assert limiter.acquire('a') == 0
+
+
+def test_rate_limiter_per_host():
+    limiter = RateLimiter(host_requests_per_second=10)
+    limiter.set_limits(host_requests_per_second=100)
+    for i in range(100):
+        assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    assert limiter.acquire('b') == 0
+
+
+def test_set_rate_keeps_capacity():
+    bucket = TokenBucket(100, capacity=10)
+    bucket.set_rate(1000)
+    assert bucket.capacity == 10
+    bucket.set_rate(1000, capacity=50)
+    assert bucket.capacity == 50
+    # without a capacity given it follows the rate
+    bucket = TokenBucket(100)
+    bucket.set_rate(1000)
+    assert bucket.capacity == 1000
+
+    limiter = RateLimiter(requests_per_second=10)
+    limiter.requests.set_rate(10, capacity=2)
+    limiter.set_limits(requests_per_second=20)
+    assert limiter.requests.capacity == 2
+
+
+def test_rate_limiter_drops_idle_hosts():
+    limiter = RateLimiter(host_requests_per_second=100, max_hosts=10)
+    # a busy host is kept
+    for i in range(101):
+        limiter.acquire('busy')
+    for i in range(20):
+        limiter.acquire('host%d' % i)
+    time.sleep(0.05)
+    for i in range(20, 40):
+        limiter.acquire('host%d' % i)
+    assert len(limiter._hosts) <= 21
+    assert 'busy' in limiter._hosts
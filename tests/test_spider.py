@@ -0,0 +1,242 @@
+from httplib2 import Response
+from melk.util.spider import Spider, SpiderJob, RetryPolicy, CircuitBreaker, CircuitOpen
+from melk.util.taskqueue import TaskQueue
+
+
+class FakeHttp:
+    """
+    stands in for an httplib2 client, answers with the status 
+    given for the host of the requested url.
+    """
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requests = []
+
+    def request(self, url, method="GET"):
+        self.requests.append(url)
+        host = url.split('/')[2]
+        response = Response({'status': str(self.statuses.get(host, 200))})
+        return response, 'content of %s' % url
+
+
+class FakeSpider(Spider):
+    def __init__(self, http, **kw):
+        Spider.__init__(self, poolsize=1, output_queue=TaskQueue(), **kw)
+        self.http = http
+
+    def _make_http_client(self):
+        return self.http
+
+
+def test_retry_policy():
+    retry = RetryPolicy(max_retries=2, base_delay=1.0, max_delay=3.0, jitter=0.5)
+    assert retry.should_retry(503, 0)
+    assert retry.should_retry(408, 1)
+    assert not retry.should_retry(503, 2)
+    assert not retry.should_retry(404, 0)
+    for attempt, top in [(0, 1.0), (1, 2.0), (2, 3.0), (5, 3.0)]:
+        delay = retry.delay(attempt)
+        assert top / 2 <= delay <= top
+
+
+def test_spider_retries():
+    http = FakeHttp({'dead.example.com': 503})
+    spider = FakeSpider(http, retry=RetryPolicy(max_retries=2, base_delay=0.001))
+    spider.input_queue.put(SpiderJob('http://dead.example.com/feed'))
+    spider.input_queue.put(SpiderJob('http://ok.example.com/feed'))
+    spider.start()
+    spider.join()
+
+    assert http.requests.count('http://dead.example.com/feed') == 3
+    assert http.requests.count('http://ok.example.com/feed') == 1
+    assert spider.output_queue.qsize() == 2
+
+
+def test_spider_retry_backoff_does_not_hold_up_other_jobs():
+    import time
+    http = FakeHttp({'dead.example.com': 503})
+    spider = FakeSpider(http, retry=RetryPolicy(max_retries=1, base_delay=0.2, jitter=0))
+    spider.input_queue.put(SpiderJob('http://dead.example.com/feed'))
+    for i in range(3):
+        spider.input_queue.put(SpiderJob('http://ok.example.com/%d' % i))
+    start = time.time()
+    spider.start()
+    spider.join()
+
+    assert time.time() - start >= 0.2
+    # the one worker fetched the others while the retry backed off
+    assert http.requests == ['http://dead.example.com/feed'] + \
+        ['http://ok.example.com/%d' % i for i in range(3)] + \
+        ['http://dead.example.com/feed']
+    assert spider.output_queue.qsize() == 4
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    assert breaker.allow('a')
+    assert not breaker.record('a', 408)
+    assert breaker.record('a', 408)
+    assert breaker.state('a') == CircuitBreaker.OPEN
+    assert not breaker.allow('a')
+    assert breaker.allow('b')
+
+    import time
+    time.sleep(0.06)
+    # one trial request goes through, the failure reopens the circuit
+    assert breaker.allow('a')
+    assert not breaker.allow('a')
+    assert breaker.record('a', 408)
+    time.sleep(0.06)
+    assert breaker.allow('a')
+    breaker.record('a', 200)
+    assert breaker.state('a') == CircuitBreaker.CLOSED
+    assert breaker.trips == 2
+
+    # a trial abandoned, or never recorded, gives way to another
+    breaker.record('a', 408)
+    assert breaker.record('a', 408)
+    time.sleep(0.06)
+    assert breaker.allow('a')
+    breaker.abandon('a')
+    assert breaker.allow('a')
+    assert not breaker.allow('a')
+    time.sleep(0.06)
+    assert breaker.allow('a')
+
+
+def test_spider_circuit_breaker():
+    http = FakeHttp({'dead.example.com': 408})
+    spider = FakeSpider(http, breaker=CircuitBreaker(threshold=2, cooldown=60))
+    for i in range(5):
+        spider.input_queue.put(SpiderJob('http://dead.example.com/%d' % i))
+    spider.start()
+    spider.join()
+
+    assert len(http.requests) == 2
+    results = []
+    while spider.output_queue.qsize() > 0:
+        results.append(spider.output_queue.get())
+    assert len(results) == 5
+    skipped = [r for r in results if isinstance(r.error, CircuitOpen)]
+    assert len(skipped) == 3
+    assert skipped[0].response.status == 503
+
+
+def test_spider_metrics():
+    http = FakeHttp({'dead.example.com': 408})
+    spider = FakeSpider(http, breaker=CircuitBreaker(threshold=1, cooldown=60))
+    spider.input_queue.put(SpiderJob('http://dead.example.com/a'))
+    spider.input_queue.put(SpiderJob('http://dead.example.com/b'))
+    for i in range(3):
+        spider.input_queue.put(SpiderJob('http://ok.example.com/%d' % i))
+    spider.start()
+    spider.join()
+
+    stats = spider.metrics.snapshot()
+    assert stats['fetches'] == 4
+    assert stats['status'] == {200: 3, 408: 1}
+    assert stats['events'] == {'circuit_trip': 1, 'circuit_open': 1}
+    assert stats['bytes'] == sum(len('content of http://ok.example.com/%d' % i) for i in range(3)) + \
+                             len('content of http://dead.example.com/a')
+    assert stats['cache_hit_rate'] == 0.0
+    assert stats['latency']['count'] == 4
+    assert stats['hosts']['ok.example.com']['fetches'] == 3
+    assert stats['hosts']['dead.example.com']['events']['circuit_open'] == 1
+
+
+def test_spider_compress_and_spool():
+    http = FakeHttp({})
+    spider = FakeSpider(http, compress_threshold=40, spool_threshold=50)
+    urls = ['http://a.example.com/',
+            'http://a.example.com/' + 'x' * 10,
+            'http://a.example.com/' + 'x' * 30]
+    for url in urls:
+        spider.input_queue.put(SpiderJob(url))
+    spider.start()
+    spider.join()
+
+    results = {}
+    while spider.output_queue.qsize() > 0:
+        r = spider.output_queue.get()
+        results[r.url] = r
+    for url in urls:
+        assert results[url].content == 'content of %s' % url
+        assert results[url].open_content().read() == 'content of %s' % url
+    assert results[urls[0]]._body is None
+    assert results[urls[1]]._body.__class__.__name__ == 'CompressedBody'
+    assert results[urls[2]]._body.__class__.__name__ == 'SpooledBody'
+
+
+def test_spider_spooled_bodies_are_budgeted():
+    http = FakeHttp({})
+    spider = FakeSpider(http, spool_threshold=10, max_inflight_bytes=1000)
+    url = 'http://a.example.com/' + 'x' * 30
+    spider.input_queue.put(SpiderJob(url))
+    spider.start()
+    spider.join()
+    result = spider.output_queue.get()
+    assert result._body.__class__.__name__ == 'SpooledBody'
+    assert spider.budget.used == len('content of %s' % url)
+    result.release()
+    assert spider.budget.used == 0
+
+
+def test_spider_inflight_bytes():
+    import threading
+    http = FakeHttp({})
+    spider = FakeSpider(http, max_inflight_bytes=100)
+    for i in range(10):
+        spider.input_queue.put(SpiderJob('http://a.example.com/%030d' % i))
+
+    spider.start()
+    # each body is 62 bytes, so once one is held another won't fit
+    done = threading.Event()
+    def waiter():
+        spider.join()
+        done.set()
+    threading.Thread(target=waiter).start()
+    done.wait(0.2)
+    assert not done.isSet()
+    assert len(http.requests) == 1
+    assert spider.budget.used == 62
+
+    # consuming results lets fetching continue
+    while not done.isSet():
+        spider.output_queue.get().release()
+        done.wait(0.01)
+    while spider.output_queue.qsize() > 0:
+        spider.output_queue.get().release()
+    assert len(http.requests) == 10
+    assert spider.budget.used == 0
+    assert spider.metrics.snapshot()['events']['stalled'] > 0
+
+
+def test_spider_deadlines_and_cancellation():
+    import time
+    from melk.util.threadpool import CancelToken
+    http = FakeHttp({})
+    spider = FakeSpider(http)
+    token = CancelToken()
+    spider.input_queue.put(SpiderJob('http://a.example.com/expired', deadline=time.time() - 1))
+    spider.input_queue.put(SpiderJob('http://a.example.com/fresh', deadline=time.time() + 60))
+    spider.input_queue.put(SpiderJob('http://a.example.com/token', cancel_token=token))
+    spider.input_queue.put(SpiderJob('http://a.example.com/tagged', tags=['refresh']))
+    spider.input_queue.put(SpiderJob('http://b.example.com/host'))
+    spider.input_queue.put(SpiderJob('http://c.example.com/untouched', tags=['search']))
+    token.cancel()
+    spider.cancel(tag='refresh')
+    spider.cancel(host='B.example.com')
+    # jobs made after a cancel are not affected by it
+    spider.input_queue.put(SpiderJob('http://a.example.com/later', tags=['refresh']))
+
+    spider.start()
+    spider.join()
+
+    assert http.requests == ['http://a.example.com/fresh',
+                             'http://c.example.com/untouched',
+                             'http://a.example.com/later']
+    assert spider.output_queue.qsize() == 3
+    events = spider.metrics.snapshot()['events']
+    assert events == {'expired': 1, 'cancelled': 3}
+    # with nothing left to match, the cancels are forgotten
+    assert not spider._cancelled_tags and not spider._cancelled_hosts
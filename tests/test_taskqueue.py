@@ -0,0 +1,322 @@
+import threading
+import time
+
+from melk.util.taskqueue import PriorityTaskQueue, FairShareTaskQueue, Sentinel
+from melk.util.taskqueue import TaskQueue, get_many
+from melk.util.threadpool import ThreadPool
+
+
+class Job(object):
+    def __init__(self, name, priority=0, key=None):
+        self.name = name
+        self.priority = priority
+        self.key = key
+
+
+def drain(q):
+    items = []
+    while q.qsize():
+        items.append(q.get())
+        q.task_done()
+    return items
+
+
+def test_priority_queue():
+    q = PriorityTaskQueue()
+    stop = Sentinel('stop')
+    q.put(Job('a'))
+    q.put(stop)
+    q.put(Job('b', 5))
+    q.put(Job('c', -1))
+    q.put('d', priority=-1)
+    q.put(Job('e'))
+    items = drain(q)
+    assert items[-1] is stop
+    assert [getattr(i, 'name', i) for i in items[:-1]] == ['c', 'd', 'a', 'e', 'b']
+    q.join()
+
+
+def test_fair_share_queue():
+    q = FairShareTaskQueue()
+    for i in range(4):
+        q.put(Job('bulk%d' % i, key='bulk'))
+    q.put(Job('x', key='alice'))
+    q.put(Job('y', key='bob'))
+    q.put(Job('z', key='alice'))
+    assert q.qsize() == 7
+    names = [j.name for j in get_many(q, 10)]
+    assert names == ['bulk0', 'x', 'y', 'bulk1', 'z', 'bulk2', 'bulk3']
+    assert q.qsize() == 0
+
+
+def test_priority_pool():
+    # a single worker, held up until everything is queued
+    gate = threading.Event()
+    def process(job):
+        gate.wait()
+        return job.name
+
+    tp = ThreadPool(poolsize=1, processor=process, output_queue=TaskQueue(),
+                    input_queue=PriorityTaskQueue())
+    tp.start()
+    tp.input_queue.put(Job('first'))
+    while tp.input_queue.qsize():
+        time.sleep(0.001)
+    for i in range(10):
+        tp.input_queue.put(Job('background'))
+    tp.input_queue.put(Job('interactive', -1))
+    gate.set()
+    tp.join()
+    results = drain(tp.output_queue)
+    # the first job was taken before the rest were queued
+    assert results[:2] == ['first', 'interactive']
+    assert len(results) == 12
+    tp.shutdown()
+    assert tp.workers == 0
+
+
+def test_priority_and_fair_share_see_through_submit():
+    gate = threading.Event()
+    def process(job):
+        gate.wait()
+        return job.name
+
+    tp = ThreadPool(poolsize=1, processor=process, input_queue=PriorityTaskQueue())
+    futures = [tp.submit(Job('background', 5)) for i in range(3)]
+    futures.append(tp.submit(Job('interactive', -1)))
+    tp.start()
+    done = []
+    for f in futures:
+        f.add_done_callback(lambda f: done.append(f.result()))
+    gate.set()
+    tp.join()
+    assert done[0] == 'interactive'
+    tp.shutdown()
+
+    q = FairShareTaskQueue()
+    tp = ThreadPool(poolsize=1, processor=process, input_queue=q)
+    for name, key in [('a1', 'a'), ('a2', 'a'), ('b1', 'b')]:
+        tp.submit(Job(name, key=key))
+    assert [j.job.name for j in get_many(q, 3)] == ['a1', 'b1', 'a2']
+
+
+def test_work_stealing_queue():
+    from melk.util.taskqueue import WorkStealingQueue
+    from Queue import Empty
+    q = WorkStealingQueue()
+    stop = Sentinel('stop')
+    q.put(1)
+    q.put(stop)
+    q.put_many([2, 3])
+    assert q.qsize() == 4
+    assert q.unfinished_tasks == 4
+    assert sorted(get_many(q, 3)) == [1, 2, 3]
+    assert q.get() is stop
+    try:
+        q.get(timeout=0.01)
+    except Empty:
+        pass
+    else:
+        assert False
+    for i in range(4):
+        q.task_done()
+    q.join()
+    try:
+        q.task_done()
+        q.join()
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_work_stealing_shares_outside_puts():
+    from melk.util.taskqueue import WorkStealingQueue
+    q = WorkStealingQueue()
+    got = {}
+    def worker(name, n):
+        got[name] = get_many(q, n)
+    q.put_many(range(10))
+    # a worker takes the rest of the shared jobs along with the first
+    t = threading.Thread(target=worker, args=('slow', 1))
+    t.start()
+    t.join()
+    assert got['slow'] == [0]
+    assert len(q._inject) == 0
+    assert list(q._deques[0]) == range(1, 10)
+    # which another worker can only steal from it
+    t = threading.Thread(target=worker, args=('thief', 9))
+    t.start()
+    t.join()
+    assert sorted(got['thief']) == range(1, 10)
+    q.task_done_many(10)
+    q.join()
+
+
+def test_work_stealing_pool():
+    from melk.util.taskqueue import WorkStealingQueue
+    def process(job):
+        # a few slow jobs among many quick ones
+        if job % 50 == 0:
+            time.sleep(0.01)
+        return job
+
+    for batch_size in (1, 8):
+        tp = ThreadPool(poolsize=16, processor=process, output_queue=TaskQueue(),
+                        input_queue=WorkStealingQueue(), batch_size=batch_size)
+        tp.start()
+        for i in range(500):
+            tp.put(i)
+        tp.join()
+        assert sorted(drain(tp.output_queue)) == range(500)
+
+        # workers retired by a resize hand on their jobs
+        tp.resize(4)
+        for i in range(500):
+            tp.put(i)
+        tp.join()
+        assert sorted(drain(tp.output_queue)) == range(500)
+        tp.shutdown()
+        assert tp.workers == 0
+
+
+def test_fast_task_queue():
+    from melk.util.taskqueue import FastTaskQueue, put_many, task_done_many
+    from Queue import Empty, Full
+    q = FastTaskQueue(maxsize=3)
+    q.put(1)
+    put_many(q, [2, 3])
+    assert q.full()
+    try:
+        q.put(4, timeout=0.01)
+    except Full:
+        pass
+    else:
+        assert False
+    assert get_many(q, 2) == [1, 2]
+    assert q.get() == 3
+    try:
+        q.get_nowait()
+    except Empty:
+        pass
+    else:
+        assert False
+    task_done_many(q, 3)
+    q.join()
+    try:
+        q.task_done()
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_fast_task_queue_threads():
+    from melk.util.taskqueue import FastTaskQueue, put_many
+    q = FastTaskQueue(maxsize=10)
+    out = FastTaskQueue()
+    def consume():
+        while True:
+            item = q.get()
+            q.task_done()
+            if item is None:
+                return
+            out.put(item)
+    def produce(start):
+        for i in range(start, start + 500, 5):
+            put_many(q, range(i, i + 5))
+    consumers = [threading.Thread(target=consume) for i in range(4)]
+    producers = [threading.Thread(target=produce, args=(i * 500,)) for i in range(4)]
+    for t in consumers + producers:
+        t.setDaemon(True)
+        t.start()
+    for t in producers:
+        t.join()
+    q.join()
+    for t in consumers:
+        q.put(None)
+    for t in consumers:
+        t.join(5)
+        assert not t.isAlive()
+    assert sorted(get_many(out, 5000)) == range(2000)
+
+
+def test_fast_task_queue_pool():
+    from melk.util.taskqueue import FastTaskQueue
+    tp = ThreadPool(poolsize=8, processor=lambda x: x * 2, output_queue=FastTaskQueue(),
+                    input_queue=FastTaskQueue(100), batch_size=4)
+    tp.start()
+    for i in range(1000):
+        tp.put(i)
+    tp.join()
+    assert sorted(drain(tp.output_queue)) == range(0, 2000, 2)
+    tp.shutdown()
+
+
+def test_sharded_pool_per_key_order():
+    from melk.util.taskqueue import ShardedTaskQueue
+    import random
+    lock = threading.Lock()
+    running = {}
+    seen = {}
+    def process(job):
+        lock.acquire()
+        try:
+            # no two jobs of a feed at once
+            assert job.key not in running
+            running[job.key] = job
+        finally:
+            lock.release()
+        time.sleep(random.random() * 0.002)
+        lock.acquire()
+        try:
+            del running[job.key]
+            seen.setdefault(job.key, []).append(job.name)
+        finally:
+            lock.release()
+        return job
+
+    for batch_size in (1, 3):
+        running.clear()
+        seen.clear()
+        tp = ThreadPool(poolsize=4, processor=process, output_queue=TaskQueue(),
+                        input_queue=ShardedTaskQueue(4), batch_size=batch_size)
+        tp.start()
+        for i in range(40):
+            for feed in range(10):
+                tp.put(Job(i, key='feed%d' % feed))
+        tp.join()
+        assert tp.input_queue.unfinished_tasks == 0
+        assert len(drain(tp.output_queue)) == 400
+        assert len(seen) == 10
+        for names in seen.values():
+            assert names == range(40)
+        tp.shutdown()
+        assert tp.workers == 0
+        assert tp.input_queue.qsize() == 0
+
+
+def test_sharded_pool_size_is_fixed():
+    from melk.util.taskqueue import ShardedTaskQueue
+    for kwargs in (dict(poolsize=3), dict(poolsize=5), dict(poolsize=4, max_workers=8)):
+        try:
+            ThreadPool(input_queue=ShardedTaskQueue(4), **kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, kwargs
+    tp = ThreadPool(processor=lambda job: job, input_queue=ShardedTaskQueue(4))
+    assert tp.poolsize == 4
+    tp.start()
+    try:
+        tp.resize(2)
+    except ValueError:
+        pass
+    else:
+        assert False
+    tp.resize(4)
+    for i in range(20):
+        tp.put(i)
+    tp.join()
+    tp.shutdown()
+    assert tp.workers == 0
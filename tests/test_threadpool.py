@@ -109,4 +109,418 @@ def test_threadpool_chain_adapters():
 
     for i in range(5, inputs+5):
         assert "%d" % i in outputs
-    
\ No newline at end of file
+    
+
+def test_threadpool_futures():
+    from melk.util.threadpool import as_completed
+
+    ba = BlackAdder()
+    ba.start()
+    futures = [ba.submit(i) for i in range(20)]
+    assert sorted(f.result() for f in as_completed(futures)) == range(1, 21)
+    assert [f.result() for f in futures] == range(1, 21)
+    # results of submitted jobs do not go to the output queue
+    assert ba.output_queue.qsize() == 0
+
+    def fail():
+        raise ValueError('oops')
+    f = ba.submit_call(fail)
+    assert isinstance(f.exception(), ValueError)
+    try:
+        f.result()
+        assert False, 'expected ValueError'
+    except ValueError:
+        pass
+    ba.join()
+
+
+def test_threadpool_map():
+    ba = BlackAdder()
+    ba.start()
+    assert list(ba.map(None, range(50), chunksize=7)) == range(1, 51)
+    assert list(ba.map(lambda x: x * 2, range(10))) == range(0, 20, 2)
+
+    def maybe_fail(x):
+        if x == 3:
+            raise KeyError(x)
+        return x
+    results = ba.map(maybe_fail, range(5), chunksize=2)
+    assert results.next() == 0
+    assert results.next() == 1
+    try:
+        results.next()
+        assert False, 'expected KeyError'
+    except KeyError:
+        pass
+
+
+def test_future_cancel():
+    from melk.util.threadpool import CancelledError
+    ba = BlackAdder()
+    # not started, so nothing runs yet
+    f = ba.submit(1)
+    assert f.cancel()
+    assert f.cancelled()
+    ba.start()
+    ba.join()
+    try:
+        f.result()
+        assert False, 'expected CancelledError'
+    except CancelledError:
+        pass
+
+
+def test_threadpool_shutdown():
+    ba = BlackAdder()
+    for i in range(20):
+        ba.input_queue.put(i)
+    ba.start()
+    assert ba.workers == 5
+    # a running pool can't be started again
+    try:
+        ba.start()
+        assert False, 'expected RuntimeError'
+    except RuntimeError:
+        pass
+    assert ba.workers == 5
+    ba.shutdown(wait=True, drain=True)
+    assert ba.workers == 0
+    assert ba.output_queue.qsize() == 20
+
+    # restart
+    ba.start()
+    assert ba.workers == 5
+    ba.input_queue.put(100)
+    ba.join()
+    assert ba.output_queue.qsize() == 21
+    ba.shutdown()
+    assert ba.workers == 0
+
+
+def test_threadpool_shutdown_discard():
+    import threading
+    gate = threading.Event()
+    started = threading.Event()
+    def process(job):
+        started.set()
+        gate.wait()
+        return job
+    tp = ThreadPool(poolsize=1, processor=process, output_queue=TaskQueue())
+    futures = [tp.submit(i) for i in range(10)]
+    tp.start()
+    started.wait()
+    threading.Timer(0.05, gate.set).start()
+    tp.shutdown(wait=True, drain=False)
+    # the job in progress completes, the rest are discarded
+    assert futures[0].result() == 0
+    assert [f.cancelled() for f in futures[1:]] == [True] * 9
+    assert tp.workers == 0
+    tp.join()
+
+
+def test_threadpool_bounded_queue():
+    from Queue import Full
+    tp = ThreadPool(poolsize=1, processor=lambda x: x, maxsize=3)
+    for i in range(3):
+        tp.put(i)
+    try:
+        tp.put(3, timeout=0.01)
+        assert False, 'expected Full'
+    except Full:
+        pass
+    tp.start()
+    tp.put(3, timeout=1)
+    tp.join()
+    tp.shutdown()
+
+
+def test_threadpool_batches():
+    from melk.util.threadpool import JobDropped
+
+    class BatchAdder(ThreadPool):
+        def __init__(self):
+            ThreadPool.__init__(self, poolsize=3, output_queue=TaskQueue(), batch_size=8)
+            self.batch_sizes = []
+
+        def _do_batch(self, jobs):
+            self.batch_sizes.append(len(jobs))
+            return [job + 1 for job in jobs]
+
+    ba = BatchAdder()
+    for i in range(100):
+        ba.input_queue.put(i)
+    futures = [ba.submit(i) for i in range(5)]
+    ba.start()
+    ba.join()
+    assert max(ba.batch_sizes) <= 8
+    assert sum(ba.batch_sizes) == 105
+    assert [f.result() for f in futures] == range(1, 6)
+    outputs = [ba.output_queue.get() for i in range(100)]
+    assert sorted(outputs) == range(1, 101)
+    ba.shutdown()
+    assert ba.workers == 0
+
+    # per job processing in batches
+    def odd_only(job):
+        if job % 2 == 0:
+            raise JobDropped('even')
+        return job
+    tp = ThreadPool(poolsize=2, processor=odd_only, output_queue=TaskQueue(), batch_size=4)
+    for i in range(20):
+        tp.input_queue.put(i)
+    tp.start()
+    tp.join()
+    assert sorted(tp.output_queue.get() for i in range(10)) == range(1, 20, 2)
+    assert tp.output_queue.qsize() == 0
+
+
+def test_threadpool_chain_stats():
+    import time
+    def slow(job):
+        time.sleep(0.005)
+        return job
+
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(poolsize=2, processor=lambda x: x, name='fetch'))
+    chain.append(ThreadPool(poolsize=2, processor=slow, name='parse'))
+    chain.append(ThreadPool(poolsize=2, processor=lambda x: x, name='store'))
+    for i in range(100):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+
+    stats = chain.stats()
+    assert [s['name'] for s in stats['stages']] == ['fetch', 'parse', 'store']
+    assert stats['bottleneck'] == 'parse'
+    parse = stats['stages'][1]
+    assert parse['jobs'] == 100
+    assert parse['errors'] == 0
+    assert parse['workers'] == 2
+    assert parse['service_time']['mean'] >= 0.005
+    assert parse['queue_depth'] == 0
+    assert len(parse['queue_depth_history']) >= 2
+    chain.shutdown()
+
+
+def test_threadpool_error_stats():
+    def fail(job):
+        raise ValueError(job)
+    tp = ThreadPool(poolsize=1, processor=fail)
+    tp.input_queue.put(1)
+    tp.start()
+    tp.join()
+    assert tp.stats()['errors'] == 1
+    tp.shutdown()
+
+
+def test_threadpool_resize():
+    import time
+    tp = ThreadPool(poolsize=2, processor=lambda x: x, output_queue=TaskQueue())
+    tp.start()
+    tp.resize(5)
+    assert tp.workers == 5
+    tp.resize(1)
+    for i in range(50):
+        if tp.workers == 1:
+            break
+        time.sleep(0.01)
+    assert tp.workers == 1
+    for i in range(10):
+        tp.input_queue.put(i)
+    tp.join()
+    assert tp.output_queue.qsize() == 10
+    tp.shutdown()
+    assert tp.workers == 0
+
+
+def test_threadpool_ordered():
+    import random, time
+    from melk.util.threadpool import JobDropped
+    def process(job):
+        time.sleep(random.random() * 0.005)
+        if job % 7 == 3:
+            raise JobDropped()
+        if job % 11 == 5:
+            raise ValueError(job)
+        return job
+
+    for batch_size in (1, 4):
+        tp = ThreadPool(poolsize=8, processor=process, output_queue=TaskQueue(),
+                        batch_size=batch_size, ordered=True)
+        for i in range(200):
+            tp.put(i)
+        tp.start()
+        tp.join()
+        outputs = []
+        while tp.output_queue.qsize() > 0:
+            outputs.append(tp.output_queue.get())
+        assert outputs == [i for i in range(200) if i % 7 != 3 and i % 11 != 5]
+        tp.shutdown()
+
+
+def test_threadpool_ordered_short_batch():
+    # a batch_processor that loses results fails its batch rather
+    # than leaving the reorder buffer waiting for them forever
+    def process(jobs):
+        if 10 in jobs:
+            return jobs[:-1]
+        return jobs
+
+    tp = ThreadPool(poolsize=4, batch_processor=process, output_queue=TaskQueue(),
+                    batch_size=4, ordered=True, window=8)
+    for i in range(100):
+        tp.put(i)
+    tp.start()
+    tp.join()
+    outputs = []
+    while tp.output_queue.qsize() > 0:
+        outputs.append(tp.output_queue.get())
+    assert len(outputs) >= 90
+    assert outputs == sorted(outputs)
+    assert 10 not in outputs
+    assert tp.stats()['errors'] >= 1
+    tp.shutdown()
+
+
+def test_threadpool_ordered_window():
+    import threading, time
+    first = threading.Event()
+    held = []
+    def process(job):
+        if job == 0:
+            first.wait()
+        held.append(tp._reorder.pending)
+        return job
+
+    tp = ThreadPool(poolsize=4, processor=process, output_queue=TaskQueue(),
+                    ordered=True, window=5)
+    for i in range(50):
+        tp.put(i)
+    tp.start()
+    # everything but job 0 that fits in the window is done
+    for i in range(100):
+        if len(held) == 4:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert len(held) == 4
+    assert tp.output_queue.qsize() == 0
+    first.set()
+    tp.join()
+    assert max(held) < 5
+    assert [tp.output_queue.get() for i in range(50)] == range(50)
+    tp.shutdown()
+
+
+def test_threadpool_chain_ordered():
+    import random, time
+    def jitter(job):
+        time.sleep(random.random() * 0.002)
+        return job + 1
+
+    chain = ThreadPoolChain()
+    for i in range(3):
+        chain.append(ThreadPool(poolsize=5, processor=jitter, ordered=True))
+    chain.output_queue = TaskQueue()
+    for i in range(100):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+    assert [chain.output_queue.get() for i in range(100)] == range(3, 103)
+    chain.shutdown()
+
+
+def test_batching_input_adapter():
+    import time
+    from melk.util.taskqueue import BatchingQueueInputAdapter, Sentinel
+    q = TaskQueue()
+    a = BatchingQueueInputAdapter(q, lambda x: x * 2, batch_size=3, window=0.05)
+    a.put(1)
+    a.put(2)
+    assert q.qsize() == 0
+    a.put(3)
+    # flushed by size
+    assert [q.get() for i in range(3)] == [2, 4, 6]
+    a.put(4)
+    assert q.qsize() == 0
+    time.sleep(0.2)
+    # flushed by time
+    assert q.qsize() == 1
+    assert q.get() == 8
+    stop = Sentinel('stop')
+    a.put(5)
+    a.put(stop)
+    assert [q.get(), q.get()] == [10, stop]
+    a.close()
+
+
+def test_coalescing_input_adapter():
+    from melk.util.taskqueue import BatchingQueueInputAdapter
+    q = TaskQueue()
+    a = BatchingQueueInputAdapter(q, batch_size=100, window=60,
+                                  key=lambda job: job[0], as_batch=True)
+    for i in range(10):
+        a.put(('feed1', i))
+        a.put(('feed2', i))
+    a.put(('feed3', 0))
+    assert a.coalesced == 18
+    a.flush()
+    assert q.get() == [('feed1', 9), ('feed2', 9), ('feed3', 0)]
+    a.close()
+
+
+def test_threadpool_chain_batching_adapter():
+    from melk.util.taskqueue import BatchingQueueInputAdapter
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(2, lambda url: url.lower()))
+    refresh = ThreadPool(2, lambda url: url, output_queue=TaskQueue())
+    # refreshes of the same feed inside a minute become one
+    chain.append(refresh, BatchingQueueInputAdapter(refresh.input_queue,
+                                                    batch_size=1000, window=60,
+                                                    key=lambda url: url))
+    for i in range(30):
+        chain.input_queue.put('http://example.com/FEED%d' % (i % 3))
+    chain.start()
+    chain.join()
+    assert sorted(chain.output_queue.get() for i in range(3)) == \
+        ['http://example.com/feed%d' % i for i in range(3)]
+    assert chain.output_queue.qsize() == 0
+    chain.shutdown()
+
+
+def test_threadpool_chain_shutdown_pushes_held_items():
+    from melk.util.taskqueue import BatchingQueueInputAdapter
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(2, lambda x: x))
+    store = ThreadPool(2, lambda x: x, output_queue=TaskQueue())
+    adapter = BatchingQueueInputAdapter(store.input_queue, batch_size=1000, window=60)
+    chain.append(store, adapter)
+    chain.start()
+    for i in range(10):
+        chain.input_queue.put(i)
+    # nothing is joined, the items are still held when shutting down
+    chain.shutdown()
+    assert sorted(chain.output_queue.get() for i in range(10)) == range(10)
+    assert chain.output_queue.qsize() == 0
+    assert store.workers == 0
+    adapter._timer.join(1)
+    assert not adapter._timer.isAlive()
+
+
+def test_batching_input_adapter_put_timeout():
+    from Queue import Full
+    from melk.util.taskqueue import BatchingQueueInputAdapter
+    q = TaskQueue(2)
+    a = BatchingQueueInputAdapter(q, batch_size=3, window=60)
+    a.put(1)
+    a.put(2)
+    try:
+        a.put(3, timeout=0.01)
+    except Full:
+        pass
+    else:
+        assert False
+    # the item that did not fit is still held
+    assert [q.get(), q.get()] == [1, 2]
+    a.close()
+    assert q.get() == 3
@@ -0,0 +1,90 @@
+import time
+from StringIO import StringIO
+
+from melk.util.trace import Tracer
+from melk.util.threadpool import ThreadPool, ThreadPoolChain, JobDropped
+from melk.util.taskqueue import TaskQueue, QueueInputAdapter
+
+
+def drain(q):
+    items = []
+    while q.qsize() > 0:
+        items.append(q.get())
+    return items
+
+
+def make_chain(batch_size=1):
+    def slow(job):
+        if job == 3:
+            time.sleep(0.05)
+        return job
+    def fussy(job):
+        if job == 5:
+            raise JobDropped()
+        return job
+
+    chain = ThreadPoolChain()
+    chain.append(ThreadPool(2, lambda x: x * 10, name='fetch'))
+    parse = ThreadPool(2, slow, name='parse', batch_size=batch_size)
+    # odd jobs are filtered out on the way into parse
+    chain.append(parse, QueueInputAdapter(parse.input_queue,
+                                          lambda x: (x / 10) % 2 and x / 10 or None))
+    chain.append(ThreadPool(2, fussy, name='store', output_queue=TaskQueue()))
+    return chain
+
+
+def test_trace_chain():
+    for batch_size in (1, 3):
+        chain = make_chain(batch_size)
+        tracer = Tracer(sample_rate=1.0, slow=0.04)
+        tracer.attach(chain)
+        for i in range(10):
+            chain.input_queue.put(i)
+        chain.start()
+        chain.join()
+
+        # results leave the chain bare
+        assert sorted(drain(chain.output_queue)) == [1, 3, 7, 9]
+        assert tracer.ended == 10
+
+        # in batches, the jobs batched with 3 are slow too
+        slow = tracer.slow_traces()
+        assert 1 <= len(slow) <= batch_size
+        trace = [t for t in slow if t.job == '3'][0]
+        assert trace.outcome == 'ok'
+        assert [span[0] for span in trace.spans] == ['fetch', 'parse', 'store']
+        assert trace.spans[1][2] >= 0.05
+        out = StringIO()
+        tracer.dump(out)
+        assert 'parse' in out.getvalue()
+        chain.shutdown()
+
+
+def test_trace_outcomes():
+    chain = make_chain()
+    tracer = Tracer(sample_rate=1.0, slow=None)
+    tracer.attach(chain)
+    for i in range(10):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+    outcomes = {}
+    for trace in tracer.slow_traces():
+        outcomes.setdefault(trace.outcome, []).append(trace.job)
+    assert sorted(outcomes['filtered']) == ['0', '2', '4', '6', '8']
+    assert outcomes['dropped'] == ['5']
+    assert len(outcomes['ok']) == 4
+    chain.shutdown()
+
+
+def test_trace_sampling_off():
+    chain = make_chain()
+    tracer = Tracer(sample_rate=0.0)
+    tracer.attach(chain)
+    for i in range(10):
+        chain.input_queue.put(i)
+    chain.start()
+    chain.join()
+    assert sorted(drain(chain.output_queue)) == [1, 3, 7, 9]
+    assert tracer.ended == 0
+    chain.shutdown()